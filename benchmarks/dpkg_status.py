@@ -0,0 +1,114 @@
+#!/usr/bin/python3
+
+"""
+Compare the performance of DpkgStatus.load_status with the line-based parser
+it replaced, on a synthetic dpkg status file
+"""
+
+from __future__ import annotations
+from typing import Dict, Optional, Tuple
+from unittest import mock
+import argparse
+import tempfile
+import timeit
+import sys
+import os
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from transilience.actions.apt import DpkgStatus  # noqa: E402
+
+
+def load_status_lines(path: str) -> Dict[Tuple[str, str], Tuple[str, str]]:
+    """
+    Line-based parser previously used by DpkgStatus.load_status
+    """
+    packages = {}
+    with open(path, "rb") as fd:
+        package: Optional[str] = None
+        version: Optional[str] = None
+        arch: Optional[str] = None
+        status: Optional[str] = None
+        for line in fd:
+            if line == b"\n":
+                if package is not None:
+                    packages[(package, arch)] = (version, status)
+                package = None
+                version = None
+                arch = None
+                status = None
+            elif line.startswith(b"Package: "):
+                package = line[9:-1].decode()
+            elif line.startswith(b"Version: "):
+                version = line[9:-1].decode()
+            elif line.startswith(b"Architecture: "):
+                arch = line[14:-1].decode()
+            elif line.startswith(b"Status: "):
+                status = line[8:-1].decode()
+        if package is not None:
+            packages[(package, arch)] = (version, status)
+    return packages
+
+
+def write_status(path: str, count: int, changed: Optional[int] = None):
+    """
+    Write a dpkg status file with ``count`` packages, and a different version
+    for package number ``changed``
+    """
+    with open(path, "wt") as fd:
+        for i in range(count):
+            version = "2.0-1" if i == changed else "1.0-1"
+            print(f"Package: package{i}", file=fd)
+            print("Status: install ok installed", file=fd)
+            print("Priority: optional", file=fd)
+            print("Section: misc", file=fd)
+            print("Installed-Size: 1234", file=fd)
+            print("Maintainer: Example Maintainer <maint@example.org>", file=fd)
+            print("Architecture: amd64", file=fd)
+            print(f"Version: {version}", file=fd)
+            print("Depends: libc6 (>= 2.31), libfoo1 (>= 1.2)", file=fd)
+            print("Conffiles:", file=fd)
+            print(f" /etc/package{i}/config.conf 0123456789abcdef0123456789abcdef", file=fd)
+            print(f"Description: Package number {i}", file=fd)
+            print(" This is a long description of the package, spanning", file=fd)
+            print(" multiple lines, as many descriptions do.", file=fd)
+            print(" .", file=fd)
+            print(" The parser only needs a few fields from each paragraph.", file=fd)
+            print(file=fd)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--packages", type=int, default=5000, help="number of packages in the status file")
+    parser.add_argument("--repeat", type=int, default=20, help="number of timed runs for each parser")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as workdir:
+        path = os.path.join(workdir, "status")
+        write_status(path, args.packages)
+
+        with mock.patch("subprocess.run"):
+            status = DpkgStatus(path, snapshot=None)
+
+        def full():
+            status.paragraphs = {}
+            status.load_status()
+
+        t_lines = timeit.timeit(lambda: load_status_lines(path), number=args.repeat) / args.repeat
+        t_full = timeit.timeit(full, number=args.repeat) / args.repeat
+
+        # Reload after a single package changed
+        status.load_status()
+        write_status(path, args.packages, changed=args.packages // 2)
+        t_incremental = timeit.timeit(status.load_status, number=args.repeat) / args.repeat
+
+        assert status.packages == load_status_lines(path)
+
+    print(f"{args.packages} packages:")
+    print(f"  line-based parser:          {t_lines * 1000:8.2f}ms")
+    print(f"  mmap parser, full parse:    {t_full * 1000:8.2f}ms")
+    print(f"  mmap parser, one change:    {t_incremental * 1000:8.2f}ms")
+
+
+if __name__ == "__main__":
+    main()
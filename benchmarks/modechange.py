@@ -0,0 +1,64 @@
+#!/usr/bin/python3
+
+"""
+Compare the performance of computing new file modes with
+ModeChange.compile/ModeChange.adjust and with the memoized ModeProgram, as
+done when setting permissions of many files
+"""
+
+from __future__ import annotations
+import argparse
+import random
+import timeit
+import sys
+import os
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from transilience.utils.modechange import ModeChange, ModeProgram  # noqa: E402
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--files", type=int, default=100000, help="number of files whose mode is computed")
+    parser.add_argument("--mode", default="u=rwX,g=rX,o=rX", help="symbolic mode to apply")
+    parser.add_argument("--repeat", type=int, default=5, help="number of timed runs for each method")
+    args = parser.parse_args()
+
+    # Typical mix of file modes found in a directory tree
+    rnd = random.Random(0)
+    files = [(rnd.choice((0o644, 0o600, 0o664, 0o755, 0o700, 0o775)), rnd.random() < 0.1) for i in range(args.files)]
+    umask = 0o022
+
+    def interpreted():
+        changes = ModeChange.compile(args.mode)
+        return [ModeChange.adjust(mode, is_dir, umask, changes) for mode, is_dir in files]
+
+    def memoized():
+        prog = ModeProgram.compile(args.mode)
+        return [prog.adjust(mode, is_dir, umask) for mode, is_dir in files]
+
+    def compile_interpreted():
+        for i in range(args.files):
+            ModeChange.compile(args.mode)
+
+    def compile_memoized():
+        for i in range(args.files):
+            ModeProgram.compile(args.mode)
+
+    assert interpreted() == memoized()
+
+    t_interpreted = timeit.timeit(interpreted, number=args.repeat) / args.repeat
+    t_memoized = timeit.timeit(memoized, number=args.repeat) / args.repeat
+    t_compile_interpreted = timeit.timeit(compile_interpreted, number=args.repeat) / args.repeat
+    t_compile_memoized = timeit.timeit(compile_memoized, number=args.repeat) / args.repeat
+
+    print(f"{args.files} files, mode {args.mode!r}:")
+    print(f"  adjust, ModeChange:         {t_interpreted * 1000:8.2f}ms")
+    print(f"  adjust, ModeProgram:        {t_memoized * 1000:8.2f}ms")
+    print(f"  compile, ModeChange:        {t_compile_interpreted * 1000:8.2f}ms")
+    print(f"  compile, ModeProgram:       {t_compile_memoized * 1000:8.2f}ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,46 @@
+from __future__ import annotations
+import unittest
+from transilience.actions import Action, ResultState
+from transilience.actions.action import ActionResolver
+from transilience.actions.misc import Noop
+from transilience.actions.facts import Platform
+
+
+class TestActionResolver(unittest.TestCase):
+    def test_registry(self):
+        resolver = ActionResolver()
+        resolver.register(Noop)
+        self.assertIs(resolver.resolve("transilience.actions.misc.Noop"), Noop)
+        self.assertEqual(resolver.hits, 1)
+        self.assertEqual(resolver.misses, 0)
+
+    def test_import(self):
+        resolver = ActionResolver(maxsize=1)
+        self.assertIs(resolver.resolve("transilience.actions.facts.platform.Platform"), Platform)
+        self.assertEqual((resolver.hits, resolver.misses), (0, 1))
+        self.assertIs(resolver.resolve("transilience.actions.facts.platform.Platform"), Platform)
+        self.assertEqual((resolver.hits, resolver.misses), (1, 1))
+
+        # The cache of imported classes is bounded
+        self.assertIs(resolver.resolve("transilience.actions.facts.facts.Facts").__name__, "Facts")
+        self.assertEqual(list(resolver.imported.keys()), ["transilience.actions.facts.facts.Facts"])
+
+    def test_invalid(self):
+        resolver = ActionResolver()
+        with self.assertRaises(ValueError):
+            resolver.resolve("transilience.actions.misc.DoesNotExist")
+        with self.assertRaises(ValueError):
+            resolver.resolve("transilience.actions.action.ResultState")
+        with self.assertRaises(ModuleNotFoundError):
+            resolver.resolve("transilience.does_not_exist.Action")
+
+
+class TestSerialize(unittest.TestCase):
+    def test_roundtrip(self):
+        act = Noop(changed=True)
+        act.result.state = ResultState.CHANGED
+        res = Action.deserialize(act.serialize())
+        self.assertIsInstance(res, Noop)
+        self.assertEqual(res.uuid, act.uuid)
+        self.assertTrue(res.changed)
+        self.assertEqual(res.result.state, ResultState.CHANGED)
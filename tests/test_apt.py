@@ -8,8 +8,10 @@ import shlex
 import time
 import os
 from transilience.unittest import ActionTestMixin, LocalTestMixin, ChrootTestMixin
-from transilience.actions import builtin
+from transilience.actions import builtin, ResultState
+from transilience.actions import apt
 from transilience.actions.apt import DpkgStatus
+from transilience.system import Local, PipelineInfo
 
 
 class MockDpkgStatus(DpkgStatus):
@@ -61,9 +63,13 @@ exit {returncode}
             with mock.patch("transilience.actions.apt.Apt.find_apt_get", return_value=apt_get):
                 yield MockLogFile(logfile)
 
-    def run_apt(self, changed=True, upgraded=0, new=0, removed=0, held=0, **kwargs):
+    def run_apt(self, system=None, changed=True, upgraded=0, new=0, removed=0, held=0, **kwargs):
         with self.mock_apt(upgraded, new, removed, held) as log:
-            self.run_action(builtin.apt(**kwargs), changed=changed)
+            if system is None:
+                self.run_action(builtin.apt(**kwargs), changed=changed)
+            else:
+                res = list(system.run_actions([builtin.apt(**kwargs)]))
+                self.assertEqual(res[0].result.state, ResultState.CHANGED if changed else ResultState.NOOP)
             return log.lines()
 
     def test_update(self):
@@ -77,6 +83,19 @@ exit {returncode}
             lines = self.run_apt(changed=False, update_cache=True, cache_valid_time=3000)
             self.assertEqual(lines, [])
 
+    def test_update_once(self):
+        system = Local()
+        lines = self.run_apt(system=system, update_cache=True)
+        self.assertEqual(lines, ["update"])
+
+        # apt-get update is not run again until the apt sources change
+        lines = self.run_apt(system=system, changed=False, update_cache=True)
+        self.assertEqual(lines, [])
+
+        updater = system.get_action_cache(apt.Apt, apt.AptCache).updater
+        self.assertEqual(updater.updates, 1)
+        self.assertEqual(updater.saved, 1)
+
     def test_upgrade(self):
         lines = self.run_apt(changed=False, upgrade="yes", upgraded=0)
         self.assertEqual(lines, ["upgrade --with-new-pkgs"])
@@ -102,7 +121,7 @@ exit {returncode}
     def test_install(self):
         with mock.patch("transilience.actions.apt.Apt.mark_manually_installed", return_value=None):
             status = MockDpkgStatus()
-            with mock.patch("transilience.actions.apt.DpkgStatus", lambda: status):
+            with mock.patch("transilience.actions.apt.DpkgStatus", lambda *args, **kw: status):
                 lines = self.run_apt(name=["python3"], state="present", new=1)
                 self.assertEqual(lines, ["install python3"])
 
@@ -126,7 +145,7 @@ exit {returncode}
 
     def test_remove(self):
         status = MockDpkgStatus()
-        with mock.patch("transilience.actions.apt.DpkgStatus", lambda: status):
+        with mock.patch("transilience.actions.apt.DpkgStatus", lambda *args, **kw: status):
             lines = self.run_apt(changed=False, name=["python3"], state="absent", removed=1)
             self.assertEqual(lines, [])
 
@@ -148,6 +167,166 @@ exit {returncode}
             lines = self.run_apt(name=["python3:arm64"], state="absent", purge=True, removed=1)
             self.assertEqual(lines, ["--purge remove python3:arm64"])
 
+    def test_deb(self):
+        debs = [f"/srv/repo/pkg{i}.deb" for i in range(6)]
+
+        def get_deb_info(path):
+            return os.path.basename(path)[:-4], "1.0", "amd64"
+
+        status = MockDpkgStatus()
+        status.packages = {("pkg3", "amd64"): ("1.0", "install ok installed")}
+        with mock.patch("transilience.actions.apt.DpkgStatus", lambda *args, **kw: status):
+            with mock.patch("transilience.actions.apt.Apt.get_deb_info", side_effect=get_deb_info):
+                lines = self.run_apt(Local(), deb=debs, new=5)
+        # Installed packages are skipped, and others are listed only once
+        self.assertEqual(lines, ["install " + " ".join(path for path in debs if "pkg3" not in path)])
+
+    def test_merge(self):
+        status = MockDpkgStatus()
+        status.packages = {("installed", "amd64"): ("1.0", "install ok installed")}
+
+        def update():
+            # Packages installed by the mock apt-get
+            for line in log.lines():
+                for name in line.split():
+                    if name.startswith("-") or name == "install":
+                        continue
+                    status.packages[(name, "amd64")] = ("1.0", "install ok installed")
+
+        pipeline1 = PipelineInfo("pipeline1")
+        pipeline2 = PipelineInfo("pipeline2")
+        acts = [
+            (builtin.apt(name=["pkga", "pkgb"]), pipeline1),
+            (builtin.apt(name=["installed"]), pipeline1),
+            (builtin.apt(name=["pkgb", "pkgc"]), pipeline2),
+            (builtin.apt(name=["pkgd"], install_recommends=False), pipeline2),
+        ]
+
+        system = Local()
+        with mock.patch("transilience.actions.apt.Apt.mark_manually_installed", return_value=None):
+            with mock.patch("transilience.actions.apt.DpkgStatus", lambda *args, **kw: status):
+                with mock.patch.object(status, "update", update):
+                    with self.mock_apt(new=3) as log:
+                        for act, pipeline in acts:
+                            system.send_pipelined(act, pipeline)
+                        res = list(system.receive_pipelined())
+                        self.assertEqual(log.lines(), ["install pkga pkgb pkgc", "--no-install-recommends install pkgd"])
+
+        self.assertEqual([a.uuid for a in res], [a.uuid for a, p in acts])
+        self.assertEqual(
+                [a.result.state for a in res],
+                [ResultState.CHANGED, ResultState.NOOP, ResultState.CHANGED, ResultState.CHANGED])
+
+
+class TestDpkgStatus(unittest.TestCase):
+    def test_parse(self):
+        with tempfile.TemporaryDirectory() as workdir:
+            path = os.path.join(workdir, "status")
+            paragraphs = [
+                "Package: hello\nStatus: install ok installed\nArchitecture: amd64\nVersion: 2.10-2\n"
+                "Description: example package\n Package: notapackage\n",
+                "Package: libc6\nStatus: install ok installed\nArchitecture: i386\nVersion: 2.31-13\n",
+                "Status: install ok installed\n",
+                "Package: removed\nStatus: deinstall ok config-files\nArchitecture: all\nVersion: 1.0",
+            ]
+            with open(path, "wt") as fd:
+                fd.write("\n".join(paragraphs))
+
+            with mock.patch("transilience.actions.apt.subprocess.run"):
+                status = DpkgStatus(path, snapshot=None)
+            status.arch = "amd64"
+            status.load_status()
+            self.assertEqual(status.packages, {
+                ("hello", "amd64"): ("2.10-2", "install ok installed"),
+                ("libc6", "i386"): ("2.31-13", "install ok installed"),
+                ("removed", "all"): ("1.0", "deinstall ok config-files"),
+            })
+            self.assertEqual(status.status("hello"), ("2.10-2", "install ok installed"))
+            self.assertEqual(status.status("removed"), ("1.0", "deinstall ok config-files"))
+            self.assertEqual(status.status("libc6"), (None, None))
+            self.assertEqual(status.status("libc6", "i386"), ("2.31-13", "install ok installed"))
+
+            # Only changed paragraphs are parsed again
+            paragraphs[1] = paragraphs[1].replace("2.31-13", "2.31-14")
+            with open(path, "wt") as fd:
+                fd.write("\n".join(paragraphs))
+            with mock.patch("transilience.actions.apt.parse_dpkg_paragraph", wraps=apt.parse_dpkg_paragraph) as parse:
+                status.load_status()
+            self.assertEqual(parse.call_count, 1)
+            self.assertEqual(status.status("libc6", "i386"), ("2.31-14", "install ok installed"))
+            self.assertEqual(len(status.packages), 3)
+
+            # Empty status file
+            with open(path, "wt") as fd:
+                pass
+            status.load_status()
+            self.assertEqual(status.packages, {})
+
+    def test_snapshot_path(self):
+        self.assertEqual(os.path.dirname(apt.dpkg_status_snapshot_path("/var/lib/dpkg/status")),
+                         apt.DPKG_STATUS_SNAPSHOT_DIR)
+        self.assertNotEqual(apt.dpkg_status_snapshot_path("/var/lib/dpkg/status"),
+                            apt.dpkg_status_snapshot_path("/srv/chroot/var/lib/dpkg/status"))
+        self.assertEqual(apt.dpkg_status_snapshot_path("/var/lib/dpkg/status", "/tmp"),
+                         apt.dpkg_status_snapshot_path("/var/lib/dpkg/../dpkg/status", "/tmp"))
+
+        # Snapshots are opt-in
+        with mock.patch("transilience.actions.apt.subprocess.run"):
+            self.assertIsNone(DpkgStatus("/dev/null").snapshot)
+            self.assertIsNone(apt.AptCache().dpkg_status.snapshot)
+            self.assertEqual(apt.AptCache(dpkg_status_snapshot=True).dpkg_status.snapshot,
+                             apt.dpkg_status_snapshot_path("/var/lib/dpkg/status"))
+
+            # They are enabled as an option of the system
+            act = apt.Apt(name=["test"])
+            self.assertIsNone(act.get_apt_cache(Local()).dpkg_status.snapshot)
+            self.assertEqual(act.get_apt_cache(Local(dpkg_status_snapshot=True)).dpkg_status.snapshot,
+                             apt.dpkg_status_snapshot_path("/var/lib/dpkg/status"))
+
+    def test_snapshot(self):
+        with tempfile.TemporaryDirectory() as workdir:
+            path = os.path.join(workdir, "status")
+            snapshot = os.path.join(workdir, "cache", "dpkg-status.pickle")
+            with open(path, "wt") as fd:
+                fd.write("Package: hello\nStatus: install ok installed\nArchitecture: amd64\nVersion: 2.10-2\n")
+
+            with mock.patch("transilience.actions.apt.subprocess.run") as run:
+                run.return_value.stdout = "amd64\n"
+                status = DpkgStatus(path, snapshot=snapshot)
+                status.update()
+                self.assertEqual(run.call_count, 1)
+            self.assertEqual(status.status("hello"), ("2.10-2", "install ok installed"))
+            self.assertEqual(os.stat(snapshot).st_mode & 0o777, 0o600)
+
+            # A new instance uses the snapshot without running dpkg or
+            # parsing the status file
+            with mock.patch("transilience.actions.apt.subprocess.run") as run:
+                with mock.patch("transilience.actions.apt.DpkgStatus.load_status") as load_status:
+                    status = DpkgStatus(path, snapshot=snapshot)
+                    status.update()
+                    self.assertEqual(status.arch, "amd64")
+                    self.assertEqual(status.status("hello"), ("2.10-2", "install ok installed"))
+                run.assert_not_called()
+                load_status.assert_not_called()
+
+            # When the status file changes, the snapshot is only used for
+            # the architecture
+            with open(path, "at") as fd:
+                fd.write("\nPackage: world\nStatus: install ok installed\nArchitecture: all\nVersion: 1.0\n")
+            with mock.patch("transilience.actions.apt.subprocess.run") as run:
+                status = DpkgStatus(path, snapshot=snapshot)
+                self.assertEqual(status.packages, {})
+                status.update()
+                run.assert_not_called()
+            self.assertEqual(status.status("world"), ("1.0", "install ok installed"))
+
+            # Snapshots writable by others are ignored
+            os.chmod(snapshot, 0o622)
+            with mock.patch("transilience.actions.apt.subprocess.run") as run:
+                run.return_value.stdout = "amd64\n"
+                DpkgStatus(path, snapshot=snapshot)
+                self.assertEqual(run.call_count, 1)
+
 
 class TestAptReal(ActionTestMixin, ChrootTestMixin, unittest.TestCase):
     def test_install_existing(self):
@@ -2,10 +2,13 @@ from __future__ import annotations
 from typing import List, Optional
 import tempfile
 import unittest
+from unittest import mock
 import stat
 import os
 from transilience.unittest import ActionTestMixin, LocalTestMixin, LocalMitogenTestMixin
 from transilience.actions import builtin, ResultState
+from transilience.actions.blockinfile import BlockInFile
+from transilience.system import Local
 
 
 def read_umask() -> int:
@@ -220,6 +223,112 @@ class BlockInFileTests(ActionTestMixin, LocalTestMixin, unittest.TestCase):
                 lines("line0", "line1", "line2", begin, "test", end),
                 block="test", insertafter="EOF")
 
+        # If the regular expression does not match, the block goes at the end
+        self.assertBlockInFile(
+                lines("line0", "line1", "line2"),
+                lines("line0", "line1", "line2", begin, "test", end),
+                block="test", insertafter="missing")
+
+        self.assertBlockInFile(
+                lines("line0", "line1", "line2"),
+                lines("line0", "line1", "line2", begin, "test", end),
+                block="test", insertbefore="missing")
+
+        self.assertBlockInFile(
+                lines("line0", "line1", "line2"),
+                insertbefore="missing")
+
+        # The last matching line is used
+        self.assertBlockInFile(
+                lines("line0", "line1", "line2"),
+                lines("line0", "line1", begin, "test", end, "line2"),
+                block="test", insertafter="^line[01]$")
+
+        # The block always starts on a new line
+        self.assertBlockInFile(
+                ["line0\n", "line1"],
+                ["line0\n", "line1\n", begin + "\n", "test\n", end + "\n"],
+                block="test")
+
+    def test_insert_regex(self):
+        begin = "# BEGIN ANSIBLE MANAGED BLOCK\n"
+        end = "# END ANSIBLE MANAGED BLOCK\n"
+
+        # Patterns are matched against one line at a time, with ^ and $
+        # matching at the start and end of the line
+        self.assertBlockInFile(
+                ["line0\n", "\n", "line1\n"],
+                ["line0\n", begin, "test\n", end, "\n", "line1\n"],
+                block="test", insertbefore="^$")
+
+        self.assertBlockInFile(
+                ["line0\n", "xline1\n", "line1x\n"],
+                ["line0\n", "xline1\n", "line1x\n", begin, "test\n", end],
+                block="test", insertafter="^line1$")
+
+        # Matches cannot span multiple lines, nor hide matches on the lines
+        # they would span
+        self.assertBlockInFile(
+                ["a\n", "ab\n", "c\n"],
+                ["a\n", "ab\n", begin, "test\n", end, "c\n"],
+                block="test", insertafter="a[^z]*b")
+
+        self.assertBlockInFile(
+                ["line0\n", "line1\n"],
+                ["line0\n", "line1\n", begin, "test\n", end],
+                block="test", insertafter="line0.line1")
+
+        # A last line without a trailing newline can match
+        self.assertBlockInFile(
+                ["line0\n", "line1"],
+                ["line0\n", begin, "test\n", end, "line1"],
+                block="test", insertbefore="^line1$")
+
+        self.assertBlockInFile(
+                ["line0\n", "line1"],
+                ["line0\n", "line1\n", begin, "test\n", end],
+                block="test", insertafter="^line1$")
+
+    def test_same_markers(self):
+        marker = "# ANSIBLE MANAGED BLOCK"
+        self.assertBlockInFile(
+                ["line0\n", marker + "\n", "line1\n", marker + "\n", "line2\n"],
+                ["line0\n", marker + "\n", "test\n", marker + "\n", "line2\n"],
+                block="test", marker="# ANSIBLE MANAGED BLOCK{mark}", marker_begin="", marker_end="")
+
+    def test_merge(self):
+        with tempfile.TemporaryDirectory() as workdir:
+            testfile = os.path.join(workdir, "testfile")
+            with open(testfile, "wt") as fd:
+                fd.write("line0\n# BEGIN B\nb\n# END B\n")
+
+            actions = [
+                builtin.blockinfile(path=testfile, block="a", marker="# {mark} A", mode=0o640),
+                builtin.blockinfile(path=testfile, block="b", marker="# {mark} B", mode=0o640),
+                builtin.blockinfile(path=testfile, block="c", marker="# {mark} C", mode=0o640,
+                                    insertbefore="BOF"),
+                # Edits are applied in order
+                builtin.blockinfile(path=testfile, block="a1", marker="# {mark} A", mode=0o640),
+            ]
+
+            with mock.patch.object(BlockInFile, "write_file_atomically", autospec=True,
+                                   side_effect=BlockInFile.write_file_atomically) as write:
+                res = list(Local().run_actions(actions))
+            self.assertEqual(write.call_count, 1)
+
+            self.assertEqual([a.result.state for a in res], [
+                ResultState.CHANGED, ResultState.NOOP, ResultState.CHANGED, ResultState.CHANGED])
+            for a in res:
+                self.assertEqual(a.mode, 0o640)
+
+            with open(testfile, "rt") as fd:
+                self.assertEqual(fd.read(), "# BEGIN C\nc\n# END C\nline0\n# BEGIN B\nb\n# END B\n"
+                                            "# BEGIN A\na1\n# END A\n")
+            self.assertEqual(stat.S_IMODE(os.stat(testfile).st_mode), 0o640)
+
+            res = list(Local().run_actions(actions[1:3]))
+            self.assertEqual([a.result.state for a in res], [ResultState.NOOP, ResultState.NOOP])
+
 
 class TestBlockInFileLocal(LocalTestMixin, unittest.TestCase):
     pass
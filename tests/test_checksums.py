@@ -0,0 +1,98 @@
+from __future__ import annotations
+import tempfile
+import hashlib
+import unittest
+from unittest import mock
+import json
+import os
+from transilience.utils.checksums import ChecksumCache
+
+
+class TestChecksumCache(unittest.TestCase):
+    def write(self, path: str, payload: bytes, mtime_ns: int = 1_000_000_000):
+        with open(path, "wb") as fd:
+            fd.write(payload)
+        os.utime(path, ns=(mtime_ns, mtime_ns))
+
+    def test_cache(self):
+        with tempfile.TemporaryDirectory() as workdir:
+            path = os.path.join(workdir, "test")
+            self.write(path, b"test")
+
+            expected = hashlib.sha1(b"test").hexdigest()
+            cache = ChecksumCache()
+            self.assertEqual(cache.sha1sum(path), expected)
+            self.assertEqual((cache.hits, cache.misses), (0, 1))
+
+            with mock.patch("hashlib.sha1", side_effect=AssertionError("file hashed again")):
+                self.assertEqual(cache.sha1sum(path), expected)
+            self.assertEqual((cache.hits, cache.misses), (1, 1))
+
+            # Changing the file invalidates the cache
+            self.write(path, b"test1")
+            self.assertEqual(cache.sha1sum(path), hashlib.sha1(b"test1").hexdigest())
+            self.assertEqual((cache.hits, cache.misses), (1, 2))
+
+    def test_recently_modified(self):
+        with tempfile.TemporaryDirectory() as workdir:
+            path = os.path.join(workdir, "test")
+            with open(path, "wb") as fd:
+                fd.write(b"test")
+
+            cache = ChecksumCache()
+            cache.sha1sum(path)
+            self.assertEqual(cache.entries, {})
+
+    def test_persist(self):
+        with tempfile.TemporaryDirectory() as workdir:
+            path = os.path.join(workdir, "test")
+            cache_file = os.path.join(workdir, "cache")
+            self.write(path, b"test")
+
+            cache = ChecksumCache(cache_file)
+            cache.sha1sum(path)
+            cache.save()
+
+            cache = ChecksumCache(cache_file)
+            self.assertEqual(cache.sha1sum(path), hashlib.sha1(b"test").hexdigest())
+            self.assertEqual((cache.hits, cache.misses), (1, 0))
+
+    def test_invalid(self):
+        with tempfile.TemporaryDirectory() as workdir:
+            path = os.path.join(workdir, "test")
+            cache_file = os.path.join(workdir, "cache")
+            self.write(path, b"test")
+            st = os.stat(path)
+            good = [path, st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns, hashlib.sha1(b"test").hexdigest()]
+
+            for data in ('{"entries": [["foo", 1]]', '[1, 2]', '{"entries": 3}', '{"entries": [3, null]}'):
+                with open(cache_file, "wt") as fd:
+                    fd.write(data)
+                self.assertEqual(ChecksumCache(cache_file).entries, {})
+
+            # Invalid rows are skipped
+            with open(cache_file, "wt") as fd:
+                json.dump({"entries": [["foo", 1], good, good[:3] + ["1", 2, "x"]]}, fd)
+            cache = ChecksumCache(cache_file)
+            self.assertEqual(list(cache.entries), [path])
+            self.assertEqual(cache.sha1sum(path), good[5])
+            self.assertEqual((cache.hits, cache.misses), (1, 0))
+
+    def test_prune(self):
+        with tempfile.TemporaryDirectory() as workdir:
+            cache_file = os.path.join(workdir, "cache")
+            paths = [os.path.join(workdir, f"test{i}") for i in range(3)]
+            cache = ChecksumCache(cache_file)
+            for path in paths:
+                self.write(path, b"test")
+                cache.sha1sum(path)
+            cache.save()
+
+            os.unlink(paths[0])
+            self.write(paths[1], b"test1")
+
+            # Saving drops entries of removed and changed files
+            cache = ChecksumCache(cache_file)
+            self.assertEqual(len(cache.entries), 3)
+            cache.save()
+            self.assertEqual(list(ChecksumCache(cache_file).entries), [paths[2]])
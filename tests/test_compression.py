@@ -0,0 +1,33 @@
+from __future__ import annotations
+import unittest
+import io
+from transilience.utils import compression
+
+
+class TestCompression(unittest.TestCase):
+    def roundtrip(self, data: bytes, method):
+        chunks = list(compression.compress(io.BytesIO(data), method))
+        self.assertEqual(b"".join(compression.decompress(chunks, method)), data)
+        return chunks
+
+    def test_choose_method(self):
+        self.assertIsNone(compression.choose_method("/etc/hosts", 100))
+        self.assertIsNone(compression.choose_method("/srv/archive.tar.GZ", 1024 * 1024))
+        self.assertEqual(compression.choose_method("/etc/big.conf", 1024 * 1024), "lzma")
+        self.assertEqual(compression.choose_method("/srv/dump.sql", 100 * 1024 * 1024), "zlib")
+
+    def test_roundtrip(self):
+        data = b"".join(b"line %d of a config file\n" % i for i in range(20000))
+        for method in (None, "zlib", "lzma"):
+            with self.subTest(method=method):
+                chunks = self.roundtrip(data, method)
+                if method is not None:
+                    self.assertLess(sum(len(c) for c in chunks), len(data) // 4)
+        self.roundtrip(b"", "zlib")
+        self.roundtrip(b"", "lzma")
+
+    def test_truncated(self):
+        chunks = list(compression.compress(io.BytesIO(b"test" * 1000), "zlib"))
+        data = b"".join(chunks)
+        with self.assertRaises(ValueError):
+            list(compression.decompress([data[:-4]], "zlib"))
@@ -1,10 +1,13 @@
 from __future__ import annotations
+from unittest import mock
 import tempfile
+import threading
 import unittest
 import stat
+import time
 import os
 from transilience.unittest import ActionTestMixin, LocalTestMixin, LocalMitogenTestMixin
-from transilience.actions import builtin
+from transilience.actions import builtin, ResultState
 
 
 class CopyTests(ActionTestMixin):
@@ -156,3 +159,146 @@ class TestCopyLocal(CopyTests, LocalTestMixin, unittest.TestCase):
 
 class TestCopyMitogen(CopyTests, LocalMitogenTestMixin, unittest.TestCase):
     pass
+
+
+class TestCopyMitogenFileStore(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        import mitogen
+        from transilience.system import Mitogen
+        cls.workdir = tempfile.TemporaryDirectory()
+        cls.store = os.path.join(cls.workdir.name, "store")
+        cls.broker = mitogen.master.Broker()
+        cls.router = mitogen.master.Router(cls.broker)
+        cls.system = Mitogen("workdir", "local", router=cls.router, file_store=cls.store)
+
+    @classmethod
+    def tearDownClass(cls):
+        super().tearDownClass()
+        cls.system.close()
+        cls.broker.shutdown()
+        cls.workdir.cleanup()
+
+    def test_store(self):
+        with tempfile.TemporaryDirectory() as workdir:
+            payload = "♥ test content"
+            srcfile = os.path.join(workdir, "source")
+            with open(srcfile, "wt") as fd:
+                fd.write(payload)
+
+            self.system.share_file_prefix(workdir)
+            act = builtin.copy(src=srcfile, dest=os.path.join(workdir, "dest1"))
+            list(self.system.run_actions([act]))
+            self.assertEqual(os.listdir(self.store), [act.checksum])
+
+            # Once in the store, the source is not transferred again
+            os.unlink(srcfile)
+            list(self.system.run_actions([
+                builtin.copy(src=srcfile, checksum=act.checksum, dest=os.path.join(workdir, "dest2"))]))
+            with open(os.path.join(workdir, "dest2"), "rt") as fd:
+                self.assertEqual(fd.read(), payload)
+
+
+class TestCopyMitogenDelta(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        import mitogen
+        from transilience.system import Mitogen
+        cls.broker = mitogen.master.Broker()
+        cls.router = mitogen.master.Router(cls.broker)
+        cls.system = Mitogen("workdir", "local", router=cls.router, delta_min_size=1024)
+
+    @classmethod
+    def tearDownClass(cls):
+        super().tearDownClass()
+        cls.system.close()
+        cls.broker.shutdown()
+
+    def test_delta(self):
+        with tempfile.TemporaryDirectory() as workdir:
+            old = b"".join(b"%08d\n" % i for i in range(20000))
+            new = old[:50000] + b"changed\n" + old[50000:]
+            srcfile = os.path.join(workdir, "source")
+            with open(srcfile, "wb") as fd:
+                fd.write(new)
+            dstfile = os.path.join(workdir, "destination")
+            with open(dstfile, "wb") as fd:
+                fd.write(old)
+
+            self.system.share_file_prefix(workdir)
+            act = builtin.copy(src=srcfile, dest=dstfile)
+            act = list(self.system.run_actions([act]))[0]
+            self.assertEqual(act.result.state, ResultState.CHANGED)
+
+            with open(dstfile, "rb") as fd:
+                self.assertEqual(fd.read(), new)
+
+    def test_unshared(self):
+        with tempfile.TemporaryDirectory() as workdir:
+            srcfile = os.path.join(workdir, "source")
+            with open(srcfile, "wb") as fd:
+                fd.write(b"new" * 1000)
+            dstfile = os.path.join(workdir, "destination")
+            with open(dstfile, "wb") as fd:
+                fd.write(b"old" * 1000)
+
+            with self.assertRaises(Exception):
+                list(self.system.run_actions([builtin.copy(src=srcfile, dest=dstfile)]))
+
+
+class TestCopyMitogenCompressed(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        import mitogen
+        from transilience.system import Mitogen
+        cls.broker = mitogen.master.Broker()
+        cls.router = mitogen.master.Router(cls.broker)
+        cls.system = Mitogen("workdir", "local", router=cls.router, transfer_compression=True)
+
+    @classmethod
+    def tearDownClass(cls):
+        super().tearDownClass()
+        cls.system.close()
+        cls.broker.shutdown()
+
+    def test_compressed(self):
+        with tempfile.TemporaryDirectory() as workdir:
+            self.system.share_file_prefix(workdir)
+            for name, payload in (
+                    ("small", b"test"),
+                    ("config", b"".join(b"option%d = value\n" % i for i in range(10000))),
+                    ("archive.gz", b"x" * 10000)):
+                srcfile = os.path.join(workdir, name)
+                with open(srcfile, "wb") as fd:
+                    fd.write(payload)
+                dstfile = os.path.join(workdir, name + ".copy")
+
+                list(self.system.run_actions([builtin.copy(src=srcfile, dest=dstfile)]))
+                with open(dstfile, "rb") as fd:
+                    self.assertEqual(fd.read(), payload)
+
+    def test_window(self):
+        with tempfile.TemporaryDirectory() as workdir:
+            self.system.share_file_prefix(workdir)
+            # Already compressed files are sent as they are, in many chunks
+            payload = os.urandom(2 * 1024 * 1024)
+            srcfile = os.path.join(workdir, "random.gz")
+            with open(srcfile, "wb") as fd:
+                fd.write(payload)
+            dstfile = os.path.join(workdir, "random.copy")
+
+            with mock.patch.object(self.system.transfer_service, "window_size", 2):
+                list(self.system.run_actions([builtin.copy(src=srcfile, dest=dstfile)]))
+            with open(dstfile, "rb") as fd:
+                self.assertEqual(fd.read(), payload)
+
+            # The transfer thread ends once the requestee acknowledged everything
+            for i in range(50):
+                if not any(t.name.startswith("transfer-") for t in threading.enumerate()):
+                    break
+                time.sleep(0.1)
+            else:
+                self.fail("transfer thread still running")
@@ -0,0 +1,121 @@
+from __future__ import annotations
+from unittest import mock
+import unittest
+import tempfile
+import tarfile
+import io
+import os
+from transilience.utils import debfile, checksums
+
+
+def make_deb(path: str, control: str, compression: str = "gz", gnu: bool = False):
+    """
+    Write a minimal .deb file with the given control file
+    """
+    def make_tar(files, mode):
+        buf = io.BytesIO()
+        with tarfile.open(fileobj=buf, mode=mode) as tf:
+            for name, data in files:
+                info = tarfile.TarInfo(name)
+                info.size = len(data)
+                tf.addfile(info, io.BytesIO(data))
+        return buf.getvalue()
+
+    if compression == "zst":
+        # Not readable by tarfile: tests mock decompression, returning the
+        # uncompressed tar that follows the marker
+        control_tar = b"not really zstd" + make_tar([("./control", control.encode())], "w")
+    elif compression:
+        control_tar = make_tar([("./control", control.encode())], "w:" + compression)
+    else:
+        control_tar = make_tar([("./control", control.encode())], "w")
+    control_name = "control.tar" + (f".{compression}" if compression else "")
+
+    members = [
+        ("debian-binary", b"2.0\n"),
+        (control_name, control_tar),
+        ("data.tar.xz", make_tar([("./usr/share/doc/test", b"test")], "w:xz")),
+    ]
+
+    with open(path, "wb") as fd:
+        fd.write(debfile.AR_MAGIC)
+        for name, data in members:
+            if gnu:
+                name += "/"
+            fd.write(f"{name:<16}{0:<12}{0:<6}{0:<6}{100644:<8}{len(data):<10}`\n".encode())
+            fd.write(data)
+            if len(data) % 2:
+                fd.write(b"\n")
+
+
+CONTROL = """Package: hello
+Version: 2.10-2
+Architecture: amd64
+Maintainer: Example <example@example.org>
+Description: example package
+ Package: notapackage
+"""
+
+
+class TestDebFile(unittest.TestCase):
+    def test_read(self):
+        with tempfile.TemporaryDirectory() as workdir:
+            path = os.path.join(workdir, "test.deb")
+            for compression in ("", "gz", "xz"):
+                for gnu in (False, True):
+                    with self.subTest(compression=compression, gnu=gnu):
+                        make_deb(path, CONTROL, compression=compression, gnu=gnu)
+                        self.assertEqual(debfile.read_control(path), CONTROL.encode())
+
+            make_deb(path, CONTROL, compression="zst")
+            with mock.patch("transilience.utils.debfile.HAVE_ZSTANDARD", False):
+                self.assertIsNone(debfile.read_control(path))
+
+            # With the zstandard module, control.tar.zst is read in-process
+            zstandard = mock.Mock()
+            zstandard.ZstdDecompressor.return_value.decompressobj.return_value.decompress = \
+                lambda data: data[len(b"not really zstd"):]
+            with mock.patch("transilience.utils.debfile.HAVE_ZSTANDARD", True):
+                with mock.patch("transilience.utils.debfile.zstandard", zstandard, create=True):
+                    self.assertEqual(debfile.read_control(path), CONTROL.encode())
+
+            with open(path, "wb") as fd:
+                fd.write(b"test")
+            with self.assertRaises(RuntimeError):
+                debfile.read_control(path)
+
+    def test_cache(self):
+        with tempfile.TemporaryDirectory() as workdir:
+            path = os.path.join(workdir, "test.deb")
+            make_deb(path, CONTROL)
+            cache = debfile.DebInfoCache(checksums.ChecksumCache())
+            self.assertEqual(cache.info(path), ("hello", "2.10-2", "amd64"))
+            with mock.patch("transilience.utils.debfile.read_control") as read_control:
+                self.assertEqual(cache.info(path), ("hello", "2.10-2", "amd64"))
+                read_control.assert_not_called()
+
+            # Files rewritten with the same inode, size and modification time
+            # are read again
+            st = os.stat(path)
+            make_deb(path, CONTROL.replace("2.10-2", "2.10-3"))
+            os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns))
+            st1 = os.stat(path)
+            self.assertEqual((st1.st_ino, st1.st_size, st1.st_mtime_ns), (st.st_ino, st.st_size, st.st_mtime_ns))
+            self.assertEqual(cache.info(path), ("hello", "2.10-3", "amd64"))
+
+            # Changed files are read again
+            make_deb(path, CONTROL.replace("2.10-2", "2.10-4"))
+            os.utime(path, ns=(0, 0))
+            self.assertEqual(cache.info(path), ("hello", "2.10-4", "amd64"))
+
+            # Unsupported compression falls back to dpkg-deb
+            make_deb(path, CONTROL, compression="zst")
+            with mock.patch("transilience.utils.debfile.HAVE_ZSTANDARD", False):
+                with mock.patch("transilience.utils.debfile.dpkg_info", return_value=CONTROL.encode()) as dpkg_info:
+                    self.assertEqual(cache.info(path), ("hello", "2.10-2", "amd64"))
+                    dpkg_info.assert_called_once_with(path)
+
+            make_deb(path, "Package: hello\n")
+            os.utime(path, ns=(1, 1))
+            with self.assertRaises(RuntimeError):
+                cache.info(path)
@@ -0,0 +1,77 @@
+from __future__ import annotations
+from unittest import mock
+import tempfile
+import unittest
+import random
+import io
+from transilience.utils import delta
+
+
+class TestDelta(unittest.TestCase):
+    def roundtrip(self, old: bytes, new: bytes, block_size: int = 2048):
+        with tempfile.TemporaryFile() as basis, tempfile.TemporaryFile() as src:
+            basis.write(old)
+            basis.flush()
+            src.write(new)
+            src.flush()
+
+            basis.seek(0)
+            signatures = delta.block_signatures(basis, block_size)
+            ops = list(delta.compute_delta(src, signatures, block_size))
+
+            out = io.BytesIO()
+            written = delta.apply_delta(basis, ops, out, block_size)
+            self.assertEqual(written, len(new))
+            self.assertEqual(out.getvalue(), new)
+            return ops
+
+    def test_choose_block_size(self):
+        self.assertEqual(delta.choose_block_size(0), 2048)
+        self.assertEqual(delta.choose_block_size(100 * 1024 * 1024), 16384)
+        self.assertEqual(delta.choose_block_size(1024 ** 4), 128 * 1024)
+
+    def test_identical(self):
+        rnd = random.Random(1)
+        data = bytes(rnd.getrandbits(8) for i in range(10000))
+        ops = self.roundtrip(data, data)
+        # Only the trailing partial block is sent as literal data
+        self.assertEqual(ops[:4], [0, 1, 2, 3])
+        self.assertEqual(ops[4:], [data[8192:]])
+
+    def test_insert(self):
+        rnd = random.Random(2)
+        data = bytes(rnd.getrandbits(8) for i in range(20000))
+        new = data[:5000] + b"inserted" + data[5000:]
+        ops = self.roundtrip(data, new)
+        literal = sum(len(op) for op in ops if isinstance(op, bytes))
+        # Unaligned matches are found after the insertion
+        self.assertLess(literal, 3 * 2048)
+
+    def test_mismatch_fallback(self):
+        rnd = random.Random(3)
+        data = bytes(rnd.getrandbits(8) for i in range(20000))
+        changed = bytes(rnd.getrandbits(8) for i in range(12000))
+        new = data[:4096] + changed + data[4096:]
+        with mock.patch("transilience.utils.delta.MISMATCH_MIN_SCAN", 8192):
+            ops = self.roundtrip(data, new)
+        # The matching blocks after the mismatch are not looked for
+        self.assertEqual(ops[:2], [0, 1])
+        self.assertEqual(b"".join(ops[2:]), new[4096:])
+
+        # A mismatch below the ratio does not give up
+        new = data[:4096] + changed[:1000] + data[4096:]
+        with mock.patch("transilience.utils.delta.MISMATCH_MIN_SCAN", 8192):
+            ops = self.roundtrip(data, new)
+        literal = sum(len(op) for op in ops if isinstance(op, bytes))
+        self.assertLess(literal, 1000 + 3 * 2048)
+
+    def test_edge_cases(self):
+        self.roundtrip(b"", b"")
+        self.roundtrip(b"", b"new")
+        self.roundtrip(b"old" * 2000, b"")
+        self.roundtrip(b"old" * 2000, b"new")
+        self.roundtrip(b"a" * 10000, b"a" * 10001)
+
+    def test_bad_block(self):
+        with self.assertRaises(ValueError):
+            delta.apply_delta(io.BytesIO(b"short"), [0], io.BytesIO(), 2048)
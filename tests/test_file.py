@@ -2,6 +2,7 @@ from __future__ import annotations
 import tempfile
 import unittest
 import stat
+import sys
 import os
 from transilience.unittest import FileModeMixin, ActionTestMixin, LocalTestMixin, LocalMitogenTestMixin
 from transilience.actions import builtin
@@ -243,6 +244,78 @@ class DirectoryTests(FileTestMixin):
             st = os.stat(os.path.join(workdir, "testdir1", "testdir2", "file2"))
             self.assertFileModeEqual(st, 0o755)
 
+    def test_recurse_tree(self):
+        with tempfile.TemporaryDirectory() as outside:
+            with tempfile.TemporaryDirectory() as workdir:
+                for i in range(4):
+                    os.makedirs(os.path.join(workdir, f"dir{i}", "sub"))
+                    with open(os.path.join(workdir, f"dir{i}", "sub", "file"), "wt") as fd:
+                        os.fchmod(fd.fileno(), 0o600)
+                os.symlink(outside, os.path.join(workdir, "dir0", "link"))
+                os.chmod(outside, 0o700)
+
+                self.run_file_action(path=workdir, state="directory", mode="u=rwX,g=rX,o=rX", recurse=True)
+
+                for i in range(4):
+                    st = os.stat(os.path.join(workdir, f"dir{i}", "sub"))
+                    self.assertFileModeEqual(st, 0o755)
+                    st = os.stat(os.path.join(workdir, f"dir{i}", "sub", "file"))
+                    self.assertFileModeEqual(st, 0o644)
+
+                # Symlinks are not followed
+                self.assertFileModeEqual(os.stat(outside), 0o700)
+
+                self.run_file_action(
+                        path=workdir, state="directory", mode="u=rwX,g=rX,o=rX", recurse=True, changed=False)
+
+class TestTreeWalk(FileModeMixin, unittest.TestCase):
+    def test_replaced_dirs(self):
+        with tempfile.TemporaryDirectory() as outside:
+            with tempfile.TemporaryDirectory() as workdir:
+                os.chmod(outside, 0o700)
+                entries = []
+                for name in ("link", "file", "missing", "other"):
+                    path = os.path.join(workdir, name)
+                    os.mkdir(path)
+                    st = os.stat(path)
+                    entries.append((path, st.st_dev, st.st_ino))
+
+                # Replace directories after they have been listed
+                os.rmdir(entries[0][0])
+                os.symlink(outside, entries[0][0])
+                os.rmdir(entries[1][0])
+                with open(entries[1][0], "wb"):
+                    pass
+                os.rmdir(entries[2][0])
+                os.rename(entries[3][0], entries[3][0] + ".old")
+                os.mkdir(entries[3][0])
+                os.mkdir(os.path.join(entries[3][0], "sub"), 0o700)
+
+                act = builtin.file(path=workdir, state="directory", mode=0o755, recurse=True)
+                act.owner = act.group = -1
+                act._set_subtree_perms(list(entries), {})
+
+                self.assertFileModeEqual(os.stat(outside), 0o700)
+                self.assertFileModeEqual(os.stat(os.path.join(entries[3][0], "sub")), 0o700)
+
+    def test_deep_tree(self):
+        with tempfile.TemporaryDirectory() as workdir:
+            path = os.path.join(workdir, *(["d"] * 300))
+            os.makedirs(path, mode=0o700)
+            st = os.stat(os.path.join(workdir, "d"))
+
+            act = builtin.file(path=workdir, state="directory", mode=0o755, recurse=True)
+            act.owner = act.group = -1
+            # Tree depth does not count towards the recursion limit
+            limit = sys.getrecursionlimit()
+            sys.setrecursionlimit(100)
+            try:
+                act._set_subtree_perms([(os.path.join(workdir, "d"), st.st_dev, st.st_ino)], {})
+            finally:
+                sys.setrecursionlimit(limit)
+
+            self.assertFileModeEqual(os.stat(path), 0o755)
+
 
 class TestDirectoryLocal(DirectoryTests, LocalTestMixin, unittest.TestCase):
     pass
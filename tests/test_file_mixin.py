@@ -1,7 +1,9 @@
 from __future__ import annotations
 from typing import Optional, Union
 import contextlib
+import tempfile
 import unittest
+import os
 from unittest import mock
 from transilience.actions.common import FileAction
 from transilience.unittest import FileModeMixin
@@ -18,7 +20,7 @@ class TestComputeFsPerms(FileModeMixin, unittest.TestCase):
         if umask is None:
             yield
         else:
-            with mock.patch("os.umask", return_value=umask):
+            with mock.patch("transilience.actions.common.get_umask", return_value=umask):
                 yield
 
     def assertComputedPerms(
@@ -95,3 +97,35 @@ class TestComputeFsPerms(FileModeMixin, unittest.TestCase):
                 if src == dest:
                     continue
                 self.assertComputedPerms(mode=f"a=,{src}=rwx,{dest}={src},{src}=", orig=0o644, expected=expected[dest])
+
+
+class TestPathCache(unittest.TestCase):
+    def test_cache(self):
+        with tempfile.TemporaryDirectory() as workdir:
+            path = os.path.join(workdir, "file")
+            link = os.path.join(workdir, "link")
+            act = ComputedPermsAction()
+            act.run(system.Local())
+
+            self.assertIsNone(act.get_path_object(path))
+            with open(path, "wb"):
+                pass
+            # Lookups are cached until explicitly invalidated
+            self.assertIsNone(act.get_path_object(path))
+            act.forget_path(path)
+            po = act.get_path_object(path)
+            self.assertIsNotNone(po)
+            self.assertIs(act.get_path_object(path), po)
+
+            os.symlink(path, link)
+            po = act.get_path_object(link, follow=False)
+            self.assertTrue(po.islink())
+            self.assertEqual(po.readlink(), path)
+            followed = act.get_path_object(link, follow=True)
+            self.assertFalse(followed.islink())
+            self.assertEqual(followed.path, path)
+
+            # Invalidating a path also invalidates symlinks resolved to it
+            act.forget_path(path)
+            self.assertIsNot(act.get_path_object(link, follow=True), followed)
+            self.assertIs(act.get_path_object(link, follow=False), po)
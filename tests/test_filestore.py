@@ -0,0 +1,46 @@
+from __future__ import annotations
+import tempfile
+import hashlib
+import unittest
+import io
+import os
+from transilience.system.filestore import FileStore
+
+
+class TestFileStore(unittest.TestCase):
+    def test_store(self):
+        with tempfile.TemporaryDirectory() as workdir:
+            store = FileStore(os.path.join(workdir, "store"), max_size=10)
+            checksum = hashlib.sha1(b"test").hexdigest()
+
+            with tempfile.TemporaryFile() as dst:
+                self.assertFalse(store.get(checksum, dst))
+            self.assertEqual((store.hits, store.misses), (0, 1))
+
+            # Wrong contents are not added
+            self.assertFalse(store.add(checksum, io.BytesIO(b"tset")))
+            self.assertTrue(store.add(checksum, io.BytesIO(b"test")))
+
+            with tempfile.TemporaryFile() as dst:
+                self.assertTrue(store.get(checksum, dst))
+                dst.seek(0)
+                self.assertEqual(dst.read(), b"test")
+            self.assertEqual((store.hits, store.misses), (1, 1))
+
+    def test_evict(self):
+        with tempfile.TemporaryDirectory() as workdir:
+            store = FileStore(os.path.join(workdir, "store"), max_size=100)
+            checksums = []
+            for i, payload in enumerate((b"test1", b"test2", b"test3")):
+                checksum = hashlib.sha1(payload).hexdigest()
+                checksums.append(checksum)
+                store.add(checksum, io.BytesIO(payload))
+                os.utime(os.path.join(store.path, checksum), ns=(i, i))
+
+            # Use the first entry, so that the second is the least recently used
+            with tempfile.TemporaryFile() as dst:
+                self.assertTrue(store.get(checksums[0], dst))
+
+            store.max_size = 10
+            store.evict()
+            self.assertEqual(sorted(os.listdir(store.path)), sorted([checksums[0], checksums[2]]))
@@ -0,0 +1,205 @@
+from __future__ import annotations
+import unittest
+from unittest import mock
+import uuid
+import sys
+from transilience.actions import ResultState
+from transilience.actions.misc import Noop, Fail
+from transilience.system import PipelineInfo
+
+
+class TestMitogenBatch(unittest.TestCase):
+    mitogen_args = {"batch_size": 4}
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        import mitogen
+        from transilience.system import Mitogen
+        cls.broker = mitogen.master.Broker()
+        cls.router = mitogen.master.Router(cls.broker)
+        cls.system = Mitogen("workdir", "local", router=cls.router, **cls.mitogen_args)
+
+    @classmethod
+    def tearDownClass(cls):
+        super().tearDownClass()
+        cls.system.close()
+        cls.broker.shutdown()
+
+    def test_batch(self):
+        acts = [Noop(changed=bool(i % 2)) for i in range(10)]
+        res = list(self.system.run_actions(acts))
+        self.assertEqual([a.uuid for a in res], [a.uuid for a in acts])
+        self.assertEqual(
+                [a.result.state for a in res],
+                [ResultState.CHANGED if i % 2 else ResultState.NOOP for i in range(10)])
+
+    def test_enqueue_while_receiving(self):
+        pipeline = PipelineInfo(str(uuid.uuid4()))
+        first = Noop()
+        self.system.send_pipelined(first, pipeline)
+        received = []
+        for act in self.system.receive_pipelined():
+            received.append(act.uuid)
+            if act.uuid == first.uuid:
+                for i in range(5):
+                    self.system.send_pipelined(Noop(), pipeline)
+        self.assertEqual(len(received), 6)
+        self.assertEqual(received[0], first.uuid)
+
+    def test_fail(self):
+        import mitogen.core
+        pipeline = PipelineInfo(str(uuid.uuid4()))
+        self.system.send_pipelined(Noop(), pipeline)
+        self.system.send_pipelined(Fail(msg="test"), pipeline)
+        self.system.send_pipelined(Noop(), pipeline)
+
+        received = self.system.receive_pipelined()
+        self.assertEqual(next(received).result.state, ResultState.NOOP)
+        with self.assertRaises(mitogen.core.CallError):
+            next(received)
+
+        # The pipeline is still consistent after the failure
+        res = list(self.system.receive_pipelined())
+        self.assertEqual(len(res), 1)
+        self.assertEqual(res[0].result.state, ResultState.SKIPPED)
+        self.system.pipeline_close(pipeline.id)
+
+    def test_decode_fail(self):
+        import mitogen.core
+        pipeline = PipelineInfo(str(uuid.uuid4()))
+        self.system.send_pipelined(Noop(), pipeline)
+        # Queue a payload that cannot be decoded on the remote system
+        self.system.batch.append({})
+        self.system.send_pipelined(Noop(changed=True), pipeline)
+
+        # Results of actions preceding the failure are received first
+        received = self.system.receive_pipelined()
+        self.assertEqual(next(received).result.state, ResultState.NOOP)
+        with self.assertRaises(mitogen.core.CallError):
+            next(received)
+        res = list(self.system.receive_pipelined())
+        self.assertEqual([a.result.state for a in res], [ResultState.CHANGED])
+        self.system.pipeline_close(pipeline.id)
+
+    def test_flush_before_receive(self):
+        pipeline = PipelineInfo(str(uuid.uuid4()))
+        act = Noop()
+        with mock.patch.object(self.system, "batch_latency", 3600):
+            self.system.send_pipelined(act, pipeline)
+        self.assertEqual(len(self.system.batch), 1)
+
+        # Waiting for results sends the queued batch
+        self.assertEqual(self.system.receive_next().uuid, act.uuid)
+        self.assertEqual(self.system.batch, [])
+        self.assertIsNone(self.system.receive_next())
+        self.system.pipeline_close(pipeline.id)
+
+    def test_execute_in_flight(self):
+        import mitogen.core
+        from transilience.actions.command import Command
+        argv = [sys.executable, "-c", "print('x' * 20000)"]
+        pipeline = PipelineInfo(str(uuid.uuid4()))
+        first = Command(argv=argv)
+        self.system.send_pipelined(first, pipeline)
+        self.system.send_pipelined(Fail(msg="test"), pipeline)
+        self.system.flush_batch()
+
+        # Results of actions still in flight are kept for receive_pipelined()
+        act = self.system.execute(Command(argv=argv))
+        self.assertEqual(act.stdout, b"x" * 20000 + b"\n")
+
+        received = self.system.receive_pipelined()
+        res = next(received)
+        self.assertEqual(res.uuid, first.uuid)
+        self.assertEqual(res.stdout, b"x" * 20000 + b"\n")
+        with self.assertRaises(mitogen.core.CallError):
+            next(received)
+        self.assertEqual(list(self.system.receive_pipelined()), [])
+        self.system.pipeline_close(pipeline.id)
+
+
+class TestMitogenDefault(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        import mitogen
+        from transilience.system import Mitogen
+        cls.broker = mitogen.master.Broker()
+        cls.router = mitogen.master.Router(cls.broker)
+        cls.system = Mitogen("workdir", "local", router=cls.router)
+
+    @classmethod
+    def tearDownClass(cls):
+        super().tearDownClass()
+        cls.system.close()
+        cls.broker.shutdown()
+
+    def test_content_ref(self):
+        from transilience.actions.command import Command
+        from transilience.system.wire import CONTENT_REF_MIN_SIZE
+        payload = b"x" * CONTENT_REF_MIN_SIZE
+        sent = []
+        encode_action = self.system.encode_action
+
+        def spy(*args, **kw):
+            res = encode_action(*args, **kw)
+            sent.append(res)
+            return res
+
+        with mock.patch.object(self.system, "encode_action", spy):
+            res = list(self.system.run_actions([Command(argv=["cat"], stdin=payload) for i in range(2)]))
+
+        # The payload is sent in full only the first time
+        self.assertEqual(sent[0]["__refs__"], (("stdin", sent[0]["__refs__"][0][1], payload),))
+        self.assertEqual(sent[1]["__refs__"], (("stdin", sent[0]["__refs__"][0][1], None),))
+        self.assertEqual([act.stdout for act in res], [payload, payload])
+        self.assertEqual([act.stdin for act in res], [payload, payload])
+
+
+class TestMitogenBatchCompact(TestMitogenBatch):
+    mitogen_args = {"batch_size": 4, "compact": True}
+
+    def test_execute(self):
+        from transilience.actions.command import Command
+        act = self.system.execute(Command(argv=["echo", "test"]))
+        self.assertEqual(act.result.state, ResultState.CHANGED)
+        self.assertEqual(act.stdout, b"test\n")
+
+
+class TestMitogenConcurrent(TestMitogenBatch):
+    mitogen_args = {"batch_size": 4, "concurrency": 4, "compact": True}
+
+    def test_concurrent(self):
+        from transilience.actions.command import Command
+        slow = PipelineInfo(str(uuid.uuid4()))
+        fast = PipelineInfo(str(uuid.uuid4()))
+        slow_act = Command(argv=["sleep", "0.5"])
+        fast_act = Noop()
+        self.system.send_pipelined(slow_act, slow)
+        self.system.send_pipelined(fast_act, fast)
+        received = [act.uuid for act in self.system.receive_pipelined()]
+        self.assertEqual(received, [fast_act.uuid, slow_act.uuid])
+        self.system.pipeline_close(slow.id)
+        self.system.pipeline_close(fast.id)
+
+    def test_decode_fail(self):
+        self.skipTest("results are sent in completion order with concurrency")
+
+    def test_batch_size_required(self):
+        from transilience.system import Mitogen
+        with self.assertRaises(ValueError):
+            Mitogen("workdir", "local", router=self.router, concurrency=4)
+
+    def test_dag(self):
+        from transilience.actions.command import Command
+        pipeline = PipelineInfo(str(uuid.uuid4()), after=[])
+        slow_act = Command(argv=["sleep", "0.5"])
+        fast_act = Noop()
+        last_act = Noop()
+        self.system.send_pipelined(slow_act, pipeline)
+        self.system.send_pipelined(fast_act, pipeline)
+        self.system.send_pipelined(last_act, PipelineInfo(pipeline.id, after=[slow_act.uuid, fast_act.uuid]))
+        received = [act.uuid for act in self.system.receive_pipelined()]
+        self.assertEqual(received, [fast_act.uuid, slow_act.uuid, last_act.uuid])
+        self.system.pipeline_close(pipeline.id)
@@ -66,3 +66,19 @@ class TestModeChange(unittest.TestCase):
         self.assertEqual(mc.affected, stat.S_ISVTX | stat.S_IRWXO)
         self.assertEqual(mc.value, 0)
         self.assertEqual(mc.mentioned, stat.S_ISVTX | stat.S_IRWXO)
+
+    def test_program(self):
+        prog = modechange.ModeProgram.compile("u=rwX,g=rX,o=")
+        self.assertIs(modechange.ModeProgram.compile("u=rwX,g=rX,o="), prog)
+        changes = modechange.ModeChange.compile("u=rwX,g=rX,o=")
+        for oldmode in (0o000, 0o644, 0o755, 0o4755, 0o100644):
+            for is_dir in (False, True):
+                for umask in (0o022, 0o077):
+                    self.assertEqual(
+                        prog.adjust(oldmode, is_dir, umask),
+                        modechange.ModeChange.adjust(oldmode, is_dir, umask, changes))
+        self.assertEqual(prog.adjust(0o100644, False, 0o022), prog.adjust(0o644, False, 0o022))
+        self.assertEqual(len(prog.results), 16)
+
+        with self.assertRaises(ValueError):
+            modechange.ModeProgram.compile("u=rwX,,")
@@ -1,10 +1,15 @@
 from __future__ import annotations
+from dataclasses import dataclass
+import collections
+import threading
 import unittest
 import uuid
 from transilience.actions import ResultState
 from transilience.actions.misc import Noop, Fail
+from transilience.actions.action import Action
 from transilience.unittest import LocalTestMixin
 from transilience.system import PipelineInfo
+from transilience.system.pipeline import PipelineExecutor
 
 
 class TestPipeline(LocalTestMixin, unittest.TestCase):
@@ -49,3 +54,117 @@ class TestPipeline(LocalTestMixin, unittest.TestCase):
 
         self.system.pipeline_close(self.pipeline_id)
         self.assertNoop(ResultState.SKIPPED, when={n2.uuid: [ResultState.CHANGED]}, changed=True)
+
+
+@dataclass
+class MergeableAction(Action):
+    fail: bool = False
+    # Number of actions passed to each run_merged call
+    merged = []
+
+    def merge_key(self):
+        return "test"
+
+    @classmethod
+    def run_merged(cls, system, actions):
+        cls.merged.append(len(actions))
+        if any(a.fail for a in actions):
+            raise RuntimeError("merged run failed")
+        super().run_merged(system, actions)
+
+    def run(self, system):
+        super().run(system)
+        if self.fail:
+            raise RuntimeError("failed")
+
+
+class TestPipelineMerge(LocalTestMixin, unittest.TestCase):
+    def test_merge(self):
+        MergeableAction.merged = []
+        p1 = PipelineInfo(str(uuid.uuid4()))
+        p2 = PipelineInfo(str(uuid.uuid4()))
+        a1 = MergeableAction()
+        a2 = MergeableAction()
+        queue = collections.deque([
+            (a1, p1), (a2, p2),
+            (MergeableAction(), PipelineInfo(p1.id, when={a1.uuid: [ResultState.NOOP]})),
+            (MergeableAction(), p2),
+            (Noop(), p1), (MergeableAction(), p1),
+        ])
+        res = list(self.system.execute_pipelined_queue(queue))
+        self.assertEqual(len(res), 6)
+        self.assertEqual([a.result.state for a in res], [ResultState.NOOP] * 6)
+        # Actions conditional on other actions in the group start a new group
+        self.assertEqual(MergeableAction.merged, [2, 2])
+
+    def test_merge_failed(self):
+        MergeableAction.merged = []
+        p1 = PipelineInfo(str(uuid.uuid4()))
+        p2 = PipelineInfo(str(uuid.uuid4()))
+        queue = collections.deque([
+            (MergeableAction(), p1), (MergeableAction(fail=True), p1), (MergeableAction(), p2)])
+        res = self.system.execute_pipelined_queue(queue)
+        # After the merged run fails, actions are run one at a time
+        self.assertEqual(next(res).result.state, ResultState.NOOP)
+        with self.assertRaises(RuntimeError):
+            next(res)
+        self.assertEqual(MergeableAction.merged, [3])
+        res = list(self.system.execute_pipelined_queue(queue))
+        self.assertEqual([a.result.state for a in res], [ResultState.NOOP])
+        self.assertEqual(MergeableAction.merged, [3])
+
+
+class TestPipelineExecutor(unittest.TestCase):
+    def setUp(self):
+        super().setUp()
+        self.executor = PipelineExecutor(max_workers=4)
+
+    def tearDown(self):
+        self.executor.shutdown()
+        super().tearDown()
+
+    def test_order(self):
+        res = {"a": [], "b": []}
+        for i in range(50):
+            for name in res:
+                self.executor.submit(name, lambda name=name, i=i: res[name].append(i))
+        self.executor.join()
+        self.assertEqual(res["a"], list(range(50)))
+        self.assertEqual(res["b"], list(range(50)))
+        self.assertEqual(self.executor.queues, {})
+
+    def test_concurrent(self):
+        # A blocked pipeline does not block the others
+        blocked = threading.Event()
+        done = []
+        self.executor.submit("a", blocked.wait)
+        self.executor.submit("a", lambda: done.append("a"))
+        self.executor.submit("b", lambda: done.append("b"))
+        self.executor.submit("b", blocked.set)
+        self.executor.join()
+        self.assertEqual(done, ["b", "a"])
+
+    def test_dependencies(self):
+        events = []
+        blocked = threading.Event()
+
+        def log(name):
+            return lambda: events.append(name)
+
+        self.executor.submit("a", blocked.wait, task_id="slow", after=[])
+        self.executor.submit("a", log("fast"), task_id="fast", after=[])
+        self.executor.submit("a", log("after_slow"), task_id="after_slow", after=["slow"])
+        self.executor.submit("a", log("after_fast"), task_id="after_fast", after=["fast", "unknown"])
+        self.executor.submit("a", blocked.set, task_id="unblock", after=["after_fast"])
+        # Without dependencies, wait for everything before
+        self.executor.submit("a", log("barrier"))
+        self.executor.submit("a", log("last"), task_id="last", after=[])
+        self.executor.join()
+        self.assertEqual(events, ["fast", "after_fast", "after_slow", "barrier", "last"])
+
+    def test_exception(self):
+        done = []
+        self.executor.submit("a", lambda: 1/0)
+        self.executor.submit("a", lambda: done.append("a"))
+        self.executor.join()
+        self.assertEqual(done, ["a"])
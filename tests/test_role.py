@@ -0,0 +1,68 @@
+from __future__ import annotations
+import unittest
+from transilience.actions import builtin
+from transilience import role
+
+
+class DagRole(role.Role):
+    dag = True
+
+
+class TestDag(unittest.TestCase):
+    def test_paths_overlap(self):
+        self.assertTrue(role.paths_overlap("/etc", "/etc"))
+        self.assertTrue(role.paths_overlap("/etc", "/etc/hosts"))
+        self.assertTrue(role.paths_overlap("/etc/hosts", "/etc/"))
+        self.assertTrue(role.paths_overlap("/", "/etc"))
+        self.assertFalse(role.paths_overlap("/etc", "/etcetera"))
+        self.assertFalse(role.paths_overlap("/etc/hosts", "/srv/hosts"))
+
+    def test_dependencies(self):
+        r = DagRole()
+
+        def deps(action, after=None, when=None):
+            return r.dag_dependencies(action, after, when if when is not None else {})
+
+        srv = builtin.file(state="directory", path="/srv/www")
+        self.assertEqual(deps(srv), [])
+        etc = builtin.file(state="directory", path="/etc/www")
+        self.assertEqual(deps(etc), [])
+
+        # Actions on nested paths depend on each other
+        index = builtin.copy(dest="/srv/www/index.html", content="test")
+        self.assertEqual(deps(index), [srv.uuid])
+        conf = builtin.copy(dest="/etc/www/../www/site.conf", content="test")
+        self.assertEqual(deps(conf), [etc.uuid])
+
+        # Explicit dependencies
+        noop1 = builtin.noop()
+        self.assertEqual(deps(noop1, after=[srv]), [srv.uuid])
+        noop2 = builtin.noop()
+        self.assertEqual(deps(noop2, when={conf.uuid: ["changed"]}), [conf.uuid])
+
+        # Actions with unknown paths wait for everything before them
+        cmd = builtin.command(argv=["true"])
+        self.assertEqual(deps(cmd), sorted([srv.uuid, etc.uuid, index.uuid, conf.uuid, noop1.uuid, noop2.uuid]))
+
+        # And everything after them waits for them
+        other = builtin.file(state="directory", path="/srv/www")
+        self.assertEqual(deps(other), [cmd.uuid])
+
+    def test_hard_link_dependencies(self):
+        r = DagRole()
+
+        def deps(action):
+            return r.dag_dependencies(action, None, {})
+
+        target = builtin.copy(dest="/srv/data/target", content="test")
+        self.assertEqual(deps(target), [])
+        other = builtin.file(state="directory", path="/srv/links")
+        self.assertEqual(deps(other), [])
+
+        # Hard links depend on their target, which is used as given
+        link = builtin.file(state="hard", path="/srv/links/link", src="/srv/data/target")
+        self.assertEqual(deps(link), sorted([target.uuid, other.uuid]))
+
+        # A relative target cannot be located, so the link waits for everything
+        rel = builtin.file(state="hard", path="/srv/links/rel", src="target")
+        self.assertEqual(deps(rel), sorted([target.uuid, other.uuid, link.uuid]))
@@ -2,8 +2,10 @@ from __future__ import annotations
 import tempfile
 import unittest
 import os
-from transilience.runner import Script
+from transilience.runner import Script, FleetRunner
 from transilience.unittest import LocalTestMixin, LocalMitogenTestMixin
+from transilience.actions import builtin, ResultState
+from transilience import role
 
 
 class ScriptTests:
@@ -36,3 +38,43 @@ class TestScriptLocal(ScriptTests, LocalTestMixin, unittest.TestCase):
 
 class TestScriptMitogen(ScriptTests, LocalMitogenTestMixin, unittest.TestCase):
     pass
+
+
+class FleetTestRole(role.Role):
+    def __init__(self, path: str):
+        super().__init__()
+        self.path = path
+
+    def start(self):
+        self.task(builtin.file(state="directory", path=self.path))
+        self.task(builtin.copy(dest=os.path.join(self.path, "testfile"), content="test"))
+
+
+class TestFleetRunner(unittest.TestCase):
+    def test_run(self):
+        with tempfile.TemporaryDirectory() as workdir:
+            def setup(runner):
+                runner.add_role(FleetTestRole, path=os.path.join(workdir, runner.name))
+
+            fleet = FleetRunner({name: {"method": "local"} for name in ("host1", "host2", "host3")}, max_workers=2)
+            results = fleet.run(setup)
+
+            self.assertEqual(sorted(results.keys()), ["host1", "host2", "host3"])
+            for name, res in results.items():
+                self.assertFalse(res.failed)
+                self.assertEqual(res.stats, {ResultState.CHANGED: 2})
+                with open(os.path.join(workdir, name, "testfile"), "rt") as fd:
+                    self.assertEqual(fd.read(), "test")
+
+    def test_failure(self):
+        with tempfile.TemporaryDirectory() as workdir:
+            def setup(runner):
+                if runner.name == "host2":
+                    raise RuntimeError("test failure")
+                runner.add_role(FleetTestRole, path=os.path.join(workdir, runner.name))
+
+            fleet = FleetRunner({name: {"method": "local"} for name in ("host1", "host2")})
+            results = fleet.run(setup)
+            self.assertFalse(results["host1"].failed)
+            self.assertTrue(results["host2"].failed)
+            self.assertTrue(os.path.exists(os.path.join(workdir, "host1", "testfile")))
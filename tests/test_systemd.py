@@ -1,9 +1,15 @@
 from __future__ import annotations
+from typing import Dict, List
 import unittest
 import inspect
+from unittest import mock
+import subprocess
+import shutil
 import uuid
 from transilience.unittest import ActionTestMixin, ChrootTestMixin
-from transilience.actions import builtin
+from transilience.actions import builtin, ResultState
+from transilience.system import Local, PipelineInfo
+from transilience.actions.systemd import SystemdUnitCache, units_for_path
 
 
 class TestSystemd(ActionTestMixin, ChrootTestMixin, unittest.TestCase):
@@ -63,3 +69,316 @@ class TestSystemd(ActionTestMixin, ChrootTestMixin, unittest.TestCase):
         self.assertSystemd(unit=self.unit_name, state="restarted", changed=True)
         self.assertSystemd(unit=self.unit_name, state="reloaded", changed=True)
         self.assertSystemd(unit=self.unit_name, state="reloaded", changed=True)
+
+
+class MockSystemctl:
+    def __init__(self, units):
+        self.units = units
+        self.calls = []
+
+    def __call__(self, *args, **kw):
+        self.calls.append(args[-1])
+        if args[-1] == "*":
+            units = [u for u in self.units if u["LoadState"] == "loaded"]
+        else:
+            name = args[-1] if "." in args[-1] else args[-1] + ".service"
+            units = [u for u in self.units if name in u["Names"].split()]
+        stdout = "\n".join("".join(f"{k}={v}\n" for k, v in u.items()) for u in units)
+        return subprocess.CompletedProcess(args, 0, stdout=stdout, stderr="")
+
+
+class TestSystemdUnitCache(unittest.TestCase):
+    def test_cache(self):
+        systemctl = MockSystemctl([
+            {"Id": "ssh.service", "Names": "ssh.service sshd.service", "LoadState": "loaded",
+             "ActiveState": "active", "UnitFileState": "enabled"},
+            {"Id": "cron.service", "Names": "cron.service", "LoadState": "loaded",
+             "ActiveState": "inactive", "UnitFileState": "disabled"},
+            {"Id": "foo.timer", "Names": "foo.timer", "LoadState": "not-found",
+             "ActiveState": "inactive", "UnitFileState": ""},
+        ])
+        cache = SystemdUnitCache()
+
+        self.assertEqual(cache.get("system", "ssh", systemctl)["ActiveState"], "active")
+        self.assertEqual(cache.get("system", "sshd.service", systemctl)["Id"], "ssh.service")
+        self.assertEqual(cache.get("system", "cron.service", systemctl)["UnitFileState"], "disabled")
+        self.assertEqual(systemctl.calls, ["*"])
+
+        # Units not loaded are looked up individually
+        self.assertEqual(cache.get("system", "foo.timer", systemctl)["LoadState"], "not-found")
+        self.assertEqual(cache.get("system", "foo.timer", systemctl)["LoadState"], "not-found")
+        self.assertEqual(systemctl.calls, ["*", "foo.timer"])
+
+        # Forgetting a scope runs the bulk query again
+        cache.forget_scope("system")
+        self.assertEqual(cache.get("system", "cron", systemctl)["Id"], "cron.service")
+        self.assertEqual(cache.get("system", "ssh", systemctl)["Id"], "ssh.service")
+        self.assertEqual(systemctl.calls, ["*", "foo.timer", "*"])
+
+        # Scopes are cached separately
+        cache.get("user", "cron", systemctl)
+        self.assertEqual(systemctl.calls, ["*", "foo.timer", "*", "*"])
+
+        cache.clear()
+        cache.get("system", "cron", systemctl)
+        self.assertEqual(systemctl.calls, ["*", "foo.timer", "*", "*", "*"])
+        self.assertEqual(cache.bulk_queries, 4)
+        self.assertEqual(cache.unit_queries, 1)
+
+    def test_forget_unit(self):
+        systemctl = MockSystemctl([
+            {"Id": "app.service", "Names": "app.service", "LoadState": "loaded",
+             "ActiveState": "inactive", "Requires": "db.service"},
+            {"Id": "db.service", "Names": "db.service", "LoadState": "loaded",
+             "ActiveState": "inactive", "RequiredBy": "app.service"},
+            {"Id": "cron.service", "Names": "cron.service", "LoadState": "loaded",
+             "ActiveState": "inactive"},
+        ])
+        cache = SystemdUnitCache()
+        cache.get("system", "app", systemctl)
+
+        # Changing a unit forgets it and the units it affects, but not others
+        cache.forget_unit("system", "app.service")
+        for name in ("app", "db", "cron"):
+            cache.get("system", name, systemctl)
+        self.assertEqual(systemctl.calls, ["*", "app", "db"])
+
+        # Stopping db stops app, which requires it
+        cache.forget_unit("system", "db")
+        cache.get("system", "app", systemctl)
+        self.assertEqual(systemctl.calls, ["*", "app", "db", "app"])
+
+    def test_action_started(self):
+        systemctl = MockSystemctl([
+            {"Id": "app.service", "Names": "app.service", "LoadState": "loaded", "ActiveState": "inactive"},
+            {"Id": "app@a.service", "Names": "app@a.service", "LoadState": "loaded", "ActiveState": "inactive"},
+            {"Id": "cron.service", "Names": "cron.service", "LoadState": "loaded", "ActiveState": "inactive"},
+        ])
+        cache = SystemdUnitCache()
+        cache.get("system", "cron", systemctl)
+
+        # Actions not touching unit files keep the cache
+        cache.action_started(builtin.copy(dest="/etc/hosts", content="test"))
+        cache.action_started(builtin.systemd(unit="cron", state="started"))
+        cache.get("system", "cron", systemctl)
+        self.assertEqual(systemctl.calls, ["*"])
+
+        # Changing a unit file, its drop-ins, or a template forgets its units
+        cache.action_started(builtin.copy(dest="/etc/systemd/system/app.service.d/override.conf", content="test"))
+        cache.action_started(builtin.copy(dest="/usr/lib/systemd/system/app@.service", content="test"))
+        for name in ("app", "app@a", "cron"):
+            cache.get("system", name, systemctl)
+        self.assertEqual(systemctl.calls, ["*", "app", "app@a"])
+
+        # Actions that can change anything forget everything
+        cache.action_started(builtin.command(argv=["true"]))
+        cache.get("system", "cron", systemctl)
+        self.assertEqual(systemctl.calls, ["*", "app", "app@a", "*"])
+
+    def test_units_for_path(self):
+        self.assertEqual(units_for_path("/etc/hosts"), set())
+        self.assertEqual(units_for_path("/etc/systemd/system/foo.service"), {"foo.service"})
+        self.assertEqual(
+                units_for_path("/etc/systemd/system/multi-user.target.wants/foo.service"),
+                {"multi-user.target", "foo.service"})
+        self.assertEqual(units_for_path("/home/user/.config/systemd/user/foo.timer"), {"foo.timer"})
+        self.assertIsNone(units_for_path("/etc"))
+        self.assertIsNone(units_for_path("/etc/systemd/../systemd"))
+        self.assertIsNone(units_for_path("relative/foo.service"))
+
+
+class MockSystemd:
+    """
+    Mock subprocess.run for systemctl and for commands changing units.
+
+    Starting a unit also starts the units it requires
+    """
+    def __init__(self, units: Dict[str, str], requires: Dict[str, List[str]]):
+        # ActiveState indexed by unit name
+        self.units = units
+        self.requires = requires
+        self.calls: List[str] = []
+
+    def show(self, names):
+        return "\n".join(
+                f"Id={name}\nNames={name}\nLoadState=loaded\nActiveState={self.units[name]}\nUnitFileState=enabled\n"
+                f"Requires={' '.join(self.requires.get(name, []))}\n"
+                for name in names)
+
+    def __call__(self, cmd, **kw):
+        if cmd[0] == "/bin/systemctl":
+            args = cmd[1:]
+            self.calls.append(" ".join(args))
+            stdout = ""
+            if args[0] == "show":
+                stdout = self.show(self.units if args[-1] == "*" else [args[-1]])
+            elif args[0] == "start":
+                for name in [args[1]] + self.requires.get(args[1], []):
+                    self.units[name] = "active"
+            elif args[0] == "stop":
+                self.units[args[1]] = "inactive"
+        else:
+            # Commands stop the unit given as argument
+            self.units[cmd[1]] = "inactive"
+            stdout = ""
+        return subprocess.CompletedProcess(cmd, 0, stdout=stdout, stderr="")
+
+    def run(self, actions):
+        with mock.patch("shutil.which", return_value="/bin/systemctl"):
+            with mock.patch("subprocess.run", self):
+                return [a.result.state for a in Local().run_actions(actions)]
+
+
+class TestUnitChanges(unittest.TestCase):
+    def test_dependent_unit(self):
+        systemd = MockSystemd({"app.service": "inactive", "db.service": "inactive"},
+                              {"app.service": ["db.service"]})
+        res = systemd.run([
+            builtin.systemd(unit="db.service", state="stopped"),
+            builtin.systemd(unit="app.service", state="started"),
+            # Starting app also started db
+            builtin.systemd(unit="db.service", state="stopped"),
+        ])
+        self.assertEqual(res, [ResultState.NOOP, ResultState.CHANGED, ResultState.CHANGED])
+        self.assertIn("stop db.service", systemd.calls)
+
+    def test_other_actions(self):
+        systemd = MockSystemd({"app.service": "active"}, {})
+        res = systemd.run([
+            builtin.systemd(unit="app.service", state="started"),
+            builtin.command(argv=["/bin/stop", "app.service"]),
+            builtin.systemd(unit="app.service", state="started"),
+        ])
+        self.assertEqual(res, [ResultState.NOOP, ResultState.CHANGED, ResultState.CHANGED])
+        self.assertEqual(systemd.calls[-1], "start app.service")
+
+
+class TestDeferredReload(unittest.TestCase):
+    def run_systemd(self, actions, system=None, fail=False):
+        calls = []
+
+        def run(cmd, **kw):
+            calls.append(" ".join(cmd[1:]))
+            if fail and cmd[-1] == "daemon-reload":
+                raise subprocess.CalledProcessError(1, cmd, "", "test failure")
+            return subprocess.CompletedProcess(cmd, 0, stdout="", stderr="")
+
+        if system is None:
+            system = Local()
+        with mock.patch("shutil.which", return_value="/bin/systemctl"):
+            with mock.patch("subprocess.run", run):
+                res = list(system.run_actions(actions))
+        return res, calls
+
+    def test_coalesce(self):
+        res, calls = self.run_systemd([
+            builtin.systemd(daemon_reload=True, defer_daemon_reload=True),
+            builtin.systemd(daemon_reload=True, defer_daemon_reload=True),
+            builtin.systemd(unit="foo.service", state="started"),
+        ])
+        self.assertEqual(calls[0], "daemon-reload")
+        self.assertEqual(calls.count("daemon-reload"), 1)
+        self.assertTrue(calls[1].startswith("show "))
+        self.assertEqual([a.result.state for a in res], [ResultState.NOOP] * 3)
+
+    def test_pipeline_close(self):
+        res, calls = self.run_systemd([
+            builtin.systemd(daemon_reload=True, defer_daemon_reload=True),
+            builtin.systemd(daemon_reload=True, defer_daemon_reload=True),
+        ])
+        self.assertEqual(calls, ["daemon-reload"])
+
+    def test_failure(self):
+        system = Local()
+        with self.assertRaises(RuntimeError):
+            self.run_systemd([builtin.systemd(daemon_reload=True, defer_daemon_reload=True)], system=system, fail=True)
+        self.assertEqual(system.deferred, {})
+        self.assertEqual(system.deferred_failures, [])
+
+    def test_failure_runner(self):
+        from transilience.runner import Runner
+        from transilience.role import Role
+
+        class Reload(Role):
+            def start(self):
+                self.task(builtin.systemd(daemon_reload=True, defer_daemon_reload=True))
+
+        class Other(Role):
+            def start(self):
+                self.task(builtin.noop())
+                self.task(builtin.noop())
+
+        def run(cmd, **kw):
+            if cmd[-1] == "daemon-reload":
+                raise subprocess.CalledProcessError(1, cmd, "", "test failure")
+            return subprocess.CompletedProcess(cmd, 0, stdout="", stderr="")
+
+        runner = Runner(Local())
+        with mock.patch("shutil.which", return_value="/bin/systemctl"):
+            with mock.patch("subprocess.run", run):
+                runner.add_role(Reload)
+                runner.add_role(Other)
+                # The failure is reported after all roles are done
+                with self.assertLogs("runner", level="ERROR") as logs:
+                    with self.assertRaises(RuntimeError):
+                        runner.main()
+        self.assertEqual(runner.pending, {})
+        self.assertEqual(sum(runner.stats.values()), 3)
+        self.assertIn("Reload deferred work", logs.output[0])
+
+    def test_pipeline_scope(self):
+        system = Local()
+        first = PipelineInfo(str(uuid.uuid4()))
+        second = PipelineInfo(str(uuid.uuid4()))
+        third = PipelineInfo(str(uuid.uuid4()))
+        calls = []
+
+        def run(cmd, **kw):
+            calls.append(" ".join(cmd[1:]))
+            return subprocess.CompletedProcess(cmd, 0, stdout="", stderr="")
+
+        with mock.patch("shutil.which", return_value="/bin/systemctl"):
+            with mock.patch("subprocess.run", run):
+                system.send_pipelined(builtin.systemd(daemon_reload=True, defer_daemon_reload=True), first)
+                system.send_pipelined(builtin.noop(), second)
+                system.send_pipelined(builtin.systemd(daemon_reload=True, defer_daemon_reload=True), third)
+                list(system.receive_pipelined())
+
+                # Closing a pipeline does not run work deferred by others
+                system.pipeline_close(second.id)
+                self.assertEqual(calls, [])
+
+                # Running deferred work satisfies all pipelines that deferred
+                # it
+                system.pipeline_close(first.id)
+                self.assertEqual(calls, ["daemon-reload"])
+                system.pipeline_close(third.id)
+                self.assertEqual(calls, ["daemon-reload"])
+
+    def test_failure_mitogen(self):
+        import mitogen
+        import mitogen.core
+        from transilience.system import Mitogen
+        if shutil.which("systemctl") is None:
+            raise unittest.SkipTest("systemctl not found")
+
+        broker = mitogen.master.Broker()
+        try:
+            router = mitogen.master.Router(broker)
+            system = Mitogen("workdir", "local", router=router, batch_size=4)
+            try:
+                # systemctl rejects the unknown scope option
+                act = builtin.systemd(scope="invalid-scope", daemon_reload=True, defer_daemon_reload=True)
+                with self.assertRaises(RuntimeError):
+                    list(system.run_actions([act]))
+            finally:
+                system.close()
+        finally:
+            broker.shutdown()
+
+    def test_immediate(self):
+        res, calls = self.run_systemd([
+            builtin.systemd(daemon_reload=True, defer_daemon_reload=True),
+            builtin.systemd(daemon_reload=True),
+        ])
+        self.assertEqual(calls, ["daemon-reload"])
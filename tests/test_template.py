@@ -0,0 +1,134 @@
+from __future__ import annotations
+import tempfile
+import unittest
+from unittest import mock
+import stat
+import os
+from transilience import template
+from transilience.runner import Runner
+from transilience.system import Local
+from transilience.unittest import ActionTestMixin, LocalTestMixin, LocalMitogenTestMixin
+from transilience.actions import builtin
+from transilience.actions.template import Template, TemplateCache
+
+
+class TestEngine(unittest.TestCase):
+    def test_render_string(self):
+        engine = template.Engine(cache_size=2)
+        self.assertEqual(engine.render_string("{{a}}", {"a": 1}), "1")
+        self.assertEqual(engine.render_string("{{a}}", {"a": None}), "")
+        self.assertEqual(engine.stats()["hits"], 1)
+        self.assertEqual(engine.stats()["misses"], 1)
+
+        # Least recently used templates are dropped
+        engine.render_string("{{b}}", {"b": 2})
+        engine.render_string("{{a}}", {"a": 3})
+        engine.render_string("{{c}}", {"c": 4})
+        self.assertEqual(len(engine.string_cache), 2)
+        self.assertEqual(engine.render_string("{{a}}", {"a": 5}), "5")
+        self.assertEqual(engine.hits, 3)
+        self.assertEqual(engine.render_string("{{b}}", {"b": 6}), "6")
+        self.assertEqual(engine.misses, 4)
+
+    def test_bytecode_cache(self):
+        with tempfile.TemporaryDirectory() as workdir:
+            tpldir = os.path.join(workdir, "templates")
+            cachedir = os.path.join(workdir, "cache")
+            os.mkdir(tpldir)
+            with open(os.path.join(tpldir, "test.j2"), "wt") as fd:
+                fd.write("{% for i in range(n) %}{{i}}{% endfor %}\n")
+
+            engine = template.Engine([tpldir], bytecode_cache_dir=cachedir)
+            self.assertEqual(engine.render_file("test.j2", {"n": 3}), "012")
+            self.assertTrue(os.listdir(cachedir))
+
+            self.assertEqual(engine.stats()["bytecode_hits"], 0)
+            self.assertEqual(engine.stats()["bytecode_misses"], 1)
+
+            # A new engine finds the compiled template in the cache
+            engine = template.Engine([tpldir], bytecode_cache_dir=cachedir)
+            self.assertEqual(engine.render_file("test.j2", {"n": 4}), "0123")
+            self.assertEqual(engine.stats()["bytecode_hits"], 1)
+            self.assertEqual(engine.stats()["bytecode_misses"], 0)
+
+            # The default directory applies to engines not given one
+            with mock.patch("transilience.template.default_bytecode_cache_dir", cachedir):
+                engine = template.Engine([tpldir])
+            self.assertEqual(engine.render_file("test.j2", {"n": 2}), "01")
+            self.assertEqual(engine.stats()["bytecode_hits"], 1)
+
+    def test_runner_engine(self):
+        # Each runner has its own engine, unless one is given
+        self.assertIsNot(Runner(Local()).template_engine, Runner(Local()).template_engine)
+        engine = template.Engine()
+        self.assertIs(Runner(Local(), template_engine=engine).template_engine, engine)
+
+
+class TemplateTests(ActionTestMixin):
+    def test_render(self):
+        with tempfile.TemporaryDirectory() as workdir:
+            srcfile = os.path.join(workdir, "test.j2")
+            with open(srcfile, "wt") as fd:
+                fd.write("♥ {{name}}{% if port %} port {{port}}{% endif %}\n")
+            self.system.share_file_prefix(workdir)
+
+            dest1 = os.path.join(workdir, "dest1")
+            dest2 = os.path.join(workdir, "dest2")
+            self.run_action(builtin.template(src=srcfile, dest=dest1, mode=0o640, context={"name": "a", "port": 22}))
+            self.run_action(builtin.template(src=srcfile, dest=dest2, context={"name": "b", "port": None}))
+            self.run_action(builtin.template(src=srcfile, dest=dest1, mode=0o640, context={"name": "a", "port": 22}),
+                            changed=False)
+
+            with open(dest1, "rt") as fd:
+                self.assertEqual(fd.read(), "♥ a port 22")
+            self.assertEqual(stat.S_IMODE(os.stat(dest1).st_mode), 0o640)
+            with open(dest2, "rt") as fd:
+                self.assertEqual(fd.read(), "♥ b")
+
+
+class TestTemplateLocal(TemplateTests, LocalTestMixin, unittest.TestCase):
+    def test_fetch_once(self):
+        with tempfile.TemporaryDirectory() as workdir:
+            srcfile = os.path.join(workdir, "test.j2")
+            with open(srcfile, "wt") as fd:
+                fd.write("{{value}}")
+            actions = [builtin.template(src=srcfile, dest=os.path.join(workdir, f"dest{i}"), context={"value": i})
+                       for i in range(3)]
+            list(self.system.run_actions(actions))
+            cache = self.system.get_action_cache(Template, TemplateCache)
+            self.assertEqual(cache.fetches, 1)
+            self.assertEqual(cache.engine.misses, 1)
+            for i in range(3):
+                with open(os.path.join(workdir, f"dest{i}"), "rt") as fd:
+                    self.assertEqual(fd.read(), str(i))
+
+
+    def test_changed_source(self):
+        with tempfile.TemporaryDirectory() as workdir:
+            srcfile = os.path.join(workdir, "test.j2")
+            with open(srcfile, "wt") as fd:
+                fd.write("{{value}}")
+            act = builtin.template(src=srcfile, dest=os.path.join(workdir, "dest"), context={"value": 1})
+
+            # The source changes after its checksum has been computed
+            with open(srcfile, "wt") as fd:
+                fd.write("changed {{value}}")
+            with self.assertRaises(RuntimeError):
+                list(self.system.run_actions([act]))
+            cache = self.system.get_action_cache(Template, TemplateCache)
+            self.assertEqual(cache.sources, {})
+            self.assertEqual(cache.fetching, {})
+            self.assertFalse(os.path.exists(os.path.join(workdir, "dest")))
+
+    def test_failed_transfer(self):
+        cache = TemplateCache()
+        with mock.patch.object(self.system, "transfer_file", side_effect=OSError("test")):
+            with self.assertRaises(OSError):
+                cache.get_source(self.system, "test.j2", "0" * 40)
+        self.assertEqual(cache.sources, {})
+        self.assertEqual(cache.fetching, {})
+        self.assertEqual(cache.fetches, 0)
+
+
+class TestTemplateMitogen(TemplateTests, LocalMitogenTestMixin, unittest.TestCase):
+    pass
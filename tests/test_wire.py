@@ -0,0 +1,147 @@
+from __future__ import annotations
+import unittest
+from transilience.actions import Action, ResultState
+from transilience.actions.misc import Noop
+from transilience.actions.command import Command
+from transilience.actions.copy import Copy
+from transilience.system import PipelineInfo
+from transilience.system.wire import CompactCodec, CONTENT_REF_MIN_SIZE
+
+
+class TestCompactCodec(unittest.TestCase):
+    def test_roundtrip(self):
+        local = CompactCodec()
+        remote = CompactCodec()
+
+        act = Command(argv=["echo", "test"], stdin="input")
+        encoded = local.encode(act)
+        self.assertIsNotNone(encoded[1])
+        decoded = remote.decode(encoded)
+        self.assertIsInstance(decoded, Command)
+        self.assertEqual(decoded.uuid, act.uuid)
+        self.assertEqual(decoded.argv, ["echo", "test"])
+        self.assertEqual(decoded.stdin, "input")
+
+        # Results are sent back using the same action type ids
+        decoded.result.state = ResultState.CHANGED
+        decoded.stdout = b"test\n"
+        encoded = remote.encode(decoded)
+        self.assertIsNone(encoded[1])
+        res = local.decode(encoded)
+        self.assertEqual(res.uuid, act.uuid)
+        self.assertEqual(res.result.state, ResultState.CHANGED)
+        self.assertEqual(res.stdout, b"test\n")
+
+        # Action types are defined only once per connection
+        encoded = local.encode(Command(argv=["true"]))
+        self.assertIsNone(encoded[1])
+        self.assertEqual(remote.decode(encoded).argv, ["true"])
+
+        encoded = local.encode(Noop(changed=True))
+        self.assertIsNotNone(encoded[1])
+        self.assertNotEqual(encoded[0], local.type_ids[Command])
+        self.assertTrue(remote.decode(encoded).changed)
+
+    def test_content_ref(self):
+        local = CompactCodec()
+        remote = CompactCodec()
+
+        content = "x" * CONTENT_REF_MIN_SIZE
+        encoded = local.encode(Copy(dest="/tmp/test1", content=content))
+        self.assertIsNotNone(encoded[6])
+        self.assertEqual(encoded[6][0][2], content)
+        self.assertNotIn(content, encoded[5])
+        self.assertEqual(remote.decode(encoded).content, content)
+
+        # Repeated contents are sent only by reference
+        encoded = local.encode(Copy(dest="/tmp/test2", content=content))
+        self.assertIsNone(encoded[6][0][2])
+        decoded = remote.decode(encoded)
+        self.assertEqual(decoded.dest, "/tmp/test2")
+        self.assertEqual(decoded.content, content)
+
+        # Each direction keeps its own contents: results echoing the content
+        # back send it once
+        encoded = remote.encode(decoded)
+        self.assertEqual(encoded[6][0][2], content)
+        self.assertEqual(local.decode(encoded).content, content)
+        encoded = remote.encode(decoded)
+        self.assertIsNone(encoded[6][0][2])
+        self.assertEqual(local.decode(encoded).content, content)
+
+        # The same data as bytes is a different value
+        encoded = local.encode(Command(argv=["cat"], stdin=content.encode()))
+        self.assertEqual(encoded[6][0][2], content.encode())
+        self.assertEqual(remote.decode(encoded).stdin, content.encode())
+
+        # Small values are sent inline
+        encoded = local.encode(Copy(dest="/tmp/test3", content="test"))
+        self.assertIsNone(encoded[6])
+        self.assertEqual(remote.decode(encoded).content, "test")
+
+        # References to contents never sent are rejected
+        other = CompactCodec()
+        other.types = dict(remote.types)
+        with self.assertRaises(ValueError):
+            other.decode(local.encode(Copy(dest="/tmp/test4", content=content)))
+
+    def test_content_ref_eviction(self):
+        size = CONTENT_REF_MIN_SIZE
+        local = CompactCodec(content_ref_cache_size=size * 2)
+        remote = CompactCodec(content_ref_cache_size=size * 2)
+
+        def send(content):
+            encoded = local.encode(Copy(dest="/tmp/test", content=content))
+            self.assertEqual(remote.decode(encoded).content, content)
+            return encoded[6][0][2] is not None
+
+        a, b, c = ("a" * size), ("b" * size), ("c" * size)
+        self.assertTrue(send(a))
+        self.assertTrue(send(b))
+        # Using a makes b the least recently used
+        self.assertFalse(send(a))
+        self.assertTrue(send(c))
+        self.assertEqual(list(local.sent.entries), list(remote.received.entries))
+        self.assertEqual(remote.received.size, size * 2)
+        self.assertFalse(send(a))
+        self.assertFalse(send(c))
+        # b was evicted on both sides, and is sent again
+        self.assertTrue(send(b))
+
+        # Contents larger than the store are sent inline
+        encoded = local.encode(Copy(dest="/tmp/test", content="d" * (size * 3)))
+        self.assertIsNone(encoded[6])
+
+    def test_content_ref_serialized(self):
+        local = CompactCodec()
+        remote = CompactCodec()
+        content = "x" * CONTENT_REF_MIN_SIZE
+
+        act = Copy(dest="/tmp/test1", content=content)
+        encoded = local.encode_serialized(act.serialize())
+        self.assertIsNone(encoded["content"])
+        self.assertEqual(encoded["__refs__"][0][2], content)
+        self.assertEqual(Action.deserialize(remote.decode_serialized(encoded)).content, content)
+
+        # Both serializations share the same stores
+        encoded = local.encode(Copy(dest="/tmp/test2", content=content))
+        self.assertIsNone(encoded[6][0][2])
+        self.assertEqual(remote.decode(encoded).content, content)
+
+        # Small values are left alone
+        encoded = local.encode_serialized(Copy(dest="/tmp/test3", content="test").serialize())
+        self.assertNotIn("__refs__", encoded)
+        self.assertEqual(Action.deserialize(remote.decode_serialized(encoded)).content, "test")
+
+    def test_undefined(self):
+        local = CompactCodec()
+        remote = CompactCodec()
+        local.encode(Noop())
+        with self.assertRaises(ValueError):
+            remote.decode(local.encode(Noop()))
+
+    def test_pipeline_info(self):
+        codec = CompactCodec()
+        self.assertIsNone(codec.decode_pipeline_info(codec.encode_pipeline_info(None)))
+        info = PipelineInfo("test", when={"uuid": [ResultState.CHANGED]})
+        self.assertEqual(codec.decode_pipeline_info(codec.encode_pipeline_info(info)), info)
@@ -1,9 +1,11 @@
 from __future__ import annotations
-from typing import TYPE_CHECKING, List, Dict, Any, Optional
+from typing import TYPE_CHECKING, List, Dict, Any, Optional, Type, Hashable
 from dataclasses import dataclass, asdict, field
+import collections
 import contextlib
 import subprocess
 import importlib
+import threading
 import logging
 import shutil
 import shlex
@@ -82,6 +84,35 @@ class Action:
         """
         return []
 
+    def list_remote_paths(self) -> Optional[List[str]]:
+        """
+        Return a list of the paths on the remote system that this action
+        reads or changes, or None if it can potentially affect anything.
+
+        Paths are given as they are set in the action, without following
+        symlinks
+        """
+        return None
+
+    def merge_key(self) -> Optional[Hashable]:
+        """
+        Return a key identifying the actions of the same class that can be
+        executed together with run_merged(), or None if this action needs to be
+        executed on its own
+        """
+        return None
+
+    @classmethod
+    def run_merged(cls, system: transilience.system.System, actions: List["Action"]):
+        """
+        Perform a sequence of actions of this class with the same merge_key(),
+        setting the result state of each of them.
+
+        The default implementation runs them one after the other
+        """
+        for action in actions:
+            action.run(system)
+
     def set_changed(self):
         """
         Mark that this action has changed something
@@ -149,15 +180,70 @@ class Action:
         action_name = serialized.pop("__action__", None)
         if action_name is None:
             raise ValueError(f"action {serialized!r} has no '__action__' element")
-        mod_name, _, cls_name = action_name.rpartition(".")
+        action_cls = resolver.resolve(action_name)
+        serialized["result"] = Result(**serialized["result"])
+        return action_cls(**serialized)
+
+
+class ActionResolver:
+    """
+    Look up action classes by their dotted names, as used in serialized
+    actions.
+
+    Classes registered in a Namespace are always known. Other classes are
+    imported on first use, and kept in a cache of up to ``maxsize`` entries
+    """
+    def __init__(self, maxsize: int = 256):
+        self.maxsize = maxsize
+        # Action classes registered in namespaces, indexed by dotted name
+        self.registry: Dict[str, Type[Action]] = {}
+        # Action classes imported on demand, in least recently used order
+        self.imported: collections.OrderedDict[str, Type[Action]] = collections.OrderedDict()
+        self.lock = threading.Lock()
+        # Number of lookups answered without importing
+        self.hits = 0
+        # Number of lookups that needed an import
+        self.misses = 0
+
+    def register(self, action_cls: Type[Action]):
+        """
+        Make an action class always resolvable without an import
+        """
+        with self.lock:
+            self.registry[f"{action_cls.__module__}.{action_cls.__qualname__}"] = action_cls
+
+    def resolve(self, name: str) -> Type[Action]:
+        """
+        Return the action class with the given dotted name
+        """
+        with self.lock:
+            action_cls = self.registry.get(name)
+            if action_cls is None:
+                action_cls = self.imported.get(name)
+                if action_cls is not None:
+                    self.imported.move_to_end(name)
+            if action_cls is not None:
+                self.hits += 1
+                return action_cls
+            self.misses += 1
+
+        mod_name, _, cls_name = name.rpartition(".")
         mod = importlib.import_module(mod_name)
         action_cls = getattr(mod, cls_name, None)
         if action_cls is None:
-            raise ValueError(f"action {action_name!r} not found in transilience.actions")
-        if not issubclass(action_cls, Action):
-            raise ValueError(f"action {action_name!r} is not an subclass of transilience.actions.Action")
-        serialized["result"] = Result(**serialized["result"])
-        return action_cls(**serialized)
+            raise ValueError(f"action {name!r} not found in transilience.actions")
+        if not isinstance(action_cls, type) or not issubclass(action_cls, Action):
+            raise ValueError(f"action {name!r} is not an subclass of transilience.actions.Action")
+
+        with self.lock:
+            self.imported[name] = action_cls
+            while len(self.imported) > self.maxsize:
+                self.imported.popitem(last=False)
+        return action_cls
+
+
+# Resolver used to deserialize actions
+resolver = ActionResolver()
 
 # https://docs.ansible.com/ansible/latest/collections/index_module.html
 
@@ -1,14 +1,23 @@
 from __future__ import annotations
-from typing import TYPE_CHECKING, Optional, List, Iterator, Dict, Tuple, Union
+from typing import TYPE_CHECKING, Optional, List, Iterator, Dict, Tuple, Union, Hashable
 from dataclasses import dataclass, field
+import concurrent.futures
 import contextlib
 import subprocess
+import threading
+import hashlib
+import logging
+import pickle
+import mmap
 import tempfile
 import shutil
 import time
 import os
 import re
-from .action import Action
+from ..utils import atomic_writer, debfile
+from ..utils.debfile import control_field
+from .action import Action, ResultState
+from .systemd import Systemd, SystemdUnitCache
 from . import builtin
 
 if TYPE_CHECKING:
@@ -25,20 +34,156 @@ re_apt_results = re.compile(
 # long and must start with an alphanumeric character.
 re_pkg_name = re.compile(r"(?P<name>[a-z0-9][a-z0-9+.-]+)(?::(?P<arch>\w+))?(?:=(?P<ver>.+))?")
 
+log = logging.getLogger(__name__)
+
+# Directory with snapshots of the parsed dpkg status, reused by new processes
+# until the status file changes
+DPKG_STATUS_SNAPSHOT_DIR = "/var/cache/transilience"
+
+# Version of the format of the snapshot
+DPKG_STATUS_SNAPSHOT_VERSION = 1
+
+# Number of .deb files above which they are inspected in parallel
+DEB_INFO_PARALLEL_MIN = 4
+
+# Number of threads used to inspect .deb files
+DEB_INFO_WORKERS = 8
+
+# Files whose changes require running apt-get update again
+APT_SOURCES = "/etc/apt/sources.list"
+APT_SOURCES_DIR = "/etc/apt/sources.list.d"
+
+# apt and dpkg cannot run concurrently: when actions are executed concurrently,
+# Apt actions still run one at a time
+apt_lock = threading.Lock()
+
+
+# Parsed paragraph of dpkg's status file: ((name, arch), (version, status)),
+# or None if the paragraph has no Package field
+DpkgEntry = Optional[Tuple[Tuple[str, Optional[str]], Tuple[Optional[str], Optional[str]]]]
+
+
+def dpkg_status_snapshot_path(status_path: str, snapshot_dir: str = DPKG_STATUS_SNAPSHOT_DIR) -> str:
+    """
+    Return the path of the snapshot of the given dpkg status file.
+
+    Each status file gets its own snapshot, so that different roots do not
+    share or overwrite each other's
+    """
+    digest = hashlib.sha1(os.path.abspath(status_path).encode(errors="surrogateescape")).hexdigest()
+    return os.path.join(snapshot_dir, f"dpkg-status-{digest}.pickle")
+
+
+def parse_dpkg_paragraph(paragraph: bytes) -> DpkgEntry:
+    """
+    Parse the fields needed by DpkgStatus from a paragraph of dpkg's status
+    file
+    """
+    # We can cut a lot of corners here, since we only need a specific
+    # subset of the paragraph contents. Particularly, we don't need multiline
+    # fields, and we can just look for field headers at the start of lines
+    package = control_field(paragraph, b"Package: ")
+    if package is None:
+        return None
+    return (
+        (package, control_field(paragraph, b"Architecture: ")),
+        (control_field(paragraph, b"Version: "), control_field(paragraph, b"Status: ")),
+    )
+
 
 class DpkgStatus:
     """
-    Information about the current status of packages
+    Information about the current status of packages.
+
+    If ``snapshot`` is not None, it is the path of a file where the parsed
+    status is saved, so that other processes can reuse it until the status
+    file changes. See dpkg_status_snapshot_path()
     """
-    def __init__(self, path="/var/lib/dpkg/status"):
+    def __init__(self, path="/var/lib/dpkg/status", snapshot: Optional[str] = None):
         self.path = path
+        self.snapshot = snapshot
         # Modification time of path the last time we read it
         self.mtime: float = None
+        # (st_dev, st_ino, st_size, st_mtime_ns) of path the last time we
+        # read it
+        self.key: Optional[Tuple[int, int, int, int]] = None
         # Package status indexed by package (name, arch): (version, status)
         self.packages: Dict[Tuple[str, str], Tuple[str, str]] = {}
-        # Read the default architecture for the system
-        res = subprocess.run(["dpkg", "--print-architecture"], check=True, text=True, capture_output=True)
-        self.arch = res.stdout.strip()
+        # Parsed paragraphs indexed by their length and SHA1 digest, to
+        # reparse only the paragraphs that changed when the status file is
+        # reloaded
+        self.paragraphs: Dict[Tuple[int, bytes], DpkgEntry] = {}
+        self.arch: str
+        if not self.load_snapshot():
+            # Read the default architecture for the system
+            res = subprocess.run(["dpkg", "--print-architecture"], check=True, text=True, capture_output=True)
+            self.arch = res.stdout.strip()
+
+    def load_snapshot(self) -> bool:
+        """
+        Load the architecture from the snapshot, and the package status if
+        the status file has not changed since the snapshot was saved.
+
+        Returns False if there is no usable snapshot
+        """
+        if self.snapshot is None:
+            return False
+
+        try:
+            fd = open(self.snapshot, "rb")
+        except FileNotFoundError:
+            return False
+
+        with fd:
+            # Only trust snapshots that nobody else could have written
+            euid = os.geteuid()
+            st = os.fstat(fd.fileno())
+            st_dir = os.stat(os.path.dirname(self.snapshot))
+            if (st.st_uid != euid or st.st_mode & 0o022
+                    or st_dir.st_uid not in (0, euid) or st_dir.st_mode & 0o022):
+                log.warning("%s: ignoring snapshot with unsafe ownership or permissions", self.snapshot)
+                return False
+
+            try:
+                data = pickle.load(fd)
+            except Exception as e:
+                log.warning("%s: ignoring unreadable snapshot: %s", self.snapshot, e)
+                return False
+
+        if (not isinstance(data, dict) or data.get("version") != DPKG_STATUS_SNAPSHOT_VERSION
+                or data.get("path") != self.path):
+            return False
+
+        self.arch = data["arch"]
+        try:
+            st = os.stat(self.path)
+        except FileNotFoundError:
+            return True
+        if data["key"] == (st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns):
+            self.packages = data["packages"]
+            self.key = data["key"]
+            self.mtime = st.st_mtime
+        return True
+
+    def save_snapshot(self):
+        """
+        Save the parsed status to the snapshot file, if possible
+        """
+        if self.snapshot is None:
+            return
+
+        try:
+            os.makedirs(os.path.dirname(self.snapshot), mode=0o700, exist_ok=True)
+            with atomic_writer(self.snapshot, "wb", chmod=0o600, sync=False) as fd:
+                pickle.dump({
+                    "version": DPKG_STATUS_SNAPSHOT_VERSION,
+                    "path": self.path,
+                    "key": self.key,
+                    "arch": self.arch,
+                    "packages": self.packages,
+                }, fd, protocol=pickle.HIGHEST_PROTOCOL)
+        except OSError as e:
+            log.debug("%s: cannot save snapshot: %s", self.snapshot, e)
 
     def status(self, package: str, arch: Optional[str] = None) -> Union[Tuple[None, None], Tuple[str, str]]:
         """
@@ -62,53 +207,133 @@ class DpkgStatus:
         Reload the dpkg status if it has changed on disk
         """
         try:
-            dpkg_mtime = os.path.getmtime(self.path)
+            st = os.stat(self.path)
         except FileNotFoundError:
             self.packages = {}
             self.mtime = None
+            self.key = None
             return
 
-        if self.mtime is not None and dpkg_mtime < self.mtime:
+        # dpkg replaces the status file on each change, so this also changes
+        # if the file is rewritten within the mtime granularity
+        key = (st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns)
+        if key == self.key:
             # Cache hit
             return
 
         self.load_status()
-        self.mtime = dpkg_mtime
+        self.mtime = st.st_mtime
+        self.key = key
+        self.save_snapshot()
 
     def load_status(self):
         """
         Parse dpkg's status file
         """
-        # We can cut a lot of corners here, since we only need a specific
-        # subset of the file contents. Particularly, we don't need multiline
-        # fields, and we can just match field headers and paragraph breaks
         packages = {}
+        paragraphs: Dict[Tuple[int, bytes], DpkgEntry] = {}
         with open(self.path, "rb") as fd:
-            package: Optional[bytes] = None
-            version: Optional[bytes] = None
-            arch: Optional[bytes] = None
-            status: Optional[bytes] = None
-            for line in fd:
-                if line == b"\n":
-                    if package is not None:
-                        packages[(package, arch)] = (version, status)
-                    package = None
-                    version = None
-                    arch = None
-                    status = None
-                elif line.startswith(b"Package: "):
-                    package = line[9:-1].decode()
-                elif line.startswith(b"Version: "):
-                    version = line[9:-1].decode()
-                elif line.startswith(b"Architecture: "):
-                    arch = line[14:-1].decode()
-                elif line.startswith(b"Status: "):
-                    status = line[8:-1].decode()
-            if package is not None:
-                packages[(package, arch)] = (version, status)
+            size = os.fstat(fd.fileno()).st_size
+            if size > 0:
+                with mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ) as data, memoryview(data) as view:
+                    pos = 0
+                    while pos < size:
+                        end = data.find(b"\n\n", pos)
+                        if end == -1:
+                            end = size
+                        if end > pos:
+                            # Hash the paragraph in place, and copy it only if
+                            # it needs parsing
+                            key = (end - pos, hashlib.sha1(view[pos:end]).digest())
+                            try:
+                                entry = self.paragraphs[key]
+                            except KeyError:
+                                entry = parse_dpkg_paragraph(data[pos:end])
+                            paragraphs[key] = entry
+                            if entry is not None:
+                                packages[entry[0]] = entry[1]
+                        pos = end + 2
+        self.paragraphs = paragraphs
         self.packages = packages
 
 
+class AptCacheUpdater:
+    """
+    Coordinate the apt-get update runs requested by Apt actions on a system.
+
+    With cache_valid_time, apt-get update runs only if the apt cache is older
+    than that. Otherwise, it runs only once, unless the apt sources have
+    changed since the last time it ran.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        # Signature of the apt sources the last time apt-get update ran
+        self.updated_sources: Optional[Tuple[Tuple[str, int, int], ...]] = None
+        # Number of times apt-get update ran
+        self.updates = 0
+        # Number of apt-get update runs avoided because one already ran
+        self.saved = 0
+
+    def sources_signature(self) -> Tuple[Tuple[str, int, int], ...]:
+        """
+        Return a summary of the state of the apt source lists
+        """
+        paths = [APT_SOURCES]
+        try:
+            paths.extend(os.path.join(APT_SOURCES_DIR, name) for name in sorted(os.listdir(APT_SOURCES_DIR)))
+        except FileNotFoundError:
+            pass
+
+        res = []
+        for path in paths:
+            try:
+                st = os.stat(path)
+            except FileNotFoundError:
+                continue
+            res.append((path, st.st_size, st.st_mtime_ns))
+        return tuple(res)
+
+    def update(self, action: "Apt") -> bool:
+        """
+        Run apt-get update for the action, if needed.
+
+        Returns True if apt-get update ran
+        """
+        with self.lock:
+            sources = self.sources_signature()
+            if action.cache_valid_time:
+                if action.is_cache_still_valid():
+                    if self.updates:
+                        self.saved += 1
+                    return False
+            elif self.updated_sources == sources:
+                self.saved += 1
+                log.info("apt-get update already run: skipped (%d runs saved so far)", self.saved)
+                return False
+
+            action.run_command([action.find_apt_get(), "-q", "update"], capture_output=True)
+            self.updated_sources = sources
+            self.updates += 1
+            return True
+
+
+class AptCache:
+    """
+    State shared by Apt actions on a system.
+
+    If ``dpkg_status_snapshot`` is True, the parsed dpkg status is persisted
+    in DPKG_STATUS_SNAPSHOT_DIR
+    """
+    def __init__(self, dpkg_status_snapshot: bool = False):
+        status_path = "/var/lib/dpkg/status"
+        if dpkg_status_snapshot:
+            snapshot: Optional[str] = dpkg_status_snapshot_path(status_path)
+        else:
+            snapshot = None
+        self.dpkg_status = DpkgStatus(status_path, snapshot=snapshot)
+        self.updater = AptCacheUpdater()
+
+
 @builtin.action(name="apt")
 @dataclass
 class Apt(Action):
@@ -118,6 +343,9 @@ class Apt(Action):
 
     `force_apt_get` is ignored: `apt-get` is always used.
 
+    The parsed dpkg status can be persisted across connections with the
+    `dpkg_status_snapshot` option of the system.
+
     Not yet implemented:
 
      * force
@@ -309,33 +537,24 @@ class Apt(Action):
         """
         Return (package, version, arch) information from a .deb file
         """
-        res = subprocess.run(["dpkg", "-I", path], capture_output=True, check=True)
-        package: Optional[str] = None
-        version: Optional[str] = None
-        arch: Optional[str] = None
-        for line in res.stdout.splitlines():
-            if line.startswith(b" Package: "):
-                package = line[10:].decode()
-            elif line.startswith(b" Version: "):
-                version = line[10:].decode()
-            elif line.startswith(b" Architecture: "):
-                arch = line[15:].decode()
-        if package is None:
-            raise RuntimeError(f"{path!r} contains no Package information")
-        if version is None:
-            raise RuntimeError(f"{path!r} contains no Version information")
-        if arch is None:
-            raise RuntimeError(f"{path!r} contains no Architecture information")
-        return package, version, arch
+        return debfile.cache.info(path)
 
     def do_deb(self):
         """
         Run apt install with .deb files
         """
-        debs = [os.path.abspath(path) for path in self.deb]
-        for path in self.deb:
-            path = os.path.abspath(path)
-            package, version, arch = self.get_deb_info(path)
+        paths = [os.path.abspath(path) for path in self.deb]
+        if len(paths) > DEB_INFO_PARALLEL_MIN:
+            # Reading control information is mostly decompression, which
+            # releases the GIL
+            with concurrent.futures.ThreadPoolExecutor(max_workers=DEB_INFO_WORKERS) as executor:
+                infos = list(executor.map(self.get_deb_info, paths))
+        else:
+            infos = [self.get_deb_info(path) for path in paths]
+
+        self._dpkg_cache.update()
+        debs: List[str] = []
+        for path, (package, version, arch) in zip(paths, infos):
             dpkg_version, dpkg_status = self._dpkg_cache.status(package, arch)
             if dpkg_version == version and dpkg_status == "install ok installed":
                 continue
@@ -544,15 +763,82 @@ class Apt(Action):
             if self.has_apt_changes(res.stdout):
                 self.set_changed()
 
+    def merge_key(self) -> Optional[Hashable]:
+        # Only plain installs of named packages are merged
+        if (self.state != "present" or self.deb or self.upgrade != "no" or self.update_cache
+                or self.autoremove or self.autoclean or not self.name
+                or any("*" in name for name in self.name)):
+            return None
+        return (
+            self.install_recommends, self.default_release, self.fail_on_autoremove,
+            self.allow_unauthenticated, tuple(self.dpkg_options), self.policy_rc_d,
+            self.only_upgrade)
+
+    @classmethod
+    def run_merged(cls, system: transilience.system.System, actions: List["Apt"]):
+        """
+        Install the packages of all the actions with a single apt-get run.
+
+        Each action is marked as changed if the dpkg status of any of its
+        packages changed
+        """
+        dpkg_cache = actions[0].get_apt_cache(system).dpkg_status
+        with apt_lock:
+            to_install: List[List[Tuple[str, Optional[str]]]] = []
+            packages: List[str] = []
+            for action in actions:
+                Action.run(action, system)
+                action._dpkg_cache = dpkg_cache
+                action_packages = action.filter_packages_to_install(action.name)
+                to_install.append([action.package_name_arch(pkg) for pkg in action_packages])
+                for pkg in action_packages:
+                    if pkg not in packages:
+                        packages.append(pkg)
+
+            if not packages:
+                return
+
+            before = {name_arch: dpkg_cache.status(*name_arch) for names in to_install for name_arch in names}
+            actions[0].do_install("present", packages)
+            dpkg_cache.update()
+            # Package maintainer scripts can enable, start, or stop units
+            system.get_action_cache(Systemd, SystemdUnitCache).clear()
+
+            for action, names in zip(actions, to_install):
+                if any(dpkg_cache.status(*name_arch) != before[name_arch] for name_arch in names):
+                    action.result.state = ResultState.CHANGED
+                else:
+                    action.result.state = ResultState.NOOP
+
+    def package_name_arch(self, pkg: str) -> Tuple[str, Optional[str]]:
+        """
+        Return the name and architecture of a package specification
+        """
+        mo = re_pkg_name.match(pkg)
+        if not mo:
+            raise RuntimeError(f"Invalid package name: {pkg!r}")
+        return mo.group("name"), mo.group("arch") or None
+
+    def get_apt_cache(self, system: transilience.system.System) -> AptCache:
+        """
+        Return the AptCache of the system, creating it if needed
+        """
+        return system.get_action_cache(Apt, lambda: AptCache(dpkg_status_snapshot=system.dpkg_status_snapshot))
+
     def run(self, system: transilience.system.System):
         super().run(system)
-        self._dpkg_cache = system.get_action_cache(Apt, DpkgStatus)
-
+        cache = self.get_apt_cache(system)
+        self._dpkg_cache = cache.dpkg_status
+        with apt_lock:
+            self.run_apt(cache.updater)
+        if self.result.state == ResultState.CHANGED:
+            # Package maintainer scripts can enable, start, or stop units
+            system.get_action_cache(Systemd, SystemdUnitCache).clear()
+
+    def run_apt(self, updater: AptCacheUpdater):
         cache_updated = False
         if self.update_cache:
-            if not self.is_cache_still_valid():
-                self.run_command([self.find_apt_get(), "-q", "update"], capture_output=True)
-                cache_updated = True
+            cache_updated = updater.update(self)
 
         # If there is nothing else to do exit. This will set state as
         # changed based on if the cache was updated.
@@ -1,6 +1,8 @@
 from __future__ import annotations
-from typing import TYPE_CHECKING, Optional, Union, List
+from typing import TYPE_CHECKING, Hashable, Optional, Union, List, Tuple
 from dataclasses import dataclass
+import contextlib
+import mmap
 import re
 from .common import FileAction
 from . import builtin
@@ -21,6 +23,9 @@ class BlockInFile(FileAction):
      * backup
      * unsafe_writes
      * validate
+
+    As in Ansible, if insertafter or insertbefore do not match any line, the
+    block is added at the end of the file.
     """
     path: str = ""
     block: Union[str, bytes] = ""
@@ -52,101 +57,216 @@ class BlockInFile(FileAction):
     def summary(self):
         return f"Edit block in {self.path!r}"
 
-    def edit_lines(self, lines: List[bytes]):
-        # Compute markers
-        marker_begin = self.marker.format(mark=self.marker_begin).encode()
-        marker_end = self.marker.format(mark=self.marker_end).encode()
+    def list_remote_paths(self) -> Optional[List[str]]:
+        return [self.path]
+
+    def block_bytes(self) -> bytes:
+        """
+        Return the block to write in the file, markers included, or b"" if
+        the block is to be removed
+        """
+        if not self.block or self.state != "present":
+            return b""
+
+        if isinstance(self.block, str):
+            block = self.block.encode()
+        else:
+            block = self.block
+
+        res = [self.marker.format(mark=self.marker_begin).encode(), b"\n"]
+        for line in block.splitlines():
+            res.append(line)
+            res.append(b"\n")
+        res.append(self.marker.format(mark=self.marker_end).encode())
+        res.append(b"\n")
+        return b"".join(res)
+
+    def find_block(self, data: Union[bytes, mmap.mmap]) -> Optional[Tuple[int, int]]:
+        """
+        Return the start and end offsets of the last marked block in data,
+        or None if there is none.
+
+        A block with a begin marker and no end marker goes on until the end
+        of the file
+        """
+        # Scan the begin and end marker lines in file order. If multiple
+        # begin markers are found before an end marker, the first one is used
+        markers = [(pos, 1) for pos in self._find_lines(data, self.marker.format(mark=self.marker_begin).encode())]
+        markers.extend((pos, 0) for pos in self._find_lines(data, self.marker.format(mark=self.marker_end).encode()))
+        markers.sort()
+
+        last_block = None
+        block_begin = None
+        # Each line is either a begin or an end marker, never both
+        last_pos = -1
+        for pos, is_begin in markers:
+            if block_begin is None:
+                if is_begin and pos != last_pos:
+                    block_begin = pos
+            elif not is_begin and pos != block_begin:
+                last_block = (block_begin, self._line_end(data, pos))
+                block_begin = None
+                last_pos = pos
+        if block_begin is not None:
+            last_block = (block_begin, len(data))
+        return last_block
 
-        # Compute insert position
+    def find_insert_position(self, data: Union[bytes, mmap.mmap]) -> int:
+        """
+        Return the offset in data where a new block should be inserted
+        """
         if self.insertbefore is None:
             if self.insertafter in (None, "EOF"):
-                pos = "EOF"
-                insertre = None
-            else:
-                pos = "AFTER"
-                insertre = re.compile(self.insertafter.encode(errors='surrogate_or_strict'))
+                return len(data)
+            pattern = self.insertafter.encode(errors='surrogate_or_strict')
         else:
             if self.insertbefore == "BOF":
-                pos = "BOF"
-                insertre = None
-            else:
-                pos = "BEFORE"
-                insertre = re.compile(self.insertbefore.encode(errors='surrogate_or_strict'))
+                return 0
+            pattern = self.insertbefore.encode(errors='surrogate_or_strict')
 
-        # Block to insert/replace
-        if self.block and self.state == "present":
-            if isinstance(self.block, str):
-                block = self.block.encode()
+        # Look for the last line matching the pattern, scanning lines
+        # backwards. Each line is searched on its own, without its trailing
+        # newline, so that ^ and $ match at its start and end
+        insertre = re.compile(pattern, re.M)
+        line_end = len(data)
+        while line_end > 0:
+            line_start = data.rfind(b"\n", 0, line_end - 1) + 1
+            if data[line_end - 1:line_end] == b"\n":
+                text_end = line_end - 1
             else:
-                block = self.block
-
-            blocklines = [marker_begin + b"\n"]
-            for line in block.splitlines():
-                if not line.endswith(b"\n"):
-                    line += b"\n"
-                blocklines.append(line)
-            blocklines.append(marker_end + b"\n")
-        else:
-            blocklines = []
+                text_end = line_end
+            if insertre.search(data, line_start, text_end):
+                return line_start if self.insertbefore is not None else line_end
+            line_end = line_start
 
-        # Look for the last matching block in the file, and for the last line
-        # matching insertre
-        line_begin = None
-        last_block = None
-        insertre_pos = None
-        for lineno, line in enumerate(lines):
-            # print("SCAN", lineno, line, line_begin, last_block, insertre_pos)
-            if line_begin is None:
-                if line.rstrip() == marker_begin:
-                    line_begin = lineno
-            else:
-                if line.rstrip() == marker_end:
-                    last_block = (line_begin, lineno)
-                    line_begin = None
-
-            if insertre is not None and insertre.search(line):
-                insertre_pos = lineno
-        if line_begin is not None:
-            last_block = (line_begin, lineno + 1)
-
-        # Do the edit
-        # print("EDIT", last_block, pos, insertre, blocklines, lines)
-        if last_block is None:
-            if pos == "EOF":
-                lines += blocklines
-            elif pos == "BOF":
-                lines[0:0] = blocklines
-            elif pos == "BEFORE":
-                lines[insertre_pos:insertre_pos] = blocklines
-            elif pos == "AFTER":
-                lines[insertre_pos + 1:insertre_pos + 1] = blocklines
+        return len(data)
+
+    def _find_lines(self, data: Union[bytes, mmap.mmap], line: bytes) -> List[int]:
+        """
+        Return the start offsets of all the lines in data that contain only
+        the given line, possibly followed by whitespace
+        """
+        res: List[int] = []
+        pos = data.find(line)
+        while pos != -1:
+            line_end = self._line_end(data, pos)
+            if (pos == 0 or data[pos - 1:pos] == b"\n") and not data[pos + len(line):line_end].strip():
+                res.append(pos)
+            pos = data.find(line, pos + 1)
+        return res
+
+    def _line_end(self, data: Union[bytes, mmap.mmap], pos: int) -> int:
+        """
+        Return the offset after the end of the line containing pos
+        """
+        end = data.find(b"\n", pos)
+        if end == -1:
+            return len(data)
+        return end + 1
+
+    def find_edit(self, data: Union[bytes, mmap.mmap]) -> Optional[Tuple[int, int, bytes]]:
+        """
+        Compute the edit to do on data.
+
+        Returns None if data does not need changing, or (start, end, replacement)
+        """
+        block = self.block_bytes()
+
+        last_block = self.find_block(data)
+        if last_block is not None:
+            start, end = last_block
+        elif not block:
+            return None
         else:
-            lines[last_block[0]:last_block[1] + 1] = blocklines
+            start = end = self.find_insert_position(data)
+            if start > 0 and data[start - 1:start] != b"\n":
+                # Insert after a last line without a trailing newline
+                block = b"\n" + block
 
-    def run(self, system: transilience.system.System):
-        super().run(system)
-        path = self.get_path_object(self.path, follow=True)
-        lines: List[bytes]
+        if data[start:end] == block:
+            return None
+
+        return start, end, block
+
+    def merge_key(self) -> Optional[Hashable]:
+        # Edits to the same file, leaving it with the same permissions
+        return (self.path, self.owner, self.group, self.mode, self.create)
+
+    @classmethod
+    def run_merged(cls, system: transilience.system.System, actions: List["BlockInFile"]):
+        """
+        Apply the edits of all the actions with a single read and a single
+        write of the file.
+
+        Each action is marked as changed if its own edit changed the file
+        """
+        for action in actions:
+            FileAction.run(action, system)
+        cls.edit_file(actions)
+
+    @classmethod
+    def edit_file(cls, actions: List["BlockInFile"]):
+        """
+        Apply the edits of a sequence of actions to the same file
+        """
+        first = actions[0]
+        path = first.get_path_object(first.path, follow=True)
         if path is None:
-            if not self.create:
+            if not first.create:
                 return
-            dest = self.path
-            lines = []
+            dest = first.path
+            size = 0
         else:
             dest = path.path
-            # Read the original contents of the file
-            with open(dest, "rb") as fd:
-                lines = fd.readlines()
-
-        orig_lines = list(lines)
-        self.edit_lines(lines)
-
-        # If file exists, and contents would not be changed, don't write it
-        if orig_lines == lines:
-            self.set_path_object_permissions(path)
-            return
-
-        # Write out the new contents
-        with self.write_file_atomically(dest, "wb") as fd:
-            for line in lines:
-                fd.write(line)
+            size = path.st.st_size
+
+        with contextlib.ExitStack() as stack:
+            if size == 0:
+                data: Union[bytes, mmap.mmap] = b""
+            else:
+                infd = stack.enter_context(open(dest, "rb"))
+                data = stack.enter_context(mmap.mmap(infd.fileno(), 0, access=mmap.ACCESS_READ))
+
+            # Apply each edit to the result of the previous ones. The last
+            # edit is kept pending, to stream it to the output file
+            current = data
+            pending: Optional[Tuple[int, int, bytes]] = None
+            writer: Optional[BlockInFile] = None
+            for action in actions:
+                if pending is not None:
+                    start, end, block = pending
+                    current = current[:start] + block + current[end:]
+                    pending = None
+                pending = action.find_edit(current)
+                if pending is None:
+                    continue
+                if writer is not None:
+                    writer.set_changed()
+                writer = action
+
+            if writer is not None:
+                # Write out the new contents, copying the unchanged parts
+                # straight from the original file
+                with memoryview(current) as view:
+                    with writer.write_file_atomically(dest, "wb") as fd:
+                        if pending is None:
+                            fd.write(view)
+                        else:
+                            start, end, block = pending
+                            fd.write(view[:start])
+                            fd.write(block)
+                            fd.write(view[end:])
+
+        # Actions that did not write the file still check its permissions
+        for action in actions:
+            if action is writer:
+                continue
+            if action is first and writer is None:
+                action.set_path_object_permissions(path)
+            else:
+                action.forget_path(action.path)
+                action.set_path_object_permissions(action.get_path_object(action.path, follow=True))
+
+    def run(self, system: transilience.system.System):
+        super().run(system)
+        self.edit_file([self])
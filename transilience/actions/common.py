@@ -1,5 +1,5 @@
 from __future__ import annotations
-from typing import TYPE_CHECKING, Union, Optional, BinaryIO, cast
+from typing import TYPE_CHECKING, Union, Optional, BinaryIO, Dict, Tuple, cast
 from dataclasses import dataclass
 import contextlib
 import tempfile
@@ -8,7 +8,8 @@ import stat
 import pwd
 import grp
 import os
-from transilience.utils.modechange import ModeChange
+from transilience.utils import get_umask
+from transilience.utils.modechange import ModeProgram
 from .action import Action, doc
 
 if TYPE_CHECKING:
@@ -22,8 +23,12 @@ class PathObject:
     # It would be nice to support dir_fd, but we need to not follow symlinks
     # when doing chown/chmod, and at least chmod does not support using dir_fd
     # and follow_symlinks together.
+    __slots__ = ("path", "st", "_target")
+
     def __init__(self, path: str, follow: bool = True):
         self.path = path
+        # Target of the symlink, read on demand
+        self._target: Optional[str] = None
         self.st = os.lstat(self.path)
         if stat.S_ISLNK(self.st.st_mode) and follow:
             self.st = os.stat(self.path)
@@ -32,6 +37,14 @@ class PathObject:
     def __str__(self):
         return self.path
 
+    def readlink(self) -> str:
+        """
+        Return the target of the symlink
+        """
+        if self._target is None:
+            self._target = os.readlink(self.path)
+        return self._target
+
     def chmod(self, mode: int):
         if self.islink():
             try:
@@ -86,6 +99,8 @@ class FileAction(Action):
         # precompiled mode
         self._mode = None
         self._cur_umask = None
+        # PathObjects looked up during this run, indexed by (path, follow)
+        self._path_cache: Dict[Tuple[str, bool], Optional[PathObject]] = {}
 
     def _compute_fs_perms(self, orig: Optional[int], is_dir: bool = False) -> Optional[int]:
         """
@@ -116,19 +131,17 @@ class FileAction(Action):
                 return None
         else:
             if orig is None:
-                new_mode, affected_bits = ModeChange.adjust(
+                new_mode, affected_bits = self._mode.adjust(
                     oldmode=0,
                     is_dir=is_dir,
-                    umask_value=self._cur_umask,
-                    changes=self._mode)
+                    umask_value=self._cur_umask)
 
                 return new_mode
             else:
-                new_mode, affected_bits = ModeChange.adjust(
+                new_mode, affected_bits = self._mode.adjust(
                     oldmode=orig,
                     is_dir=is_dir,
-                    umask_value=self._cur_umask,
-                    changes=self._mode)
+                    umask_value=self._cur_umask)
 
                 if orig == new_mode:
                     return None
@@ -151,14 +164,31 @@ class FileAction(Action):
             path: str,
             follow: Optional[bool] = None) -> Optional[PathObject]:
         """
-        Return a PathObject from a given path
+        Return a PathObject from a given path.
+
+        Results are cached until forget_path() is called for the path
         """
         if follow is None:
             follow = getattr(self, "follow", True)
+        key = (path, follow)
         try:
-            return PathObject(path=path, follow=follow)
+            return self._path_cache[key]
+        except KeyError:
+            pass
+        try:
+            res: Optional[PathObject] = PathObject(path=path, follow=follow)
         except FileNotFoundError:
-            return None
+            res = None
+        self._path_cache[key] = res
+        return res
+
+    def forget_path(self, path: str):
+        """
+        Drop cached information about a path, after changing it
+        """
+        for key, po in list(self._path_cache.items()):
+            if key[0] == path or (po is not None and po.path == path):
+                del self._path_cache[key]
 
     def set_path_object_permissions(self, path: Optional[PathObject], record=True):
         """
@@ -171,6 +201,7 @@ class FileAction(Action):
         mode = self._compute_fs_perms(orig=stat.S_IMODE(path.st.st_mode), is_dir=path.isdir())
         if mode is not None:
             path.chmod(mode)
+            self.forget_path(path.path)
             if record:
                 self.mode = mode
             self.set_changed()
@@ -182,6 +213,7 @@ class FileAction(Action):
         if (self.owner != -1 and self.owner != path.st.st_uid) or (self.group != -1 and self.group != path.st.st_gid):
             self.set_changed()
             path.chown(cast(int, self.owner), cast(int, self.group))
+            self.forget_path(path.path)
             self.log.info("%s: file ownership set to %d %d", path, self.owner, self.group)
         else:
             if record:
@@ -201,6 +233,7 @@ class FileAction(Action):
         except FileExistsError:
             yield None
             return
+        self.forget_path(path)
 
         # If we are here, it means we created the file. If anything fails here,
         # we need to remove it on exit
@@ -244,6 +277,7 @@ class FileAction(Action):
             self._set_fd_perms(path, fd)
 
             os.rename(tmppath, path)
+            self.forget_path(path)
             self.log.info("%s: original file replaced", path)
             self.set_changed()
         except Exception:
@@ -268,8 +302,9 @@ class FileAction(Action):
         else:
             self.group = -1
 
+        self._path_cache = {}
+
         if isinstance(self.mode, str):
-            self._mode = ModeChange.compile(self.mode)
+            self._mode = ModeProgram.compile(self.mode)
 
-        self._cur_umask = os.umask(0)
-        os.umask(self._cur_umask)
+        self._cur_umask = get_umask()
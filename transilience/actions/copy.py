@@ -3,6 +3,7 @@ from typing import TYPE_CHECKING, Optional, Union, List
 from dataclasses import dataclass
 import hashlib
 import os
+from transilience.utils import checksums
 from .common import FileAction, PathObject
 from . import builtin
 
@@ -47,8 +48,7 @@ class Copy(FileAction):
 
             if self.checksum is None:
                 self.src = os.path.abspath(self.src)
-                with open(self.src, "rb") as fd:
-                    self.checksum = PathObject.compute_file_sha1sum(fd)
+                self.checksum = checksums.cache.sha1sum(self.src)
         elif self.content is not None:
             if self.checksum is None:
                 h = hashlib.sha1()
@@ -72,6 +72,9 @@ class Copy(FileAction):
             res.append(self.src)
         return res
 
+    def list_remote_paths(self) -> Optional[List[str]]:
+        return [self.dest]
+
     def write_content(self):
         """
         Write destination file from self.content
@@ -107,11 +110,14 @@ class Copy(FileAction):
                 self.set_path_object_permissions(path)
                 return
             dest = path.path
+            # The existing file can be used as a basis for delta transfers
+            basis = dest if not path.isdir() else None
         else:
             dest = self.dest
+            basis = None
 
         with self.write_file_atomically(dest, "w+b") as fd:
-            system.transfer_file(self.src, fd)
+            system.transfer_file(self.src, fd, checksum=self.checksum, basis=basis)
             fd.seek(0)
             checksum = PathObject.compute_file_sha1sum(fd)
             if checksum != self.checksum:
@@ -1,8 +1,11 @@
 from __future__ import annotations
-from typing import TYPE_CHECKING, Optional
+from typing import TYPE_CHECKING, Optional, List, Dict, Tuple, cast
 from dataclasses import dataclass
+import concurrent.futures
 import tempfile
 import shutil
+import errno
+import stat
 import os
 from .common import FileAction, PathObject
 from . import builtin
@@ -11,6 +14,20 @@ from .action import doc
 if TYPE_CHECKING:
     import transilience.system
 
+# Number of threads used to set permissions of subdirectories in parallel,
+# with recurse=True
+TREE_WORKERS = 8
+
+# Open a directory to be used as dir_fd, without following symlinks
+DIR_OPEN_FLAGS = os.O_RDONLY | os.O_DIRECTORY | os.O_NOFOLLOW | os.O_CLOEXEC
+
+# Errors opening a subdirectory that has been removed, or replaced with
+# something else, while walking a tree: the entry is skipped
+SKIP_DIR_ERRNOS = frozenset((errno.ENOENT, errno.ELOOP, errno.ENOTDIR))
+
+# (path, st_dev, st_ino) of a directory waiting to be visited
+DirEntry = Tuple[str, int, int]
+
 
 @builtin.action(name="file")
 @dataclass
@@ -58,6 +75,17 @@ class File(FileAction):
         else:
             return f"{self.__class__}: unknown state {self.state!r}"
 
+    def list_remote_paths(self) -> Optional[List[str]]:
+        res = [self.path]
+        if self.state == "hard":
+            # The target of a hard link needs to exist. do_hard() uses src as
+            # given, so a relative src depends on the working directory of the
+            # remote system, and we cannot tell which path it is
+            if not os.path.isabs(self.src):
+                return None
+            res.append(self.src)
+        return res
+
     def do_file(self):
         path = self.get_path_object(self.path)
         if path is None:
@@ -69,13 +97,94 @@ class File(FileAction):
         self.set_path_object_permissions(path)
 
     def _set_tree_perms(self, path: PathObject):
-        for root, dirs, files in path.walk():
-            for fn in dirs:
-                self.set_path_object_permissions(
-                        PathObject(os.path.join(root, fn), follow=False), record=False)
-            for fn in files:
-                self.set_path_object_permissions(
-                        PathObject(os.path.join(root, fn), follow=False), record=False)
+        """
+        Set permissions and ownership of everything inside a directory,
+        without following symlinks
+        """
+        if self.mode is None and self.owner == -1 and self.group == -1:
+            # Nothing to change on existing files
+            return
+
+        # Memoize new modes by (original mode, is_dir)
+        memo: Dict[Tuple[int, bool], Optional[int]] = {}
+
+        dir_fd = os.open(path.path, DIR_OPEN_FLAGS)
+        try:
+            subdirs = self._set_dir_entries_perms(dir_fd, path.path, memo)
+        finally:
+            os.close(dir_fd)
+
+        if len(subdirs) < 2:
+            self._set_subtree_perms(subdirs, memo)
+            return
+
+        # Work on subtrees in parallel: most of the time is spent in system
+        # calls, which run without holding the GIL
+        with concurrent.futures.ThreadPoolExecutor(max_workers=TREE_WORKERS) as executor:
+            futures = [executor.submit(self._set_subtree_perms, [subdir], memo) for subdir in subdirs]
+            for future in futures:
+                future.result()
+
+    def _set_subtree_perms(self, stack: List[DirEntry], memo: Dict[Tuple[int, bool], Optional[int]]):
+        """
+        Set permissions of everything inside the directories in ``stack``.
+
+        Directories are visited depth first, keeping only one of them open at
+        a time. A directory is skipped if it is no longer the one that was
+        listed, because it has been removed or replaced in the meantime
+        """
+        while stack:
+            dir_path, dev, ino = stack.pop()
+            try:
+                dir_fd = os.open(dir_path, DIR_OPEN_FLAGS)
+            except OSError as e:
+                if e.errno in SKIP_DIR_ERRNOS:
+                    continue
+                raise
+            try:
+                st = os.fstat(dir_fd)
+                if st.st_dev != dev or st.st_ino != ino:
+                    continue
+                stack.extend(self._set_dir_entries_perms(dir_fd, dir_path, memo))
+            finally:
+                os.close(dir_fd)
+
+    def _set_dir_entries_perms(
+            self, dir_fd: int, dir_path: str, memo: Dict[Tuple[int, bool], Optional[int]]) -> List[DirEntry]:
+        """
+        Set permissions of the entries of the directory open as ``dir_fd``.
+
+        Returns the subdirectories found
+        """
+        subdirs: List[DirEntry] = []
+        with os.scandir(dir_fd) as it:
+            for de in it:
+                try:
+                    st = de.stat(follow_symlinks=False)
+                except FileNotFoundError:
+                    continue
+                is_dir = stat.S_ISDIR(st.st_mode)
+                if is_dir:
+                    subdirs.append((os.path.join(dir_path, de.name), st.st_dev, st.st_ino))
+
+                orig = stat.S_IMODE(st.st_mode)
+                key = (orig, is_dir)
+                mode = memo.get(key, -1)
+                if mode == -1:
+                    mode = memo[key] = self._compute_fs_perms(orig=orig, is_dir=is_dir)
+
+                # Symlinks have no permissions of their own on Linux
+                if mode is not None and not stat.S_ISLNK(st.st_mode):
+                    os.chmod(de.name, mode, dir_fd=dir_fd)
+                    self.set_changed()
+                    self.log.info("%s: file mode set to 0o%o", os.path.join(dir_path, de.name), mode)
+
+                if (self.owner != -1 and self.owner != st.st_uid) or (self.group != -1 and self.group != st.st_gid):
+                    os.chown(de.name, cast(int, self.owner), cast(int, self.group), dir_fd=dir_fd, follow_symlinks=False)
+                    self.set_changed()
+                    self.log.info("%s: file ownership set to %d %d",
+                                  os.path.join(dir_path, de.name), self.owner, self.group)
+        return subdirs
 
     def _mkpath(self, path: str):
         parent = os.path.dirname(path)
@@ -84,6 +193,7 @@ class File(FileAction):
 
         self.log.info("%s: creating directory", path)
         os.mkdir(path)
+        self.forget_path(path)
 
         patho = self.get_path_object(path)
         self.set_path_object_permissions(patho, record=False)
@@ -123,7 +233,7 @@ class File(FileAction):
         if path is None:
             os.symlink(target, self.path)
         elif path.islink():
-            orig = os.readlink(self.path)
+            orig = path.readlink()
             if orig == target:
                 return
             os.symlink(target, self.path)
@@ -150,6 +260,7 @@ class File(FileAction):
                 raise
 
         self.set_changed()
+        self.forget_path(self.path)
         path = self.get_path_object(self.path, follow=False)
         self.set_path_object_permissions(path)
 
@@ -185,9 +296,8 @@ class File(FileAction):
                 os.unlink(tmp)
                 raise
         else:
-            target = self.get_path_object(self.src, follow=False)
             # noop if it's a link to the same target
-            if (target.st.st_dev, target.st.st_ino) == (path.st.st_dev, path.st.st_ino):
+            if (target_po.st.st_dev, target_po.st.st_ino) == (path.st.st_dev, path.st.st_ino):
                 return
             # tempfile.mktemp is deprecated, but I cannot find a better way to
             # atomically create a symlink with a nonconflicting name
@@ -200,6 +310,7 @@ class File(FileAction):
                 raise
 
         self.set_changed()
+        self.forget_path(self.path)
         path = self.get_path_object(self.path, follow=False)
         self.set_path_object_permissions(path)
 
@@ -225,6 +336,7 @@ class File(FileAction):
             os.unlink(self.path)
             self.set_changed()
             self.log.info("%s: removed")
+        self.forget_path(self.path)
 
     def run(self, system: transilience.system.System):
         super().run(system)
@@ -1,5 +1,5 @@
 from __future__ import annotations
-from typing import TYPE_CHECKING
+from typing import TYPE_CHECKING, List, Optional
 from dataclasses import dataclass
 from .action import Action, doc
 from . import builtin
@@ -19,6 +19,9 @@ class Noop(Action):
     def summary(self):
         return "Do nothing"
 
+    def list_remote_paths(self) -> Optional[List[str]]:
+        return []
+
     def run(self, system: transilience.system.System):
         super().run(system)
         if self.changed:
@@ -1,8 +1,6 @@
 from __future__ import annotations
-from typing import TYPE_CHECKING, Optional, Callable
-
-if TYPE_CHECKING:
-    from .action import Action
+from typing import Optional, Callable
+from .action import Action, resolver
 
 
 class Namespace:
@@ -19,6 +17,17 @@ class Namespace:
     def __repr__(self):
         return f"Action namespace {self.name!r}"
 
+    def register(self, name: str, factory: Callable[..., Action]):
+        """
+        Add an action factory to this namespace.
+
+        If the factory is an Action class, also register it for quick lookup
+        when deserializing actions
+        """
+        setattr(self, name, factory)
+        if isinstance(factory, type) and issubclass(factory, Action):
+            resolver.register(factory)
+
     def action(
             self,
             factory: Optional[Callable[..., Action]] = None,
@@ -29,12 +38,12 @@ class Namespace:
                 nonlocal name
                 if name is None:
                     name = factory.__name__
-                setattr(self, name, factory)
+                self.register(name, factory)
                 return factory
             return decorator
         else:
             name = factory.__name__
-            setattr(self, name, factory)
+            self.register(name, factory)
             return factory
 
 
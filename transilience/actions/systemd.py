@@ -1,7 +1,8 @@
 from __future__ import annotations
-from typing import TYPE_CHECKING, Optional
+from typing import TYPE_CHECKING, Callable, Dict, Iterable, List, Optional, Set
 from dataclasses import dataclass
 import subprocess
+import threading
 import shutil
 import shlex
 import os
@@ -11,6 +12,237 @@ from . import builtin
 if TYPE_CHECKING:
     import transilience.system
 
+# Dependencies along which changing the state of a unit can change the state
+# of other units: starting a unit starts what it requires and stops what
+# conflicts with it, stopping it stops what requires it
+DEPENDENCY_PROPERTIES = (
+    "Requires", "Wants", "BindsTo", "Conflicts", "ConflictedBy",
+    "RequiredBy", "BoundBy", "ConsistsOf", "TriggeredBy",
+)
+
+# Unit properties used by Systemd actions
+UNIT_PROPERTIES = ("Id", "Names", "LoadState", "ActiveState", "UnitFileState") + DEPENDENCY_PROPERTIES
+
+# Directories containing unit files: unit files in a user's home are under
+# USER_UNIT_DIR
+UNIT_DIRS = ("/etc/systemd", "/run/systemd", "/lib/systemd", "/usr/lib/systemd", "/usr/local/lib/systemd")
+USER_UNIT_DIR = "/.config/systemd/"
+
+
+def units_for_path(path: str) -> Optional[Set[str]]:
+    """
+    Return the names of the units whose unit files are affected by changing
+    ``path``, or None if it can affect any unit.
+
+    Drop-in directories and .wants/.requires directories count as their
+    unit, and a template counts as all its instances
+    """
+    if not os.path.isabs(path):
+        return None
+    path = os.path.normpath(path)
+    for unit_dir in UNIT_DIRS:
+        if path == unit_dir or unit_dir.startswith(path.rstrip(os.sep) + os.sep):
+            return None
+        if path.startswith(unit_dir + os.sep):
+            relpath = path[len(unit_dir) + 1:]
+            break
+    else:
+        pos = path.find(USER_UNIT_DIR)
+        if pos == -1:
+            return set()
+        relpath = path[pos + len(USER_UNIT_DIR):]
+
+    res: Set[str] = set()
+    for name in relpath.split(os.sep):
+        for suffix in (".d", ".wants", ".requires"):
+            if name.endswith(suffix):
+                name = name[:-len(suffix)]
+                break
+        if "." in name:
+            res.add(name)
+    return res
+
+
+def parse_show(output: str) -> List[Dict[str, str]]:
+    """
+    Parse the output of systemctl show into a dict of properties for each
+    unit
+    """
+    res = []
+    for paragraph in output.split("\n\n"):
+        info = {}
+        for line in paragraph.splitlines():
+            line = line.strip()
+            if not line:
+                continue
+            k, v = line.split("=", 1)
+            info[k] = v
+        if info:
+            res.append(info)
+    return res
+
+
+class SystemdUnitCache:
+    """
+    Cache of the state of systemd units, shared by Systemd actions on a system.
+
+    The state of all the units loaded by the service manager is fetched with
+    a single systemctl show, the first time a unit is looked up. Units not
+    found there are queried one at a time.
+
+    Changing the state of a unit forgets it and the units it can affect
+    through DEPENDENCY_PROPERTIES. Changing its unit file state reloads the
+    service manager, and forgets the whole scope. Other actions forget the
+    units whose files they change, or everything if they can change anything.
+    Forgotten units are queried one at a time, and forgotten scopes with a new
+    bulk query
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        # Properties of units, indexed by scope and by unit name
+        self.units: Dict[str, Dict[str, Dict[str, str]]] = {}
+        # Number of systemctl show runs for all loaded units
+        self.bulk_queries = 0
+        # Number of systemctl show runs for a single unit
+        self.unit_queries = 0
+
+    def get(self, scope: str, unit: str, run_systemctl: Callable[..., subprocess.CompletedProcess]) -> Dict[str, str]:
+        """
+        Return the properties of a unit.
+
+        run_systemctl is a function running systemctl for the given scope with
+        the arguments it receives
+        """
+        with self.lock:
+            units = self.units.get(scope)
+            if units is None:
+                units = self.units[scope] = self._load_all(run_systemctl)
+
+            info = self._lookup(units, unit)
+            if info is None:
+                info = units[unit] = self._load_unit(unit, run_systemctl)
+                # Also index it by its names, to find it as a dependency
+                for name in [info.get("Id", "")] + info.get("Names", "").split():
+                    if name:
+                        units.setdefault(name, info)
+            return info
+
+    def _lookup(self, units: Dict[str, Dict[str, str]], unit: str) -> Optional[Dict[str, str]]:
+        info = units.get(unit)
+        if info is None and "." not in unit:
+            # systemctl defaults to .service for names without a suffix
+            info = units.get(unit + ".service")
+        return info
+
+    def _load_all(self, run_systemctl: Callable[..., subprocess.CompletedProcess]) -> Dict[str, Dict[str, str]]:
+        res = run_systemctl(
+                "show", "--no-pager", "--property=" + ",".join(UNIT_PROPERTIES), "*", check=False, text=True)
+        self.bulk_queries += 1
+        units: Dict[str, Dict[str, str]] = {}
+        if res.returncode != 0:
+            return units
+        for info in parse_show(res.stdout):
+            for name in info.get("Names", "").split():
+                units[name] = info
+            unit_id = info.get("Id")
+            if unit_id:
+                units[unit_id] = info
+        return units
+
+    def _load_unit(self, unit: str, run_systemctl: Callable[..., subprocess.CompletedProcess]) -> Dict[str, str]:
+        res = run_systemctl(
+                "show", "--no-pager", "--property=" + ",".join(UNIT_PROPERTIES), unit, check=False, text=True)
+        self.unit_queries += 1
+        if res.returncode != 0:
+            return {}
+        units = parse_show(res.stdout)
+        if not units:
+            return {}
+        return units[0]
+
+    def _forget(self, units: Dict[str, Dict[str, str]], names: Iterable[str], dependencies: bool):
+        """
+        Forget the given units, and if ``dependencies`` is True, the units
+        they can affect
+        """
+        todo = list(names)
+        seen: Set[str] = set()
+        # ids of the forgotten infos, to also drop other names used to look
+        # them up
+        forgotten: Set[int] = set()
+        while todo:
+            name = todo.pop()
+            if name in seen:
+                continue
+            seen.add(name)
+
+            if "@." in name:
+                # A template affects all its instances
+                prefix, suffix = name.split("@.", 1)
+                todo.extend(k for k in units if k.startswith(prefix + "@") and k.endswith("." + suffix))
+
+            info = self._lookup(units, name)
+            units.pop(name, None)
+            if info is None:
+                continue
+            forgotten.add(id(info))
+            if dependencies:
+                for prop in DEPENDENCY_PROPERTIES:
+                    todo.extend(info.get(prop, "").split())
+
+        for key in [key for key, info in units.items() if id(info) in forgotten]:
+            del units[key]
+
+    def forget_unit(self, scope: str, unit: str):
+        """
+        Drop cached information about a unit whose state changed, and about
+        the units that depend on it
+        """
+        with self.lock:
+            units = self.units.get(scope)
+            if units is not None:
+                self._forget(units, (unit,), dependencies=True)
+
+    def forget_scope(self, scope: str):
+        """
+        Drop cached information about all units in a scope, for example after
+        the service manager reloaded its configuration
+        """
+        with self.lock:
+            self.units.pop(scope, None)
+
+    def action_started(self, action: Action):
+        """
+        Forget the units that an action that is not Systemd can change
+        """
+        if isinstance(action, Systemd):
+            return
+
+        paths = action.list_remote_paths()
+        if paths is None:
+            self.clear()
+            return
+
+        names: Set[str] = set()
+        for path in paths:
+            path_names = units_for_path(path)
+            if path_names is None:
+                self.clear()
+                return
+            names.update(path_names)
+
+        if names:
+            with self.lock:
+                for units in self.units.values():
+                    self._forget(units, names, dependencies=False)
+
+    def clear(self):
+        """
+        Drop all cached information, for example after a daemon-reload
+        """
+        with self.lock:
+            self.units = {}
+
 
 @builtin.action(name="systemd")
 @dataclass
@@ -18,12 +250,19 @@ class Systemd(Action):
     """
     Same as Ansible's
     [builtin.systemd](https://docs.ansible.com/ansible/latest/collections/ansible/builtin/systemd_module.html)
+
+    If ``defer_daemon_reload`` is True, ``daemon_reload`` is not run right
+    away, but once before the next Systemd action that works on a unit, or
+    when the pipeline is closed. Multiple deferred reloads are coalesced into
+    one. If a deferred reload fails, the failure is reported when the
+    runner ends.
     """
     scope: str = "system"
     no_block: bool = False
     force: bool = False
     daemon_reexec: bool = False
     daemon_reload: bool = False
+    defer_daemon_reload: bool = False
     unit: Optional[str] = None
     enabled: Optional[bool] = None
     masked: Optional[bool] = None
@@ -54,14 +293,14 @@ class Systemd(Action):
 
         verbs = []
         if self.daemon_reload:
-            verbs.append("reload")
+            verbs.append("reload (deferred)" if self.defer_daemon_reload else "reload")
         if self.daemon_reexec:
             verbs.append("restart")
 
         if verbs:
             if summary:
                 summary += " and "
-            summary += " and ".join(summary, ", ".join(verbs) + " systemd")
+            summary += ", ".join(verbs) + " systemd"
 
         if not summary:
             summary += "systemd action with nothing to do"
@@ -109,26 +348,45 @@ class Systemd(Action):
                 self.log.error("%s: exited with code %d and stderr %r", formatted_cmd, e.returncode, e.stderr)
                 raise
 
-        if self.daemon_reload:
+        def new_unit_cache():
+            cache = SystemdUnitCache()
+            system.add_action_listener(cache.action_started)
+            return cache
+
+        unit_cache = system.get_action_cache(Systemd, new_unit_cache)
+        reload_key = ("systemd daemon-reload", self.scope)
+
+        def daemon_reload():
             run_systemctl("daemon-reload")
+            unit_cache.clear()
+
+        if self.daemon_reload:
+            if self.defer_daemon_reload:
+                system.defer(reload_key, daemon_reload)
+            else:
+                system.cancel_deferred(reload_key)
+                daemon_reload()
 
         if self.daemon_reexec:
+            # Reexecuting also reloads the units
+            system.cancel_deferred(reload_key)
             run_systemctl("daemon-reexec")
+            unit_cache.clear()
 
         if self.unit is not None:
+            # Units need to be seen as they are on disk
+            system.run_deferred(reload_key)
+
             # Fetch the current status of the unit
             # Documentation of UnitFileState values can be found in man systemctl(1)
-            res = run_systemctl("show", self.unit, "--no-page", check=False, text=True)
-
-            unit_info = {}
-            if res.returncode == 0:
-                for line in res.stdout.splitlines():
-                    k, v = line.strip().split("=", 1)
-                    unit_info[k] = v
+            unit_info = unit_cache.get(self.scope, self.unit, run_systemctl)
 
             if self.masked is not None:
                 orig_masked = unit_info.get("UnitFileState") == "masked"
                 if self.masked != orig_masked:
+                    # systemctl reloads the service manager after changing
+                    # unit files
+                    unit_cache.forget_scope(self.scope)
                     run_systemctl("mask" if self.masked else "unmask", self.unit)
                     self.set_changed()
 
@@ -137,6 +395,7 @@ class Systemd(Action):
                         "enabled", "enabled-runtime", "alias", "static",
                         "indirect", "generated", "transient")
                 if self.enabled != orig_enabled:
+                    unit_cache.forget_scope(self.scope)
                     run_systemctl("enable" if self.enabled else "disable", self.unit)
                     self.set_changed()
 
@@ -163,5 +422,6 @@ class Systemd(Action):
                             action = "restart"
 
                 if action is not None:
+                    unit_cache.forget_unit(self.scope, self.unit)
                     run_systemctl(action, self.unit)
                     self.set_changed()
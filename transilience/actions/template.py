@@ -0,0 +1,143 @@
+from __future__ import annotations
+from typing import TYPE_CHECKING, Any, Dict, List, Optional
+from dataclasses import dataclass, field
+import threading
+import tempfile
+import os
+from transilience.utils import checksums
+from .common import FileAction, PathObject
+from . import builtin
+
+if TYPE_CHECKING:
+    import transilience.system
+    import transilience.template
+
+
+class TemplateCache:
+    """
+    Template sources and compiled templates, shared by Template actions on a
+    system
+    """
+    def __init__(self):
+        # Imported here, so that only systems that render templates need
+        # jinja2
+        from transilience import template
+
+        self.lock = threading.Lock()
+        # Template sources indexed by SHA1 checksum
+        self.sources: Dict[str, str] = {}
+        # Locks serializing transfers of the same source, indexed by SHA1
+        # checksum
+        self.fetching: Dict[str, threading.Lock] = {}
+        self.engine: transilience.template.Engine = template.Engine()
+        # Number of template sources transferred from the controller
+        self.fetches = 0
+
+    def get_source(self, system: transilience.system.System, src: str, checksum: str) -> str:
+        """
+        Return the source of a template, transferring it from the controller
+        only the first time it is needed
+        """
+        with self.lock:
+            source = self.sources.get(checksum)
+            if source is not None:
+                return source
+            fetch_lock = self.fetching.setdefault(checksum, threading.Lock())
+
+        # Different sources are transferred concurrently, and concurrent
+        # requests for the same source wait for the first transfer
+        with fetch_lock:
+            with self.lock:
+                source = self.sources.get(checksum)
+                if source is not None:
+                    return source
+
+            try:
+                with tempfile.TemporaryFile() as fd:
+                    system.transfer_file(src, fd, checksum=checksum)
+                    fd.seek(0)
+                    received = PathObject.compute_file_sha1sum(fd)
+                    if received != checksum:
+                        raise RuntimeError(f"{src!r} has SHA1 {received!r} after receiving it,"
+                                           f" but 'checksum' value is {checksum!r}")
+                    fd.seek(0)
+                    source = fd.read().decode()
+
+                with self.lock:
+                    self.sources[checksum] = source
+                    self.fetches += 1
+            finally:
+                # On failure, waiting requests retry the transfer themselves
+                with self.lock:
+                    self.fetching.pop(checksum, None)
+            return source
+
+
+@builtin.action(name="template")
+@dataclass
+class Template(FileAction):
+    """
+    Similar to Ansible's
+    [builtin.template](https://docs.ansible.com/ansible/latest/collections/ansible/builtin/template_module.html),
+    rendering the template on the target system.
+
+    The template source is transferred once for each system, and cached by
+    checksum, so each action only carries its own ``context``.
+
+    Not yet implemented:
+
+     * backup
+     * force
+     * unsafe_writes
+     * validate
+     * templates including or extending other templates
+    """
+    dest: str = ""
+    src: str = ""
+    context: Dict[str, Any] = field(
+            default_factory=dict, metadata={"doc": "variables used to render the template"})
+    checksum: Optional[str] = None
+    follow: bool = True
+
+    def __post_init__(self):
+        super().__post_init__()
+        if self.dest == "":
+            raise TypeError(f"{self.__class__}.dest cannot be empty")
+        if self.src == "":
+            raise TypeError(f"{self.__class__}.src cannot be empty")
+
+        if self.checksum is None:
+            self.src = os.path.abspath(self.src)
+            self.checksum = checksums.cache.sha1sum(self.src)
+
+    def summary(self):
+        return f"Render {self.src!r} to {self.dest!r}"
+
+    def list_local_files_needed(self) -> List[str]:
+        res = super().list_local_files_needed()
+        res.append(self.src)
+        return res
+
+    def list_remote_paths(self) -> Optional[List[str]]:
+        return [self.dest]
+
+    def run(self, system: transilience.system.System):
+        super().run(system)
+        cache = system.get_action_cache(Template, TemplateCache)
+        source = cache.get_source(system, self.src, self.checksum)
+        content = cache.engine.render_string(source, self.context).encode()
+
+        path = self.get_path_object(self.dest)
+        if path is not None:
+            # If the file exists with the same contents, don't write it
+            if path.st.st_size == len(content):
+                with open(path.path, "rb") as fd:
+                    if fd.read() == content:
+                        self.set_path_object_permissions(path)
+                        return
+            dest = path.path
+        else:
+            dest = self.dest
+
+        with self.write_file_atomically(dest, "wb") as fd:
+            fd.write(content)
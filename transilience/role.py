@@ -3,6 +3,7 @@ from typing import TYPE_CHECKING, Sequence, Optional, List, Union, Callable, Typ
 import contextlib
 import warnings
 import uuid
+import os
 from . import actions
 from .system import PipelineInfo
 
@@ -14,6 +15,17 @@ if TYPE_CHECKING:
 ChainedMethod = Callable[[actions.Action], None]
 
 
+def paths_overlap(a: str, b: str) -> bool:
+    """
+    Check if two paths are the same, or one contains the other
+    """
+    if a == b:
+        return True
+    if len(a) > len(b):
+        a, b = b, a
+    return b.startswith(a.rstrip("/") + "/")
+
+
 class PendingAction:
     def __init__(
             self,
@@ -54,8 +66,17 @@ class Role:
     system.
 
     The main point of a Role is to enqueue actions to be executed on a System,
-    and possibly enqueue some more based on their results
+    and possibly enqueue some more based on their results.
+
+    By default, the actions of a role are executed in the order they are
+    enqueued. If ``dag`` is set to True in a Role subclass, actions are
+    instead sent with the list of previous actions they depend on, and systems
+    that support it can execute independent actions concurrently. See task()
+    for how dependencies are computed.
     """
+    # Send actions with their dependencies instead of executing them in order
+    dag: bool = False
+
     def __init__(self):
         # Unique identifier for this role
         self.uuid: str = str(uuid.uuid4())
@@ -65,6 +86,14 @@ class Role:
         self.pending: Set[str] = set()
         self.extra_when: Dict[Union[actions.Action, PendingAction], Union[str, List[str]]] = {}
         self.extra_notify: List[Type["Role"]] = []
+        # Dependency tracking for dag mode:
+        # uuid of the last action that could affect anything
+        self.dag_barrier: Optional[str] = None
+        # uuids of the actions enqueued after dag_barrier
+        self.dag_since_barrier: List[str] = []
+        # uuid of the last action after dag_barrier that used a remote path,
+        # indexed by path
+        self.dag_paths: Dict[str, str] = {}
 
     @contextlib.contextmanager
     def when(self, when: Dict[Union[actions.Action, PendingAction], Union[str, List[str]]]):
@@ -101,9 +130,17 @@ class Role:
             action: actions.Action,
             notify: Union[None, Type["Role"], Sequence[Type["Role"]]] = None,
             when: Optional[Dict[Union[actions.Action, PendingAction], Union[str, List[str]]]] = None,
+            after: Optional[Sequence[Union[actions.Action, PendingAction]]] = None,
             **kw):
         """
-        Enqueue an action for execution
+        Enqueue an action for execution.
+
+        In dag mode, the action depends on the actions listed in ``after``
+        and ``when``, on previous actions that use overlapping remote paths,
+        and on the last previous action with unknown remote paths. An action
+        with unknown remote paths depends on all the previous actions.
+        Outside of dag mode, ``after`` is ignored, since actions are always
+        executed in order
         """
         clean_notify: List[Type[Role]] = [] + self.extra_notify
         if notify is None:
@@ -137,11 +174,48 @@ class Role:
                 pipe_when[a.uuid] = s
             pipeline_info.when = pipe_when
 
+        if self.dag:
+            pipeline_info.after = self.dag_dependencies(action, after, pipeline_info.when)
+
         # File the action for execution
         self.runner.system.send_pipelined(action, pipeline_info)
 
         return pa
 
+    def dag_dependencies(
+            self, action: actions.Action,
+            after: Optional[Sequence[Union[actions.Action, PendingAction]]],
+            when: Dict[str, List[str]]) -> List[str]:
+        """
+        Compute the uuids of the actions that action depends on, and record
+        it for computing the dependencies of the next actions
+        """
+        deps: Set[str] = set(when)
+        if after is not None:
+            deps.update(a.uuid for a in after)
+        if self.dag_barrier is not None:
+            deps.add(self.dag_barrier)
+
+        paths = action.list_remote_paths()
+        if paths is None:
+            # The action can affect anything: it depends on all the previous
+            # actions, and all the next actions depend on it
+            deps.update(self.dag_since_barrier)
+            self.dag_barrier = action.uuid
+            self.dag_since_barrier = []
+            self.dag_paths = {}
+        else:
+            paths = [os.path.normpath(p) for p in paths]
+            for path, act_uuid in self.dag_paths.items():
+                if any(paths_overlap(path, p) for p in paths):
+                    deps.add(act_uuid)
+            for path in paths:
+                self.dag_paths[path] = action.uuid
+            self.dag_since_barrier.append(action.uuid)
+
+        deps.discard(action.uuid)
+        return sorted(deps)
+
     def add(self, *args, **kw):
         warnings.warn("Role.add() has been renamed to Role.task()", DeprecationWarning)
         return self.task(*args, **kw)
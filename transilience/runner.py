@@ -1,14 +1,20 @@
 from __future__ import annotations
-from typing import TYPE_CHECKING, Dict, Set, Union, Type
+from typing import TYPE_CHECKING, Dict, Set, Union, Type, Optional, Any, Callable
+from dataclasses import dataclass, field
+import concurrent.futures
+import collections
 import importlib
 import logging
+import time
 import sys
 from . import template
+from .utils import checksums
 from .role import PendingAction
 from .system.local import Local
 from .actions import builtin, ResultState
 
 if TYPE_CHECKING:
+    import mitogen.master
     from .role import Role
     from .actions import Namespace
     from .system import System
@@ -60,11 +66,23 @@ class Script:
 
 
 class Runner:
-    def __init__(self, system):
-        self.template_engine = template.Engine()
+    def __init__(
+            self,
+            system: System,
+            name: Optional[str] = None,
+            template_engine: Optional[template.Engine] = None):
+        if template_engine is None:
+            template_engine = template.Engine()
+        self.template_engine = template_engine
         self.system = system
+        # Name of the system, used in log messages
+        self.name = name
         self.pending: Dict[str, PendingAction] = {}
         self.notified: Set[str] = set()
+        # Count of executed actions, indexed by ResultState
+        self.stats: Dict[str, int] = collections.Counter()
+        # Names of the roles added, indexed by their pipeline id
+        self.role_names: Dict[str, str] = {}
 
     def add_pending_action(self, pa: PendingAction):
         # Add to pending queues
@@ -82,7 +100,12 @@ class Runner:
                 changed = "skipped"
             else:
                 changed = "noop"
-            log.info("%s", f"[{changed} {act.result.elapsed/1000000000:.3f}s] {pending.role.name} {pending.summary}")
+            self.stats[act.result.state] += 1
+            if self.name is None:
+                log.info("%s", f"[{changed} {act.result.elapsed/1000000000:.3f}s] {pending.role.name} {pending.summary}")
+            else:
+                log.info("%s", f"[{changed} {act.result.elapsed/1000000000:.3f}s] {self.name}: {pending.role.name}"
+                               f" {pending.summary}")
 
             pending.role.on_action_executed(pending, act)
 
@@ -95,12 +118,33 @@ class Runner:
             name = role_cls.__name__
             role = role_cls(**kw)
         role.name = name
+        self.role_names[role.uuid] = name
         role.set_runner(self)
         role.main()
 
+    def check_deferred(self):
+        """
+        Report failures of the work deferred by roles, like reloading
+        services, which runs when a role is done.
+
+        Raises RuntimeError if any failed
+        """
+        failures = self.system.pop_deferred_failures()
+        for pipeline_id, error in failures:
+            role = self.role_names.get(pipeline_id, pipeline_id)
+            if self.name is None:
+                log.error("%s", f"[failed] {role} deferred work: {error}")
+            else:
+                log.error("%s", f"[failed] {self.name}: {role} deferred work: {error}")
+        if failures:
+            raise RuntimeError(f"deferred work of {len(failures)} roles failed")
+
     def main(self):
         """
-        Run until all roles are done
+        Run until all roles are done.
+
+        Failures of work deferred by roles do not stop the others, and are
+        raised as RuntimeError at the end
         """
         while True:
             self.receive()
@@ -113,6 +157,15 @@ class Runner:
             for role in todo:
                 self.add_role(role)
 
+        stats = self.template_engine.stats()
+        log.debug("%stemplates: %d hits, %d misses, bytecode cache %d hits, %d misses,"
+                  " %.1fms compiling strings, %.1fms loading files",
+                  "" if self.name is None else f"{self.name}: ",
+                  stats["hits"], stats["misses"], stats["bytecode_hits"], stats["bytecode_misses"],
+                  stats["compile_ms"], stats["load_ms"])
+
+        self.check_deferred()
+
     @classmethod
     def cli(cls, main):
         def wrapped():
@@ -127,6 +180,10 @@ class Runner:
                                 help="verbose output")
             parser.add_argument("--debug", action="store_true",
                                 help="verbose output")
+            parser.add_argument("--checksum-cache", metavar="file", action="store",
+                                help="file used to cache checksums of local files across runs")
+            parser.add_argument("--template-cache", metavar="dir", action="store",
+                                help="directory used to cache compiled templates across runs")
             args = parser.parse_args()
 
             FORMAT = "%(asctime)-15s %(levelname)s %(name)s %(message)s"
@@ -154,9 +211,120 @@ class Runner:
             log.setLevel(logging.INFO)
 
             # TODO: add options for specifying remote systems, and pass a
-            # system to main
-            # TODO: work on multiple systems by starting a thread per system
-            # and running main in each thread
-            main()
+            # system to main. FleetRunner can be used in main to work on
+            # multiple systems at the same time
+            if args.checksum_cache:
+                checksums.cache.load(args.checksum_cache)
+            if args.template_cache:
+                template.default_bytecode_cache_dir = args.template_cache
+            try:
+                return main()
+            finally:
+                checksums.cache.save()
+                log.debug("checksum cache: %d hits, %d misses", checksums.cache.hits, checksums.cache.misses)
 
         return wrapped
+
+
+@dataclass
+class HostResult:
+    """
+    Results of provisioning one host with a FleetRunner
+    """
+    name: str
+    # Count of executed actions, indexed by ResultState
+    stats: Dict[str, int] = field(default_factory=dict)
+    # Exception that stopped provisioning, if any
+    error: Optional[BaseException] = None
+    # Elapsed time in seconds
+    elapsed: float = 0.0
+
+    @property
+    def failed(self) -> bool:
+        return self.error is not None
+
+
+class FleetRunner:
+    """
+    Run the same roles on multiple hosts, working on up to ``max_workers``
+    hosts at the same time.
+
+    ``hosts`` maps host names to the arguments used to create their Mitogen
+    systems: ``method`` is the Mitogen connection method, and all other
+    arguments are forwarded to it.
+
+    All systems share the same Mitogen router and template engine, which is
+    ``template_engine`` if given, or a new one.
+    """
+    def __init__(
+            self,
+            hosts: Dict[str, Dict[str, Any]],
+            max_workers: int = 16,
+            router: Optional[mitogen.master.Router] = None,
+            template_engine: Optional[template.Engine] = None):
+        self.hosts = hosts
+        self.max_workers = max_workers
+        self.router = router
+        self.broker: Optional[mitogen.master.Broker] = None
+        if template_engine is None:
+            template_engine = template.Engine()
+        self.template_engine = template_engine
+
+    def run_host(self, name: str, setup: Callable[[Runner], None]) -> HostResult:
+        """
+        Provision one host, calling setup to add roles to its Runner
+        """
+        from .system.mitogen import Mitogen
+
+        res = HostResult(name=name)
+        start = time.perf_counter()
+        kw = dict(self.hosts[name])
+        method = kw.pop("method")
+        runner = None
+        try:
+            system = Mitogen(name, method, router=self.router, **kw)
+            try:
+                runner = Runner(system, name=name, template_engine=self.template_engine)
+                setup(runner)
+                runner.main()
+            finally:
+                system.close()
+        except Exception as e:
+            log.error("%s: provisioning failed: %s", name, e)
+            res.error = e
+        if runner is not None:
+            res.stats = dict(runner.stats)
+        res.elapsed = time.perf_counter() - start
+        return res
+
+    def run(self, setup: Callable[[Runner], None]) -> Dict[str, HostResult]:
+        """
+        Provision all hosts, calling setup to add roles to each Runner.
+
+        A failure on a host does not stop provisioning the others.
+
+        Returns the results for each host, indexed by host name
+        """
+        import mitogen.master
+
+        if self.router is None:
+            self.broker = mitogen.master.Broker()
+            self.router = mitogen.master.Router(self.broker)
+
+        results: Dict[str, HostResult] = {}
+        try:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+                futures = {executor.submit(self.run_host, name, setup): name for name in self.hosts}
+                for future in concurrent.futures.as_completed(futures):
+                    res = future.result()
+                    results[res.name] = res
+        finally:
+            if self.broker is not None:
+                self.broker.shutdown()
+                self.broker.join()
+                self.broker = None
+                self.router = None
+
+        failed = sum(1 for r in results.values() if r.failed)
+        log.info("%s", f"[fleet] {len(results) - failed} hosts provisioned, {failed} failed")
+        return results
@@ -0,0 +1,139 @@
+from __future__ import annotations
+from typing import BinaryIO, Optional
+import tempfile
+import hashlib
+import logging
+import shutil
+import fcntl
+import os
+
+log = logging.getLogger(__name__)
+
+# ioctl to share the data blocks of a file with another file, on filesystems
+# that support it (from linux/fs.h)
+FICLONE = 0x40049409
+
+
+def clone_file(src: BinaryIO, dst: BinaryIO):
+    """
+    Copy the whole contents of src to the empty file dst, sharing the data
+    blocks if the file system supports it
+    """
+    src.seek(0)
+    try:
+        fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+        dst.seek(0, os.SEEK_END)
+        return
+    except OSError:
+        pass
+    shutil.copyfileobj(src, dst)
+
+
+class FileStore:
+    """
+    Content-addressed store of files, indexed by SHA1 checksum.
+
+    Each time a file is added, the least recently used files are removed to
+    keep the total size of the store below ``max_size`` bytes
+    """
+    def __init__(self, path: str, max_size: int = 1024 ** 3):
+        self.path = path
+        self.max_size = max_size
+        os.makedirs(self.path, mode=0o700, exist_ok=True)
+        # Number of lookups found in the store
+        self.hits = 0
+        # Number of lookups not found in the store
+        self.misses = 0
+
+    def _entry_path(self, checksum: str) -> str:
+        if len(checksum) != 40 or any(c not in "0123456789abcdef" for c in checksum):
+            raise ValueError(f"{checksum!r} is not a valid SHA1 checksum")
+        return os.path.join(self.path, checksum)
+
+    def get(self, checksum: str, dst: BinaryIO) -> bool:
+        """
+        Write the file with the given checksum to dst.
+
+        Returns False if the file is not in the store
+        """
+        path = self._entry_path(checksum)
+        try:
+            fd = open(path, "rb")
+        except FileNotFoundError:
+            self.misses += 1
+            return False
+
+        with fd:
+            clone_file(fd, dst)
+        # Mark the entry as recently used
+        os.utime(path)
+        self.hits += 1
+        log.info("%s: found in file store", checksum)
+        return True
+
+    def add(self, checksum: str, src: BinaryIO) -> bool:
+        """
+        Add the contents of src to the store, reading it from the beginning.
+
+        The contents are added only if their checksum matches ``checksum``.
+        Returns True if the file has been added
+        """
+        path = self._entry_path(checksum)
+        if os.path.exists(path):
+            return True
+
+        fd, tmppath = tempfile.mkstemp(dir=self.path, prefix=".tmp")
+        try:
+            with open(fd, "w+b", closefd=True) as outfd:
+                clone_file(src, outfd)
+                outfd.seek(0)
+                h = hashlib.sha1()
+                while True:
+                    buf = outfd.read(40960)
+                    if not buf:
+                        break
+                    h.update(buf)
+                if h.hexdigest() != checksum:
+                    log.warning("%s: not adding to file store: contents have SHA1 %s", checksum, h.hexdigest())
+                    os.unlink(tmppath)
+                    return False
+                os.fchmod(outfd.fileno(), 0o400)
+            os.rename(tmppath, path)
+        except Exception:
+            os.unlink(tmppath)
+            raise
+
+        self.evict()
+        return True
+
+    def evict(self, keep: Optional[int] = None):
+        """
+        Remove the least recently used files until the store takes up at
+        most ``keep`` bytes, defaulting to max_size
+        """
+        if keep is None:
+            keep = self.max_size
+
+        entries = []
+        total = 0
+        with os.scandir(self.path) as it:
+            for de in it:
+                if de.name.startswith("."):
+                    continue
+                st = de.stat(follow_symlinks=False)
+                entries.append((st.st_mtime_ns, st.st_size, de.path))
+                total += st.st_size
+
+        if total <= keep:
+            return
+
+        entries.sort()
+        for mtime, size, path in entries:
+            if total <= keep:
+                break
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+            log.info("%s: removed from file store", os.path.basename(path))
@@ -13,6 +13,7 @@ class LocalExecuteMixin:
     System implementation to execute actions locally
     """
     def execute(self, action: actions.Action) -> actions.Action:
+        self.action_started([action])
         with action.result.collect():
             action.run(self)
         return action
@@ -20,10 +21,15 @@ class LocalExecuteMixin:
 
 class Local(LocalExecuteMixin, LocalPipelineMixin, System):
     """
-    Work on the local system
+    Work on the local system.
+
+    If ``dpkg_status_snapshot`` is True, Apt actions persist the parsed dpkg
+    status in ``/var/cache/transilience``, and later runs reuse it until the
+    status file changes
     """
-    def __init__(self):
+    def __init__(self, dpkg_status_snapshot: bool = False):
         super().__init__()
+        self.dpkg_status_snapshot = dpkg_status_snapshot
         self.pending_actions = collections.deque()
 
     def transfer_file(self, src: str, dst: BinaryIO, **kw):
@@ -39,8 +45,9 @@ class Local(LocalExecuteMixin, LocalPipelineMixin, System):
         Run a sequence of provisioning actions in the chroot
         """
         pipeline = PipelineInfo(str(uuid.uuid4()))
-        for act in action_list:
-            yield self.execute_pipelined(act, pipeline)
+        yield from self.execute_pipelined_queue(collections.deque((act, pipeline) for act in action_list))
+        self.pipeline_close(pipeline.id)
+        self.raise_deferred_failures()
 
     def send_pipelined(self, action: actions.Action, pipeline_info: PipelineInfo):
         """
@@ -54,5 +61,4 @@ class Local(LocalExecuteMixin, LocalPipelineMixin, System):
 
         It is ok to enqueue new actions while this method runs
         """
-        while self.pending_actions:
-            yield self.execute_pipelined(*self.pending_actions.popleft())
+        yield from self.execute_pipelined_queue(self.pending_actions)
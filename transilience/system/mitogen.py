@@ -1,9 +1,13 @@
 from __future__ import annotations
-from typing import Dict, Optional, Sequence, Generator, Any, BinaryIO
+from typing import Dict, Optional, Sequence, Generator, Any, BinaryIO, Deque, Iterator, List, Tuple, Union
 import collections
+import functools
 import threading
 import logging
+import weakref
+import time
 import uuid
+import os
 try:
     import mitogen
     import mitogen.core
@@ -14,14 +18,26 @@ except ModuleNotFoundError:
     mitogen = None
 from .. import actions
 from .system import System, PipelineInfo
-from .pipeline import LocalPipelineMixin
+from .pipeline import LocalPipelineMixin, PipelineExecutor
 from .local import LocalExecuteMixin
+from .wire import CompactCodec
+from .filestore import FileStore
+from ..utils import delta, compression
 
 log = logging.getLogger(__name__)
 
+# An action serialized for sending to a remote system: either a dict from
+# Action.serialize(), or a tuple from CompactCodec
+Payload = Union[Dict[str, Any], Tuple]
+
 _this_system_lock = threading.Lock()
 _this_system = None
 
+# Mitogen allows only one service pool per router: systems sharing a router
+# also share its services and service pool
+_router_services_lock = threading.Lock()
+_router_services: weakref.WeakKeyDictionary = weakref.WeakKeyDictionary()
+
 
 if mitogen is None:
 
@@ -31,16 +47,292 @@ if mitogen is None:
 
 else:
 
+    class TransferService(mitogen.service.Service):
+        """
+        Send registered files in ways that need less bandwidth than
+        FileService: compressed, or as differences from a different version
+        of the file held by the requestee.
+
+        Paths must be registered before they can be served.
+
+        Each transfer runs in its own thread, to leave the service pool free
+        for other requests. Like FileService, it sends at most
+        ``window_size`` messages ahead of those acknowledged by the requestee,
+        to keep the data queued in memory bounded.
+        """
+        # Number of messages, of about 128KiB each, sent ahead of the
+        # acknowledged ones
+        window_size = 8
+
+        # Seconds to wait for an acknowledgement before giving up a transfer
+        ack_timeout = 300.0
+
+        def __init__(self, router: mitogen.core.Router):
+            super().__init__(router)
+            self._paths = set()
+            self._prefixes = set()
+
+        def register(self, path: str):
+            self._paths.add(path)
+
+        def register_prefix(self, path: str):
+            self._prefixes.add(path.rstrip(os.sep) + os.sep)
+
+        def is_registered(self, path: str) -> bool:
+            if path in self._paths:
+                return True
+            return any(path.startswith(prefix) for prefix in self._prefixes)
+
+        def _start_transfer(
+                self, fd: BinaryIO, chunks: Iterator[Any], metadata: Dict[str, Any],
+                sender: mitogen.core.Sender, msg: mitogen.core.Message):
+            """
+            Reply to ``msg`` with ``metadata`` and a sender for
+            acknowledgements, then send ``chunks`` to ``sender`` in a new
+            thread, closing ``fd`` at the end
+            """
+            acks = mitogen.core.Receiver(self.router, respondent=sender.context)
+            metadata["ack"] = acks.to_sender()
+            msg.reply(metadata)
+            threading.Thread(
+                    target=self._send_chunks, args=(fd, chunks, sender, acks),
+                    name=f"transfer-{sender.context.context_id}", daemon=True).start()
+
+        def _send_chunks(
+                self, fd: BinaryIO, chunks: Iterator[Any],
+                sender: mitogen.core.Sender, acks: mitogen.core.Receiver):
+            unacked = 0
+            try:
+                with fd:
+                    for chunk in chunks:
+                        sender.send(chunk)
+                        unacked += 1
+                        while unacked >= self.window_size:
+                            acks.get(timeout=self.ack_timeout)
+                            unacked -= 1
+                sender.close()
+                # Wait for the requestee to acknowledge everything and close
+                # its side, so that no acknowledgement is left undelivered
+                while True:
+                    acks.get(timeout=self.ack_timeout)
+            except mitogen.core.ChannelError:
+                pass
+            except Exception:
+                log.exception("%s: transfer to context %d failed", fd.name, sender.context.context_id)
+            finally:
+                sender.close()
+                acks.close()
+
+        @mitogen.service.expose(policy=mitogen.service.AllowAny())
+        @mitogen.service.no_reply()
+        def fetch_delta(
+                self, path: str, block_size: int, signatures: delta.Signatures,
+                sender: mitogen.core.Sender, msg: mitogen.core.Message):
+            """
+            Reply with the size of ``path``, then send to ``sender`` lists of
+            delta operations that rebuild it from a basis with the given
+            block signatures
+            """
+            if not self.is_registered(path):
+                msg.reply(mitogen.core.CallError(f"{path!r} has not been registered for transfer"))
+                return
+            if msg.src_id != sender.context.context_id:
+                msg.reply(mitogen.core.CallError("sender does not belong to the requesting context"))
+                return
+
+            try:
+                fd = open(path, "rb")
+            except OSError as e:
+                msg.reply(mitogen.core.CallError(e))
+                return
+
+            def chunks():
+                ops: List[delta.DeltaOp] = []
+                queued = 0
+                for op in delta.compute_delta(fd, signatures, block_size):
+                    ops.append(op)
+                    queued += 4 if isinstance(op, int) else len(op)
+                    if queued >= delta.MAX_LITERAL:
+                        yield ops
+                        ops = []
+                        queued = 0
+                if ops:
+                    yield ops
+
+            self._start_transfer(fd, chunks(), {"size": os.fstat(fd.fileno()).st_size}, sender, msg)
+
+        @mitogen.service.expose(policy=mitogen.service.AllowAny())
+        @mitogen.service.no_reply()
+        def fetch_compressed(self, path: str, sender: mitogen.core.Sender, msg: mitogen.core.Message):
+            """
+            Reply with the size of ``path`` and the compression method chosen
+            for it, then send its compressed contents to ``sender``
+            """
+            if not self.is_registered(path):
+                msg.reply(mitogen.core.CallError(f"{path!r} has not been registered for transfer"))
+                return
+            if msg.src_id != sender.context.context_id:
+                msg.reply(mitogen.core.CallError("sender does not belong to the requesting context"))
+                return
+
+            try:
+                fd = open(path, "rb")
+            except OSError as e:
+                msg.reply(mitogen.core.CallError(e))
+                return
+
+            size = os.fstat(fd.fileno()).st_size
+            method = compression.choose_method(path, size)
+            chunks = (mitogen.core.Blob(chunk) for chunk in compression.compress(fd, method))
+            self._start_transfer(fd, chunks, {"size": size, "method": method}, sender, msg)
+
     class LocalMitogen(LocalExecuteMixin, LocalPipelineMixin, System):
         def __init__(self, parent_context: mitogen.core.Context, router: mitogen.core.Router):
             super().__init__()
             self.parent_context = parent_context
             self.router = router
+            self.codec = CompactCodec()
+            self.file_store: Optional[FileStore] = None
+            self.delta_min_size: Optional[int] = None
+            self.transfer_compression = False
+            # Executor running batched actions of different pipelines
+            # concurrently, or None to run them in order
+            self.executor: Optional[PipelineExecutor] = None
+            # Serializes encoding and sending results from concurrent actions
+            self.send_lock = threading.Lock()
+
+        def configure(
+                self,
+                file_store: Optional[str] = None, file_store_size: Optional[int] = None,
+                delta_min_size: Optional[int] = None, transfer_compression: bool = False,
+                concurrency: Optional[int] = None, dpkg_status_snapshot: bool = False):
+            """
+            Set options sent by the controller
+            """
+            if file_store is not None:
+                self.file_store = FileStore(file_store, max_size=file_store_size)
+            if concurrency is not None and self.executor is None:
+                self.executor = PipelineExecutor(max_workers=concurrency)
+            self.delta_min_size = delta_min_size
+            self.transfer_compression = transfer_compression
+            self.dpkg_status_snapshot = dpkg_status_snapshot
+
+        def transfer_file_delta(self, src: str, dst: BinaryIO, basis: str):
+            """
+            Fetch file ``src`` from the controller, transferring only the parts
+            that differ from the local file ``basis``
+            """
+            size = os.path.getsize(basis)
+            block_size = delta.choose_block_size(size)
+            with open(basis, "rb") as basis_fd:
+                signatures = delta.block_signatures(basis_fd, block_size)
+
+                recv = mitogen.core.Receiver(router=self.router)
+                metadata = self.parent_context.call_service(
+                    service_name=TransferService.name(),
+                    method_name="fetch_delta",
+                    path=src,
+                    block_size=block_size,
+                    signatures=signatures,
+                    sender=recv.to_sender(),
+                )
 
-        def transfer_file(self, src: str, dst: BinaryIO, **kw):
+                written = 0
+                literal = 0
+                try:
+                    for ops in self._receive_chunks(recv, metadata["ack"]):
+                        literal += sum(len(op) for op in ops if not isinstance(op, int))
+                        written += delta.apply_delta(basis_fd, ops, dst, block_size)
+                finally:
+                    metadata["ack"].close()
+
+            if written != metadata["size"]:
+                raise IOError(f"Transfer of {src!r} was interrupted")
+            log.info("%s: transferred %d bytes out of %d using delta transfer", src, literal, written)
+
+        def transfer_file(
+                self, src: str, dst: BinaryIO,
+                checksum: Optional[str] = None, basis: Optional[str] = None, **kw):
             """
             Fetch file ``src`` from the controller and write it to the open
             file descriptor ``dst``.
+
+            If a file store is configured and ``checksum`` is given, the
+            contents are taken from the file store when available, and added
+            to it after transferring them otherwise.
+
+            If delta transfers are enabled and ``basis`` is the path to a
+            large enough local file, only the differences between ``src`` and
+            ``basis`` are transferred.
+
+            If transfer compression is enabled, files are otherwise
+            transferred compressed.
+            """
+            if self.file_store is not None and checksum is not None:
+                if self.file_store.get(checksum, dst):
+                    return
+
+            if (basis is not None and self.delta_min_size is not None
+                    and os.path.getsize(basis) >= self.delta_min_size):
+                self.transfer_file_delta(src, dst, basis)
+            elif self.transfer_compression:
+                self.transfer_file_compressed(src, dst)
+            else:
+                self.transfer_file_full(src, dst)
+
+            if self.file_store is not None and checksum is not None:
+                dst.flush()
+                self.file_store.add(checksum, dst)
+
+        def _receive_chunks(self, recv: mitogen.core.Receiver, ack: mitogen.core.Sender) -> Iterator[Any]:
+            """
+            Generate the messages sent by TransferService to ``recv``,
+            acknowledging each one after it has been processed.
+
+            ``ack`` needs to be closed at the end of the transfer
+            """
+            for msg in recv:
+                yield msg.unpickle()
+                ack.send(None)
+
+        def transfer_file_compressed(self, src: str, dst: BinaryIO):
+            """
+            Fetch file ``src`` from the controller, decompressing it while
+            it is written to ``dst``
+            """
+            recv = mitogen.core.Receiver(router=self.router)
+            metadata = self.parent_context.call_service(
+                service_name=TransferService.name(),
+                method_name="fetch_compressed",
+                path=src,
+                sender=recv.to_sender(),
+            )
+
+            received = 0
+            written = 0
+
+            def chunks():
+                nonlocal received
+                for chunk in self._receive_chunks(recv, metadata["ack"]):
+                    received += len(chunk)
+                    yield chunk
+
+            try:
+                for buf in compression.decompress(chunks(), metadata["method"]):
+                    dst.write(buf)
+                    written += len(buf)
+            finally:
+                metadata["ack"].close()
+
+            if written != metadata["size"]:
+                raise IOError(f"Transfer of {src!r} was interrupted")
+            if metadata["method"] is not None:
+                log.info("%s: transferred %d bytes as %d bytes compressed with %s",
+                         src, written, received, metadata["method"])
+
+        def transfer_file_full(self, src: str, dst: BinaryIO):
+            """
+            Fetch the whole file ``src`` from the controller
             """
             ok, metadata = mitogen.service.FileService.get(
                 context=self.parent_context,
@@ -50,23 +342,138 @@ else:
             if not ok:
                 raise IOError(f'Transfer of {src!r} was interrupted')
 
+        def decode_payload(self, payload: Payload) -> Tuple[actions.Action, Optional[PipelineInfo]]:
+            """
+            Deserialize an action and its pipeline metadata.
+
+            Payloads need to be decoded in the order they were sent
+            """
+            if isinstance(payload, dict):
+                payload = self.codec.decode_serialized(payload)
+                pipeline_info = payload.pop("__pipeline__", None)
+                action = actions.Action.deserialize(payload)
+                if pipeline_info is not None:
+                    pipeline_info = PipelineInfo.deserialize(pipeline_info)
+            else:
+                action = self.codec.decode(payload[0])
+                pipeline_info = self.codec.decode_pipeline_info(payload[1])
+            return action, pipeline_info
+
+        def encode_result(self, action: actions.Action, compact: bool) -> Payload:
+            """
+            Serialize an executed action to send it back to the controller.
+
+            Results need to be sent in the order they were encoded
+            """
+            if compact:
+                return self.codec.encode(action)
+            else:
+                return self.codec.encode_serialized(action.serialize())
+
+        def run_serialized(self, payload: Payload) -> Payload:
+            """
+            Run a serialized action, optionally as part of a pipeline, and
+            return the serialized action with its results.
+
+            The results are serialized in the same format as the action
+            """
+            action, pipeline_info = self.decode_payload(payload)
+
+            if pipeline_info is None:
+                action = self.execute(action)
+            else:
+                action = self.execute_pipelined(action, pipeline_info)
+
+            return self.encode_result(action, compact=not isinstance(payload, dict))
+
+        def run_and_send(
+                self, action: actions.Action, pipeline_info: PipelineInfo, compact: bool,
+                sender: mitogen.core.Sender):
+            """
+            Run a decoded pipelined action, and send its serialized result to
+            ``sender``, or a CallError if it failed
+            """
+            try:
+                action = self.execute_pipelined(action, pipeline_info)
+                with self.send_lock:
+                    sender.send(self.encode_result(action, compact))
+            except Exception as e:
+                sender.send(mitogen.core.CallError(e))
+
     class Mitogen(System):
         """
-        Access a system via Mitogen
+        Access a system via Mitogen.
+
+        By default, each pipelined action is sent as a separate remote call.
+
+        If ``batch_size`` is set, pipelined actions are instead queued and sent
+        in batches of up to ``batch_size`` actions, which are executed in order
+        by a single remote call. Results are streamed back as soon as each
+        action has been executed. A batch is also sent when an action is queued
+        more than ``batch_latency`` seconds after the oldest one in the batch.
+        There is no timer: queued actions are otherwise sent before waiting for
+        any result, so they are never kept waiting by a blocked controller.
+
+        If ``compact`` is True, actions are sent using the compact
+        serialization of CompactCodec instead of Action.serialize(). With
+        either serialization, str and bytes values of at least
+        ``wire.CONTENT_REF_MIN_SIZE``, like the contents of Copy actions, are
+        sent in full only the first time, and by reference afterwards.
+
+        If ``file_store`` is set, it is the path of a directory on the remote
+        system used to keep transferred files indexed by checksum, so that
+        they are not transferred again. It is kept within
+        ``file_store_size`` bytes by removing the least recently used files.
+
+        If ``delta_min_size`` is set, replacing an existing file of at least
+        that size transfers only the parts of the new file that differ from
+        it, using an rsync-style rolling checksum.
+
+        If ``transfer_compression`` is True, other file transfers are
+        compressed on the controller and decompressed while they are written
+        on the remote system. The compression method is chosen for each file
+        according to its size and name.
+
+        If ``concurrency`` is set, batched actions from different pipelines
+        are executed concurrently on the remote system, by up to
+        ``concurrency`` threads. Actions of the same pipeline are still
+        executed in order, and results are received in the order actions
+        complete. It requires ``batch_size`` to be set.
+
+        If ``dpkg_status_snapshot`` is True, Apt actions persist the parsed
+        dpkg status in ``/var/cache/transilience`` on the remote system, and
+        later connections reuse it until the status file changes.
         """
         internal_broker = None
         internal_router = None
 
-        def __init__(self, name: str, method: str, router: Optional[mitogen.master.Router] = None, **kw):
+        def __init__(
+                self, name: str, method: str, router: Optional[mitogen.master.Router] = None,
+                batch_size: Optional[int] = None, batch_latency: float = 0.1,
+                compact: bool = False,
+                file_store: Optional[str] = None, file_store_size: int = 1024 ** 3,
+                delta_min_size: Optional[int] = None,
+                transfer_compression: bool = False,
+                concurrency: Optional[int] = None,
+                dpkg_status_snapshot: bool = False,
+                **kw):
             super().__init__()
+            if concurrency is not None and batch_size is None:
+                raise ValueError("concurrency requires batch_size to be set")
             if router is None:
                 if self.internal_router is None:
                     self.internal_broker = mitogen.master.Broker()
                     self.internal_router = mitogen.master.Router(self.internal_broker)
                 router = self.internal_router
             self.router = router
-            self.file_service = mitogen.service.FileService(router)
-            self.pool = mitogen.service.Pool(router=self.router, services=[self.file_service])
+            with _router_services_lock:
+                services = _router_services.get(router)
+                if services is None:
+                    file_service = mitogen.service.FileService(router)
+                    transfer_service = TransferService(router)
+                    pool = mitogen.service.Pool(router=router, services=[file_service, transfer_service])
+                    services = _router_services[router] = (file_service, transfer_service, pool)
+            self.file_service, self.transfer_service, self.pool = services
 
             meth = getattr(self.router, method, None)
             if meth is None:
@@ -75,30 +482,117 @@ else:
             kw.setdefault("python_path", "/usr/bin/python3")
             self.context = meth(remote_name=name, **kw)
 
+            if (file_store is not None or delta_min_size is not None or transfer_compression
+                    or concurrency is not None or dpkg_status_snapshot):
+                self.context.call_no_reply(
+                        self._remote_configure, self.router.myself(), {
+                            "file_store": file_store,
+                            "file_store_size": file_store_size,
+                            "delta_min_size": delta_min_size,
+                            "transfer_compression": transfer_compression,
+                            "concurrency": concurrency,
+                            "dpkg_status_snapshot": dpkg_status_snapshot,
+                        })
+
             self.pending_actions = collections.deque()
 
+            # Use the compact serialization of CompactCodec instead of
+            # Action.serialize()
+            self.compact = compact
+            # Codec used for compact serialization, and to send large values by
+            # reference with either serialization
+            self.codec = CompactCodec()
+
+            # Batched transport
+            self.batch_size = batch_size
+            self.batch_latency = batch_latency
+            # Serialized actions waiting to be sent
+            self.batch: List[Payload] = []
+            # time.monotonic() of when the first action in self.batch was queued
+            self.batch_started: Optional[float] = None
+            # Receiver for results streamed back by batched calls
+            self.batch_results: Optional[mitogen.core.Receiver] = None
+            # Number of batched actions whose results have not been received yet
+            self.batch_pending = 0
+            # Results of pipelined actions received while waiting for a
+            # synchronous call, or the exceptions raised receiving them, to be
+            # returned by receive_pipelined()
+            self.received: Deque[Union[actions.Action, Exception]] = collections.deque()
+
         def close(self):
             self.context.shutdown(wait=True)
 
         def share_file(self, pathname: str):
             self.file_service.register(pathname)
+            self.transfer_service.register(pathname)
 
         def share_file_prefix(self, pathname: str):
             self.file_service.register_prefix(pathname)
+            self.transfer_service.register_prefix(pathname)
+
+        def encode_action(self, action: actions.Action, pipeline_info: Optional[PipelineInfo] = None) -> Payload:
+            """
+            Serialize an action for sending it to the remote system
+            """
+            if not self.compact:
+                serialized = action.serialize()
+                if pipeline_info is not None:
+                    serialized["__pipeline__"] = pipeline_info.serialize()
+                return self.codec.encode_serialized(serialized)
+            else:
+                return (self.codec.encode(action), self.codec.encode_pipeline_info(pipeline_info))
+
+        def decode_action(self, payload: Payload) -> actions.Action:
+            """
+            Deserialize an action received from the remote system
+            """
+            if not self.compact:
+                return actions.Action.deserialize(self.codec.decode_serialized(payload))
+            else:
+                return self.codec.decode(payload)
 
         def execute(self, action: actions.Action) -> actions.Action:
-            res = self.context.call(self._remote_run_actions, self.router.myself(), action.serialize())
-            return actions.Action.deserialize(res)
+            # Keep remote execution in the same order as actions are
+            # submitted, and decode results in the order they were encoded
+            self.drain_pipelined()
+            res = self.context.call(self._remote_run_actions, self.router.myself(), self.encode_action(action))
+            return self.decode_action(res)
 
         def send_pipelined(self, action: actions.Action, pipeline_info: PipelineInfo):
             """
             Execute this action as part of a pipeline
             """
-            serialized = action.serialize()
-            serialized["__pipeline__"] = pipeline_info.serialize()
-            self.pending_actions.append(
-                self.context.call_async(self._remote_run_actions, self.router.myself(), serialized)
-            )
+            serialized = self.encode_action(action, pipeline_info)
+
+            if self.batch_size is None:
+                self.pending_actions.append(
+                    self.context.call_async(self._remote_run_actions, self.router.myself(), serialized)
+                )
+                return
+
+            if not self.batch:
+                self.batch_started = time.monotonic()
+            self.batch.append(serialized)
+            if (len(self.batch) >= self.batch_size
+                    or time.monotonic() - self.batch_started >= self.batch_latency):
+                self.flush_batch()
+
+        def flush_batch(self):
+            """
+            Send all queued actions to the remote system as a single call
+            """
+            if not self.batch:
+                return
+
+            if self.batch_results is None:
+                self.batch_results = mitogen.core.Receiver(self.router, respondent=self.context)
+
+            batch = self.batch
+            self.batch = []
+            self.batch_started = None
+            self.context.call_no_reply(
+                    self._remote_run_batch, self.router.myself(), self.batch_results.to_sender(), batch)
+            self.batch_pending += len(batch)
 
         def receive_pipelined(self) -> Generator[actions.Action, None, None]:
             """
@@ -106,15 +600,74 @@ else:
 
             It is ok to enqueue new actions while this method runs
             """
-            while self.pending_actions:
-                yield actions.Action.deserialize(self.pending_actions.popleft().get().unpickle())
+            while True:
+                if self.received:
+                    res = self.received.popleft()
+                    if isinstance(res, Exception):
+                        raise res
+                    yield res
+                    continue
+
+                res = self.receive_next()
+                if res is None:
+                    break
+                yield res
+
+        def receive_next(self) -> Optional[actions.Action]:
+            """
+            Wait for the result of the next pipelined action, in the order
+            results are sent by the remote system.
+
+            Queued actions are sent before waiting, so that the remote system
+            is never idle, and so that no result waits on an unsent batch.
+
+            Returns None if there are no pending results
+            """
+            self.flush_batch()
+            if self.pending_actions:
+                return self.decode_action(self.pending_actions.popleft().get().unpickle())
+            elif self.batch_pending:
+                self.batch_pending -= 1
+                return self.decode_action(self.batch_results.get().unpickle())
+            else:
+                return None
+
+        def drain_pipelined(self):
+            """
+            Receive the results of all pipelined actions sent or queued so far,
+            and keep them for receive_pipelined().
+
+            Results need to be decoded in the same order as they were
+            encoded: this is called before synchronous calls, whose results
+            would otherwise be decoded before those of earlier actions
+            """
+            while True:
+                try:
+                    res = self.receive_next()
+                except Exception as e:
+                    self.received.append(e)
+                    continue
+                if res is None:
+                    break
+                self.received.append(res)
 
         def pipeline_clear_failed(self, pipeline_id: str):
+            self.flush_batch()
             self.context.call_no_reply(self._pipeline_clear_failed, pipeline_id)
 
         def pipeline_close(self, pipeline_id: str):
+            self.flush_batch()
             self.context.call_no_reply(self._pipeline_close, pipeline_id)
 
+        def pop_deferred_failures(self) -> List[Tuple[str, str]]:
+            """
+            Return and forget the failures of the work deferred by pipelines
+            closed on the remote system, once all actions and pipeline
+            closures sent so far have been processed
+            """
+            self.flush_batch()
+            return self.context.call(self._pop_deferred_failures)
+
         def run_actions(self, action_list: Sequence[actions.Action]) -> Generator[actions.Action, None, None]:
             """
             Run a sequence of provisioning actions in the chroot
@@ -123,6 +676,8 @@ else:
             for act in action_list:
                 self.send_pipelined(act, pipeline)
             yield from self.receive_pipelined()
+            self.pipeline_close(pipeline.id)
+            self.raise_deferred_failures()
 
         @classmethod
         def _pipeline_clear_failed(cls, pipeline_id: str):
@@ -131,7 +686,11 @@ else:
                 if _this_system is None:
                     return
                 system = _this_system
-            system.pipeline_clear_failed(pipeline_id)
+            if system.executor is None:
+                system.pipeline_clear_failed(pipeline_id)
+            else:
+                # Run after the actions already queued for the pipeline
+                system.executor.submit(pipeline_id, functools.partial(system.pipeline_clear_failed, pipeline_id))
 
         @classmethod
         def _pipeline_close(self, pipeline_id: str):
@@ -140,28 +699,112 @@ else:
                 if _this_system is None:
                     return
                 system = _this_system
-            system.pipeline_close(pipeline_id)
+            if system.executor is None:
+                system.pipeline_close(pipeline_id)
+            else:
+                # Run after the actions already queued for the pipeline
+                system.executor.submit(pipeline_id, functools.partial(system.pipeline_close, pipeline_id))
 
         @classmethod
-        @mitogen.core.takes_router
-        def _remote_run_actions(
-                self,
-                context: mitogen.core.Context,
-                action: actions.Action,
-                router: mitogen.core.Router = None) -> Dict[str, Any]:
+        def _pop_deferred_failures(cls) -> List[Tuple[str, str]]:
+            global _this_system, _this_system_lock
+            with _this_system_lock:
+                if _this_system is None:
+                    return []
+                system = _this_system
+            if system.executor is not None:
+                # Wait for the pipeline closures already queued
+                system.executor.join()
+            return system.pop_deferred_failures()
 
+        @classmethod
+        def _get_local_system(cls, context: mitogen.core.Context, router: mitogen.core.Router) -> LocalMitogen:
+            """
+            Return the LocalMitogen system for this remote process, creating it
+            on first use
+            """
             global _this_system, _this_system_lock
             with _this_system_lock:
                 if _this_system is None:
                     _this_system = LocalMitogen(parent_context=context, router=router)
-                system = _this_system
+                return _this_system
 
-            pipeline_info = action.pop("__pipeline__", None)
+        @classmethod
+        @mitogen.core.takes_router
+        def _remote_configure(
+                cls,
+                context: mitogen.core.Context,
+                config: Dict[str, Any],
+                router: mitogen.core.Router = None):
+            system = cls._get_local_system(context, router)
+            system.configure(**config)
 
-            action = actions.Action.deserialize(action)
-            if pipeline_info is None:
-                action = system.execute(action)
-            else:
-                pipeline = PipelineInfo.deserialize(pipeline_info)
-                action = system.execute_pipelined(action, pipeline)
-            return action.serialize()
+        @classmethod
+        @mitogen.core.takes_router
+        def _remote_run_actions(
+                cls,
+                context: mitogen.core.Context,
+                action: Payload,
+                router: mitogen.core.Router = None) -> Payload:
+            system = cls._get_local_system(context, router)
+            if system.executor is not None:
+                # Keep execution in the same order as actions are submitted
+                system.executor.join()
+            return system.run_serialized(action)
+
+        @classmethod
+        @mitogen.core.takes_router
+        def _remote_run_batch(
+                cls,
+                context: mitogen.core.Context,
+                sender: mitogen.core.Sender,
+                batch: List[Payload],
+                router: mitogen.core.Router = None):
+            """
+            Run a batch of serialized actions in order, sending each result to
+            ``sender`` as soon as it is available.
+
+            Exactly one message is sent for each action: if an action fails, a
+            CallError is sent in place of its result.
+
+            Otherwise, consecutive actions that can be merged are executed
+            together.
+
+            If the remote system has a concurrent executor, actions are queued
+            to it, and results are sent as actions complete
+            """
+            system = cls._get_local_system(context, router)
+            if system.executor is not None:
+                for serialized in batch:
+                    compact = not isinstance(serialized, dict)
+                    try:
+                        action, pipeline_info = system.decode_payload(serialized)
+                    except Exception as e:
+                        sender.send(mitogen.core.CallError(e))
+                        continue
+                    system.executor.submit(
+                            pipeline_info.id,
+                            functools.partial(system.run_and_send, action, pipeline_info, compact, sender),
+                            task_id=action.uuid, after=pipeline_info.after)
+                return
+
+            queue: Deque[Tuple[actions.Action, PipelineInfo]] = collections.deque()
+            compact = bool(batch) and not isinstance(batch[0], dict)
+
+            def run_queue():
+                while queue:
+                    try:
+                        for action in system.execute_pipelined_queue(queue):
+                            sender.send(system.encode_result(action, compact))
+                    except Exception as e:
+                        sender.send(mitogen.core.CallError(e))
+
+            for serialized in batch:
+                try:
+                    queue.append(system.decode_payload(serialized))
+                except Exception as e:
+                    # Results are sent in order: run the actions decoded so
+                    # far before reporting the failure
+                    run_queue()
+                    sender.send(mitogen.core.CallError(e))
+            run_queue()
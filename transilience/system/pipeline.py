@@ -1,11 +1,18 @@
 from __future__ import annotations
-from typing import TYPE_CHECKING, Dict
+from typing import TYPE_CHECKING, Callable, Deque, Dict, Generator, List, Optional, Sequence, Set, Tuple
+import concurrent.futures
+import contextlib
+import threading
+import logging
+import time
 
 
 if TYPE_CHECKING:
     from ..actions import Action
     from .system import PipelineInfo
 
+log = logging.getLogger(__name__)
+
 
 class Pipeline:
     """
@@ -24,6 +31,9 @@ class LocalPipelineMixin:
     def __init__(self):
         super().__init__()
         self.pipelines: Dict[str, Pipeline] = {}
+        # uuids of actions whose merged execution failed, which are then
+        # executed on their own
+        self.merge_failed: Set[str] = set()
 
     def get_pipeline(self, pipeline_id: str) -> Pipeline:
         """
@@ -31,8 +41,9 @@ class LocalPipelineMixin:
         """
         res = self.pipelines.get(pipeline_id)
         if res is None:
-            res = Pipeline(pipeline_id)
-            self.pipelines[pipeline_id] = res
+            # Use setdefault, so that pipelines executed concurrently by a
+            # PipelineExecutor never replace each other's state
+            res = self.pipelines.setdefault(pipeline_id, Pipeline(pipeline_id))
         return res
 
     def pipeline_clear_failed(self, pipeline_id: str):
@@ -50,9 +61,30 @@ class LocalPipelineMixin:
         Dicard state about a pipeline.
 
         Call this method to cleanup internal state when a pipeline is done
-        executing
+        executing. This also runs the work deferred by actions of the
+        pipeline. Its failures are logged and kept for
+        pop_deferred_failures(), so that closing a pipeline does not stop the
+        others
         """
         self.pipelines.pop(pipeline_id, None)
+        try:
+            self.run_deferred(pipeline_id=pipeline_id)
+        except Exception as e:
+            log.error("pipeline %s: deferred work failed: %s", pipeline_id, e)
+            with self.deferred_lock:
+                self.deferred_failures.append((pipeline_id, str(e)))
+
+    @contextlib.contextmanager
+    def running_in_pipeline(self, pipeline_id: Optional[str]):
+        """
+        Set the pipeline of the actions run by this thread in this context
+        """
+        previous = self.current_pipeline_id()
+        self.current_pipeline.id = pipeline_id
+        try:
+            yield
+        finally:
+            self.current_pipeline.id = previous
 
     def execute_pipelined(self, action: Action, pipeline_info: PipelineInfo) -> Action:
         """
@@ -81,9 +113,248 @@ class LocalPipelineMixin:
 
         # Execute
         try:
-            act = self.execute(action)
+            with self.running_in_pipeline(pipeline_info.id):
+                act = self.execute(action)
             pipeline.states[act.uuid] = act.result.state
             return act
         except Exception:
             pipeline.failed = True
             raise
+
+    def pipeline_can_merge(self, action: Action, pipeline_info: PipelineInfo, group: Set[str]) -> bool:
+        """
+        Check if a pipelined action would be executed, and can be executed
+        together with the actions whose uuids are in ``group``
+        """
+        if action.uuid in self.merge_failed:
+            return False
+        pipeline = self.get_pipeline(pipeline_info.id)
+        if pipeline.failed:
+            return False
+        for act_uuid, states in pipeline_info.when.items():
+            # The state of actions in the group is not known in advance
+            if act_uuid in group:
+                return False
+            if pipeline.states.get(act_uuid) not in states:
+                return False
+        return True
+
+    def take_merge_group(self, queue: Deque[Tuple[Action, PipelineInfo]]) -> List[Tuple[Action, PipelineInfo]]:
+        """
+        Remove from the beginning of the queue the longest sequence of actions
+        that can be executed together with Action.run_merged().
+
+        The sequence has at least one action
+        """
+        action, pipeline_info = queue.popleft()
+        group = [(action, pipeline_info)]
+        key = action.merge_key()
+        if key is None or not self.pipeline_can_merge(action, pipeline_info, set()):
+            return group
+        action_cls = action.__class__
+        uuids = {action.uuid}
+
+        while queue:
+            action, pipeline_info = queue[0]
+            if (action.__class__ != action_cls or action.merge_key() != key
+                    or not self.pipeline_can_merge(action, pipeline_info, uuids)):
+                break
+            queue.popleft()
+            group.append((action, pipeline_info))
+            uuids.add(action.uuid)
+
+        return group
+
+    def execute_pipelined_merged(self, group: List[Tuple[Action, PipelineInfo]]) -> List[Action]:
+        """
+        Execute a group of pipelined actions returned by take_merge_group()
+        with a single call to Action.run_merged().
+
+        All actions in the group are reported as taking the time of the whole
+        group. If run_merged() raises an exception, the pipelines are left
+        untouched
+        """
+        group_actions = [action for action, pipeline_info in group]
+        self.action_started(group_actions)
+        # Work deferred by actions of different pipelines is not attributed to
+        # either
+        pipeline_ids = {pipeline_info.id for action, pipeline_info in group}
+        start_ns = time.perf_counter_ns()
+        with self.running_in_pipeline(pipeline_ids.pop() if len(pipeline_ids) == 1 else None):
+            group_actions[0].__class__.run_merged(self, group_actions)
+        elapsed = time.perf_counter_ns() - start_ns
+
+        for action, pipeline_info in group:
+            action.result.elapsed = elapsed
+            self.get_pipeline(pipeline_info.id).states[action.uuid] = action.result.state
+        return group_actions
+
+    def execute_pipelined_queue(
+            self, queue: Deque[Tuple[Action, PipelineInfo]]) -> Generator[Action, None, None]:
+        """
+        Execute pipelined actions from the queue until it is empty, generating
+        the executed actions.
+
+        Consecutive actions that can run together are executed with a single
+        call to Action.run_merged(). If that fails, they are executed again
+        one by one, to report the failure on the right action.
+
+        It is ok to enqueue new actions while this method runs. If an action
+        fails, its exception is raised, and the actions following it are left
+        in the queue
+        """
+        while queue:
+            group = self.take_merge_group(queue)
+            if len(group) > 1:
+                try:
+                    executed = self.execute_pipelined_merged(group)
+                except Exception as e:
+                    log.warning("%d merged actions failed, running them one at a time: %s", len(group), e)
+                    self.merge_failed.update(action.uuid for action, pipeline_info in group)
+                    queue.extendleft(reversed(group))
+                    continue
+                yield from executed
+            else:
+                action, pipeline_info = group[0]
+                self.merge_failed.discard(action.uuid)
+                yield self.execute_pipelined(action, pipeline_info)
+
+
+class ExecutorTask:
+    """
+    A task queued in a PipelineExecutor
+    """
+    def __init__(self, func: Callable[[], None], task_id: Optional[str], after: Optional[Sequence[str]]):
+        self.func = func
+        self.task_id = task_id
+        # Ids of the tasks to wait for, or None to wait for all the tasks
+        # submitted before this one
+        self.after = after
+
+
+class PipelineQueue:
+    """
+    Tasks of a pipeline in a PipelineExecutor
+    """
+    def __init__(self):
+        # Tasks waiting to be run, in submission order
+        self.waiting: List[ExecutorTask] = []
+        # Ids of the tasks that are waiting or running
+        self.pending_ids: Set[str] = set()
+        # Number of tasks currently running
+        self.running = 0
+        # True while running a task that no other task can run alongside
+        self.barrier_running = False
+
+    def pop_ready(self) -> List[ExecutorTask]:
+        """
+        Remove from the waiting list and return all the tasks that can start
+        """
+        if self.barrier_running:
+            return []
+        res: List[ExecutorTask] = []
+        remaining: List[ExecutorTask] = []
+        for pos, task in enumerate(self.waiting):
+            if task.after is None:
+                # Wait for all the previous tasks
+                if pos == 0 and self.running == 0:
+                    res.append(task)
+                    remaining.extend(self.waiting[1:])
+                    self.barrier_running = True
+                else:
+                    remaining.extend(self.waiting[pos:])
+                break
+            elif any(dep in self.pending_ids for dep in task.after):
+                remaining.append(task)
+            else:
+                res.append(task)
+        self.waiting = remaining
+        self.running += len(res)
+        return res
+
+    def __bool__(self):
+        return bool(self.waiting) or self.running > 0
+
+
+class PipelineExecutor:
+    """
+    Run tasks of different pipelines concurrently on a thread pool.
+
+    Tasks submitted for the same pipeline are run one at a time, in the order
+    they were submitted, so that each pipeline sees its actions executed
+    sequentially, as it would without an executor.
+
+    Tasks submitted with a list of dependencies instead only wait for those
+    tasks to be done, and can run concurrently with other tasks of the same
+    pipeline.
+    """
+    def __init__(self, max_workers: Optional[int] = None):
+        self.pool = concurrent.futures.ThreadPoolExecutor(
+                max_workers=max_workers, thread_name_prefix="pipeline")
+        self.lock = threading.Lock()
+        # Notified when all tasks have been run
+        self.idle = threading.Condition(self.lock)
+        # Tasks waiting or running, indexed by pipeline id
+        self.queues: Dict[str, PipelineQueue] = {}
+
+    def submit(
+            self, pipeline_id: str, func: Callable[[], None],
+            task_id: Optional[str] = None, after: Optional[Sequence[str]] = None):
+        """
+        Queue a task for a pipeline.
+
+        If ``after`` is None, the task is run after all other tasks queued for
+        the same pipeline. Otherwise, it is run as soon as the tasks of the
+        same pipeline whose ``task_id`` is listed in ``after`` are done.
+        Dependencies on tasks that are not queued are considered satisfied.
+
+        Tasks are expected to handle their own exceptions: exceptions that
+        escape a task are logged and ignored
+        """
+        with self.lock:
+            queue = self.queues.get(pipeline_id)
+            if queue is None:
+                queue = self.queues[pipeline_id] = PipelineQueue()
+            queue.waiting.append(ExecutorTask(func, task_id, after))
+            if task_id is not None:
+                queue.pending_ids.add(task_id)
+            ready = queue.pop_ready()
+        for task in ready:
+            self.pool.submit(self._run_task, pipeline_id, queue, task)
+
+    def _run_task(self, pipeline_id: str, queue: PipelineQueue, task: ExecutorTask):
+        """
+        Run a task, then start the tasks of the pipeline that become ready
+        """
+        try:
+            task.func()
+        except Exception:
+            log.exception("pipeline %s: task failed", pipeline_id)
+
+        with self.lock:
+            queue.running -= 1
+            if task.after is None:
+                queue.barrier_running = False
+            if task.task_id is not None:
+                queue.pending_ids.discard(task.task_id)
+            ready = queue.pop_ready()
+            if not queue:
+                del self.queues[pipeline_id]
+                if not self.queues:
+                    self.idle.notify_all()
+        for next_task in ready:
+            self.pool.submit(self._run_task, pipeline_id, queue, next_task)
+
+    def join(self):
+        """
+        Wait until all submitted tasks have been run
+        """
+        with self.lock:
+            while self.queues:
+                self.idle.wait()
+
+    def shutdown(self):
+        """
+        Wait for all submitted tasks, and stop the worker threads
+        """
+        self.pool.shutdown(wait=True)
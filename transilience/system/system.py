@@ -1,5 +1,5 @@
 from __future__ import annotations
-from typing import TYPE_CHECKING, Type, Dict, Any, Callable, BinaryIO, List
+from typing import TYPE_CHECKING, Type, Dict, Any, Callable, BinaryIO, Hashable, List, Optional, Sequence, Set, Tuple
 from dataclasses import dataclass, field, asdict
 import threading
 
@@ -16,6 +16,11 @@ class PipelineInfo:
     # Execute only when the state of all the given actions previous executed in
     # the same pipeline (identified by uuid) is one of those listed
     when: Dict[str, List[str]] = field(default_factory=dict)
+    # If set, execution can start as soon as the given actions in the same
+    # pipeline (identified by uuid) have been executed, instead of waiting
+    # for all the actions previously sent. Systems are free to ignore this
+    # and execute actions in order
+    after: Optional[List[str]] = None
 
     def serialize(self) -> Dict[str, Any]:
         """
@@ -39,6 +44,39 @@ class System:
         # Objects that can be registered by actions as caches
         self.caches: Dict[Type[Action], Any] = {}
         self.caches_lock = threading.Lock()
+        # Work deferred by actions, indexed by a key identifying it, with the
+        # ids of the pipelines that deferred it
+        self.deferred: Dict[Hashable, Tuple[Callable[[], None], Set[str]]] = {}
+        self.deferred_lock = threading.Lock()
+        # Persist the parsed dpkg status across connections, see
+        # transilience.actions.apt.DPKG_STATUS_SNAPSHOT_DIR
+        self.dpkg_status_snapshot = False
+        # Failures of work deferred by pipelines that have been closed, as
+        # (pipeline id, error message), until pop_deferred_failures()
+        self.deferred_failures: List[Tuple[str, str]] = []
+        # Pipeline of the action being executed by each thread
+        self.current_pipeline = threading.local()
+        # Functions called with each action that starts running on this
+        # system, which caches can use to notice changes made by other actions
+        self.action_listeners: List[Callable[[Action], None]] = []
+        self.action_listeners_lock = threading.Lock()
+
+    def add_action_listener(self, func: Callable[[Action], None]):
+        """
+        Call func with each action that starts running on this system
+        """
+        with self.action_listeners_lock:
+            self.action_listeners.append(func)
+
+    def action_started(self, actions: Sequence[Action]):
+        """
+        Notify the action listeners that these actions are starting to run
+        """
+        with self.action_listeners_lock:
+            listeners = list(self.action_listeners)
+        for func in listeners:
+            for action in actions:
+                func(action)
 
     def close(self):
         """
@@ -59,6 +97,98 @@ class System:
                 self.caches[action] = res
             return res
 
+    def current_pipeline_id(self) -> Optional[str]:
+        """
+        Return the id of the pipeline of the action being executed by this
+        thread, or None if it is not executed as part of a pipeline
+        """
+        return getattr(self.current_pipeline, "id", None)
+
+    def defer(self, key: Hashable, func: Callable[[], None]):
+        """
+        Schedule func to be run later by run_deferred(), at the latest when
+        the pipeline of the current action is closed.
+
+        If work with the same key is already scheduled, it is run only once.
+        Outside of a pipeline, func is run right away
+        """
+        pipeline_id = self.current_pipeline_id()
+        if pipeline_id is None:
+            with self.deferred_lock:
+                func()
+            return
+
+        with self.deferred_lock:
+            entry = self.deferred.get(key)
+            if entry is None:
+                self.deferred[key] = (func, {pipeline_id})
+            else:
+                entry[1].add(pipeline_id)
+
+    def cancel_deferred(self, key: Hashable) -> bool:
+        """
+        Unschedule deferred work, for example because an action performed it
+        right away.
+
+        Returns True if work with the given key was scheduled
+        """
+        with self.deferred_lock:
+            return self.deferred.pop(key, None) is not None
+
+    def run_deferred(self, key: Optional[Hashable] = None, pipeline_id: Optional[str] = None):
+        """
+        Run the deferred work with the given key, or that was deferred by the
+        given pipeline, or all deferred work if both are None.
+
+        Running work also satisfies other pipelines that deferred the same
+        key. If it fails, it stays scheduled for them, and the first exception
+        is raised after all the other work has run
+        """
+        failed_pipeline = pipeline_id if pipeline_id is not None else self.current_pipeline_id()
+        error: Optional[Exception] = None
+        # Run while holding the lock, so that concurrent actions waiting for
+        # the deferred work do not proceed before it is done
+        with self.deferred_lock:
+            if key is not None:
+                keys = [key] if key in self.deferred else []
+            elif pipeline_id is not None:
+                keys = [k for k, (func, pipelines) in self.deferred.items() if pipeline_id in pipelines]
+            else:
+                keys = list(self.deferred)
+
+            for k in keys:
+                func, pipelines = self.deferred.pop(k)
+                try:
+                    func()
+                except Exception as e:
+                    pipelines.discard(failed_pipeline)
+                    if pipelines:
+                        self.deferred[k] = (func, pipelines)
+                    if error is None:
+                        error = e
+
+        if error is not None:
+            raise error
+
+    def pop_deferred_failures(self) -> List[Tuple[str, str]]:
+        """
+        Return and forget the failures of the work deferred by pipelines
+        that have been closed, as (pipeline id, error message) tuples
+        """
+        with self.deferred_lock:
+            res = self.deferred_failures
+            self.deferred_failures = []
+        return res
+
+    def raise_deferred_failures(self):
+        """
+        Raise RuntimeError if work deferred by pipelines that have been
+        closed failed
+        """
+        failures = self.pop_deferred_failures()
+        if failures:
+            raise RuntimeError("deferred work failed: " + "; ".join(error for pipeline_id, error in failures))
+
     def share_file(self, pathname: str):
         """
         Register a pathname as exportable to children
@@ -84,5 +214,13 @@ class System:
         """
         Fetch file ``src`` from the controller and write it to the open
         file descriptor ``dst``.
+
+        If given, ``checksum`` is the SHA1 checksum of the contents of
+        ``src``, which implementations can use to avoid transferring contents
+        that they already have.
+
+        If given, ``basis`` is the path of a local file with a different
+        version of ``src``, which implementations can use to transfer only
+        the differences.
         """
         raise NotImplementedError(f"{self.__class__}.transfer_file is not implemented")
@@ -0,0 +1,287 @@
+from __future__ import annotations
+from typing import Dict, List, Tuple, Type, Any, Optional, Union
+import collections
+import dataclasses
+import hashlib
+from ..actions.action import Action, Result, resolver
+from .system import PipelineInfo
+
+# Fields common to all actions, which are encoded separately
+COMMON_FIELDS = frozenset(("uuid", "result"))
+
+# Field value types that can be sent as they are
+SCALAR_TYPES = frozenset((str, bytes, int, float, bool, type(None)))
+
+# str and bytes field values at least this long are sent by reference: their
+# contents travel only the first time they are sent over a connection
+CONTENT_REF_MIN_SIZE = 16 * 1024
+
+# Total length of the contents sent by reference that are kept for each
+# direction of a connection
+CONTENT_REF_CACHE_SIZE = 64 * 1024 * 1024
+
+# Cache of action field schemas, indexed by action class
+_schemas: Dict[Type[Action], Tuple[str, ...]] = {}
+
+
+def action_schema(action_cls: Type[Action]) -> Tuple[str, ...]:
+    """
+    Return the names of the fields of an action class, in the order they are
+    encoded
+    """
+    res = _schemas.get(action_cls)
+    if res is None:
+        res = tuple(f.name for f in dataclasses.fields(action_cls) if f.name not in COMMON_FIELDS)
+        _schemas[action_cls] = res
+    return res
+
+
+def encode_value(value: Any) -> Any:
+    """
+    Encode a field value for sending.
+
+    Values are not copied, since they are copied anyway when pickled to be
+    sent. Dataclasses are converted to dicts, as Action.serialize() would do
+    """
+    if type(value) in SCALAR_TYPES:
+        return value
+    if dataclasses.is_dataclass(value) and not isinstance(value, type):
+        return dataclasses.asdict(value)
+    return value
+
+
+def content_key(value: Union[str, bytes]) -> str:
+    """
+    Return the key identifying a str or bytes value sent by reference
+    """
+    if isinstance(value, str):
+        return "s" + hashlib.sha1(value.encode(errors="surrogatepass")).hexdigest()
+    else:
+        return "b" + hashlib.sha1(value).hexdigest()
+
+
+class ContentStore:
+    """
+    Least recently used contents sent by reference in one direction of a
+    connection, kept within ``max_size`` total length.
+
+    The sender and the receiver update their stores with the same operations
+    in the same order, so they always hold the same keys. The sender only
+    needs the keys, and stores None instead of contents
+    """
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        # Total length of the entries
+        self.size = 0
+        # (length, contents) indexed by key, from least to most recently used
+        self.entries: collections.OrderedDict[str, Tuple[int, Union[str, bytes, None]]] = collections.OrderedDict()
+
+    def get(self, key: str) -> Optional[Tuple[int, Union[str, bytes, None]]]:
+        """
+        Look up an entry, marking it as the most recently used
+        """
+        entry = self.entries.get(key)
+        if entry is not None:
+            self.entries.move_to_end(key)
+        return entry
+
+    def add(self, key: str, size: int, content: Union[str, bytes, None]):
+        """
+        Add an entry, removing the least recently used ones if needed
+        """
+        old = self.entries.pop(key, None)
+        if old is not None:
+            self.size -= old[0]
+        self.entries[key] = (size, content)
+        self.size += size
+        while self.size > self.max_size:
+            self.size -= self.entries.popitem(last=False)[1][0]
+
+
+class CompactCodec:
+    """
+    Compact serialization of actions over a connection.
+
+    Actions are encoded as tuples::
+
+        (type_id, definition, uuid, result_state, result_elapsed, values, refs)
+
+    ``values`` has the values of all action fields, in the order given by the
+    schema of the action class. Action classes are identified by integer ids,
+    assigned by the sender the first time it sends an action of that class:
+    in that case, ``definition`` is a ``(name, schema)`` tuple that the
+    receiver uses to register the id. Otherwise, ``definition`` is None.
+
+    str and bytes values of at least ``content_ref_min_size`` are sent by
+    reference: their position in ``values`` is None, and ``refs`` is a tuple
+    of ``(index, key, content)`` tuples. ``content`` is the value itself the
+    first time the value is sent, and None afterwards, when the receiver looks
+    it up by ``key``. ``refs`` is None if no values are sent by reference.
+
+    The receiver keeps the contents it received, and the sender the keys it
+    sent, each in a ContentStore of ``content_ref_cache_size``. Both update
+    them in the same order, so they evict the same contents, which are then
+    sent again if needed. Each direction has its own stores: contents
+    received in an action are sent again the first time they appear in a
+    result.
+
+    Actions serialized as dicts with Action.serialize() can also send values
+    by reference, with encode_serialized() and decode_serialized().
+
+    One codec needs to be used on each side of a connection, and messages need
+    to be decoded in the same order as they were encoded.
+    """
+    def __init__(
+            self,
+            content_ref_min_size: Optional[int] = CONTENT_REF_MIN_SIZE,
+            content_ref_cache_size: int = CONTENT_REF_CACHE_SIZE):
+        # Minimum size of values sent by reference, or None to send all values
+        # as they are
+        self.content_ref_min_size = content_ref_min_size
+        # Keys of the contents that the other side keeps
+        self.sent = ContentStore(content_ref_cache_size)
+        # Contents received from the other side
+        self.received = ContentStore(content_ref_cache_size)
+        # Action class ids indexed by action class
+        self.type_ids: Dict[Type[Action], int] = {}
+        # Action class and schema indexed by action class id
+        self.types: Dict[int, Tuple[Type[Action], Tuple[str, ...]]] = {}
+
+    def encode(self, action: Action) -> Tuple:
+        """
+        Encode an action as a tuple
+        """
+        action_cls = action.__class__
+        schema = action_schema(action_cls)
+        type_id = self.type_ids.get(action_cls)
+        if type_id is None:
+            type_id = len(self.types)
+            self.type_ids[action_cls] = type_id
+            self.types[type_id] = (action_cls, schema)
+            definition: Optional[Tuple[str, Tuple[str, ...]]] = (
+                    f"{action_cls.__module__}.{action_cls.__qualname__}", schema)
+        else:
+            definition = None
+
+        values = [encode_value(getattr(action, name)) for name in schema]
+        refs = self.encode_refs(values) if self.content_ref_min_size is not None else None
+
+        return (
+            type_id, definition, action.uuid, action.result.state, action.result.elapsed,
+            tuple(values), refs,
+        )
+
+    def encode_refs(self, values: List[Any]) -> Optional[Tuple[Tuple[int, str, Union[str, bytes, None]], ...]]:
+        """
+        Replace large str and bytes values with None, and return the
+        references to send in their place
+        """
+        refs = []
+        for idx, value in enumerate(values):
+            if type(value) not in (str, bytes):
+                continue
+            size = len(value)
+            # Values that would not fit in the store are sent as they are
+            if size < self.content_ref_min_size or size > self.sent.max_size:
+                continue
+            key = content_key(value)
+            if self.sent.get(key) is not None:
+                refs.append((idx, key, None))
+            else:
+                self.sent.add(key, size, None)
+                refs.append((idx, key, value))
+            values[idx] = None
+        if not refs:
+            return None
+        return tuple(refs)
+
+    def decode_refs(self, refs: Optional[Tuple[Tuple[Any, str, Any], ...]]) -> List[Tuple[Any, Union[str, bytes]]]:
+        """
+        Resolve references sent by the other side, returning (position,
+        content) tuples
+        """
+        res: List[Tuple[Any, Union[str, bytes]]] = []
+        if refs is None:
+            return res
+        for pos, key, content in refs:
+            if content is None:
+                entry = self.received.get(key)
+                if entry is None:
+                    raise ValueError(f"content {key} has not been sent on this connection")
+                content = entry[1]
+            else:
+                self.received.add(key, len(content), content)
+            res.append((pos, content))
+        return res
+
+    def encode_serialized(self, serialized: Dict[str, Any]) -> Dict[str, Any]:
+        """
+        Send by reference the large str and bytes values of an action
+        serialized with Action.serialize(), in place.
+
+        Their fields are set to None, and ``__refs__`` lists ``(name, key,
+        content)`` tuples like ``refs`` in the compact encoding
+        """
+        if self.content_ref_min_size is None:
+            return serialized
+        names = list(serialized)
+        refs = self.encode_refs(list(serialized.values()))
+        if refs is None:
+            return serialized
+        for idx, key, content in refs:
+            serialized[names[idx]] = None
+        serialized["__refs__"] = tuple((names[idx], key, content) for idx, key, content in refs)
+        return serialized
+
+    def decode_serialized(self, serialized: Dict[str, Any]) -> Dict[str, Any]:
+        """
+        Resolve in place the references in an action serialized with
+        encode_serialized() by the other side
+        """
+        for name, content in self.decode_refs(serialized.pop("__refs__", None)):
+            serialized[name] = content
+        return serialized
+
+    def decode(self, encoded: Tuple) -> Action:
+        """
+        Decode an action encoded by the codec at the other side of the
+        connection
+        """
+        type_id, definition, uuid, state, elapsed, values, refs = encoded
+
+        # Update the content store first, to keep it in sync with the sender
+        # even if decoding fails
+        ref_values = self.decode_refs(refs)
+
+        if definition is not None:
+            name, schema = definition
+            action_cls = resolver.resolve(name)
+            self.type_ids[action_cls] = type_id
+            self.types[type_id] = (action_cls, schema)
+        else:
+            try:
+                action_cls, schema = self.types[type_id]
+            except KeyError:
+                raise ValueError(f"action type {type_id} has not been defined on this connection")
+
+        fields = dict(zip(schema, values))
+        for idx, content in ref_values:
+            fields[schema[idx]] = content
+
+        return action_cls(uuid=uuid, result=Result(state=state, elapsed=elapsed), **fields)
+
+    def encode_pipeline_info(self, pipeline_info: Optional[PipelineInfo]) -> Optional[Tuple]:
+        """
+        Encode pipeline metadata as a tuple
+        """
+        if pipeline_info is None:
+            return None
+        return (pipeline_info.id, pipeline_info.when, pipeline_info.after)
+
+    def decode_pipeline_info(self, encoded: Optional[Tuple]) -> Optional[PipelineInfo]:
+        """
+        Decode pipeline metadata encoded with encode_pipeline_info
+        """
+        if encoded is None:
+            return None
+        return PipelineInfo(id=encoded[0], when=encoded[1], after=encoded[2])
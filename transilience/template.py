@@ -1,7 +1,19 @@
 from __future__ import annotations
 from typing import Optional, List, Dict, Any
+import collections
+import threading
+import hashlib
+import time
+import os
 import jinja2
 
+# Number of compiled string templates kept by Engine.render_string
+STRING_CACHE_SIZE = 1024
+
+# Directory where new engines cache compiled file templates, if they are not
+# given one
+default_bytecode_cache_dir: Optional[str] = None
+
 
 def finalize_value(val):
     """
@@ -15,11 +27,41 @@ def finalize_value(val):
         return val
 
 
+class BytecodeCache(jinja2.FileSystemBytecodeCache):
+    """
+    FileSystemBytecodeCache that counts how many compiled templates it found
+    """
+    def __init__(self, directory: str):
+        super().__init__(directory)
+        self.lock = threading.Lock()
+        # Number of templates found compiled in the cache
+        self.hits = 0
+        # Number of templates that needed compiling
+        self.misses = 0
+
+    def load_bytecode(self, bucket: jinja2.bccache.Bucket):
+        super().load_bytecode(bucket)
+        with self.lock:
+            if bucket.code is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+
+
 class Engine:
     """
-    Jinja2 machinery tuned to render text templates
+    Jinja2 machinery tuned to render text templates.
+
+    Templates rendered from strings are compiled once and kept in a least
+    recently used cache of ``cache_size`` entries. If ``bytecode_cache_dir``
+    is set, or ``default_bytecode_cache_dir`` is, compiled file templates are
+    also stored there, and reused across runs.
     """
-    def __init__(self, template_paths: Optional[List[str]] = None):
+    def __init__(
+            self,
+            template_paths: Optional[List[str]] = None,
+            cache_size: int = STRING_CACHE_SIZE,
+            bytecode_cache_dir: Optional[str] = None):
         if template_paths is None:
             template_paths = ["."]
 
@@ -29,16 +71,80 @@ class Engine:
                 finalize=finalize_value,
                 loader=jinja2.FileSystemLoader(template_paths))
 
+        self.cache_size = cache_size
+        # Compiled string templates, indexed by SHA1 of their source
+        self.string_cache: collections.OrderedDict[bytes, jinja2.Template] = collections.OrderedDict()
+        self.lock = threading.Lock()
+        # Number of string templates found in the cache
+        self.hits = 0
+        # Number of string templates that needed compiling
+        self.misses = 0
+        # Nanoseconds spent compiling string templates
+        self.compile_ns = 0
+        # Nanoseconds spent loading file templates, which includes
+        # compiling them when they are not cached
+        self.load_ns = 0
+
+        if bytecode_cache_dir is None:
+            bytecode_cache_dir = default_bytecode_cache_dir
+        if bytecode_cache_dir is not None:
+            self.set_bytecode_cache(bytecode_cache_dir)
+
+    def set_bytecode_cache(self, path: str):
+        """
+        Store the compiled bytecode of file templates in the given directory
+        """
+        os.makedirs(path, mode=0o700, exist_ok=True)
+        self.env.bytecode_cache = BytecodeCache(path)
+
+    def stats(self) -> Dict[str, Any]:
+        """
+        Return statistics about template compilation: hits and misses of the
+        string template cache and of the bytecode cache of file templates,
+        and the time spent compiling and loading them
+        """
+        bytecode_cache = self.env.bytecode_cache
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "bytecode_hits": bytecode_cache.hits if isinstance(bytecode_cache, BytecodeCache) else 0,
+            "bytecode_misses": bytecode_cache.misses if isinstance(bytecode_cache, BytecodeCache) else 0,
+            "compile_ms": self.compile_ns / 1_000_000,
+            "load_ms": self.load_ns / 1_000_000,
+        }
+
     def render_string(self, template: str, ctx: Dict[str, Any]) -> str:
         """
         Render a template from a string
         """
-        tpl = self.env.from_string(template)
+        key = hashlib.sha1(template.encode(errors="surrogatepass")).digest()
+        with self.lock:
+            tpl = self.string_cache.get(key)
+            if tpl is not None:
+                self.string_cache.move_to_end(key)
+                self.hits += 1
+
+        if tpl is None:
+            start = time.perf_counter_ns()
+            tpl = self.env.from_string(template)
+            elapsed = time.perf_counter_ns() - start
+            with self.lock:
+                self.misses += 1
+                self.compile_ns += elapsed
+                self.string_cache[key] = tpl
+                while len(self.string_cache) > self.cache_size:
+                    self.string_cache.popitem(last=False)
+
         return tpl.render(**ctx)
 
     def render_file(self, path: str, ctx: Dict[str, Any]) -> str:
         """
         Render a template from a file, relative to template_paths
         """
+        start = time.perf_counter_ns()
         tpl = self.env.get_template(path)
+        elapsed = time.perf_counter_ns() - start
+        with self.lock:
+            self.load_ns += elapsed
         return tpl.render(**ctx)
+
@@ -3,12 +3,15 @@ from typing import Sequence, Optional
 import logging
 import contextlib
 import subprocess
+import threading
 import shlex
 import os
 import tempfile
 
 log = logging.getLogger(__name__)
 
+_umask_lock = threading.Lock()
+
 
 def run(cmd: Sequence[str], check: bool = True, **kw) -> subprocess.CompletedProcess:
     """
@@ -20,6 +23,28 @@ def run(cmd: Sequence[str], check: bool = True, **kw) -> subprocess.CompletedPro
     return subprocess.run(cmd, check=check, **kw)
 
 
+def get_umask() -> int:
+    """
+    Return the current umask of the process.
+
+    os.umask can only read the umask by temporarily changing it, which would
+    affect files created meanwhile by other threads: on Linux, the umask is
+    read from /proc instead
+    """
+    try:
+        with open("/proc/self/status", "rt") as fd:
+            for line in fd:
+                if line.startswith("Umask:"):
+                    return int(line[6:].strip(), 8)
+    except FileNotFoundError:
+        pass
+
+    with _umask_lock:
+        cur_umask = os.umask(0)
+        os.umask(cur_umask)
+    return cur_umask
+
+
 @contextlib.contextmanager
 def atomic_writer(
         fname: str,
@@ -43,9 +68,7 @@ def atomic_writer(
     """
 
     if use_umask:
-        cur_umask = os.umask(0)
-        os.umask(cur_umask)
-        chmod &= ~cur_umask
+        chmod &= ~get_umask()
 
     dirname = os.path.dirname(fname)
     if not os.path.isdir(dirname):
@@ -0,0 +1,162 @@
+from __future__ import annotations
+from typing import Optional, Dict, Tuple
+import threading
+import hashlib
+import logging
+import json
+import time
+import os
+from . import atomic_writer
+
+log = logging.getLogger(__name__)
+
+# Files modified less than this many nanoseconds before being hashed are not
+# cached, since they could change again without changing their mtime
+RACY_INTERVAL_NS = 2_000_000_000
+
+
+class ChecksumCache:
+    """
+    Cache of SHA1 checksums of local files.
+
+    Checksums are reused as long as the device, inode, size and modification
+    time of a file are unchanged.
+
+    If ``path`` is given, the cache is loaded from that file, and save() writes
+    it back.
+    """
+    def __init__(self, path: Optional[str] = None):
+        self.path: Optional[str] = None
+        # (st_dev, st_ino, st_size, st_mtime_ns, sha1) indexed by file name
+        self.entries: Dict[str, Tuple[int, int, int, int, str]] = {}
+        self.lock = threading.Lock()
+        # True if entries changed since the last load or save
+        self.dirty = False
+        # Number of checksums found in the cache
+        self.hits = 0
+        # Number of checksums that needed hashing a file
+        self.misses = 0
+        if path is not None:
+            self.load(path)
+
+    def load(self, path: str):
+        """
+        Load cached checksums from the given file, and use it for saving
+        """
+        self.path = path
+        try:
+            with open(path, "rt") as fd:
+                data = json.load(fd)
+        except FileNotFoundError:
+            return
+        except ValueError as e:
+            log.warning("%s: ignoring invalid checksum cache: %s", path, e)
+            return
+
+        rows = data.get("entries", ()) if isinstance(data, dict) else None
+        if not isinstance(rows, list):
+            log.warning("%s: ignoring invalid checksum cache: entries are not a list", path)
+            return
+
+        invalid = 0
+        with self.lock:
+            for row in rows:
+                if not self._valid_row(row):
+                    invalid += 1
+                    continue
+                name, dev, ino, size, mtime_ns, sha1 = row
+                self.entries.setdefault(name, (dev, ino, size, mtime_ns, sha1))
+        if invalid:
+            log.warning("%s: ignoring %d invalid checksum cache entries", path, invalid)
+            self.dirty = True
+
+    @staticmethod
+    def _valid_row(row) -> bool:
+        """
+        Check that a row loaded from a cache file is a
+        ``[name, dev, ino, size, mtime_ns, sha1]`` list
+        """
+        if not isinstance(row, list) or len(row) != 6:
+            return False
+        if not isinstance(row[0], str) or not isinstance(row[5], str):
+            return False
+        return all(type(v) is int for v in row[1:5])
+
+    def prune(self):
+        """
+        Remove entries of files that no longer exist, or have changed
+        """
+        with self.lock:
+            names = list(self.entries.items())
+
+        stale = []
+        for name, entry in names:
+            try:
+                st = os.stat(name)
+            except OSError:
+                stale.append(name)
+                continue
+            if (st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns) != entry[:4]:
+                stale.append(name)
+
+        if not stale:
+            return
+
+        with self.lock:
+            for name in stale:
+                self.entries.pop(name, None)
+            self.dirty = True
+
+    def save(self):
+        """
+        Write the cache to its file, if it has one and it has changed.
+
+        Entries of files that no longer exist, or have changed, are not saved
+        """
+        if self.path is None:
+            return
+
+        self.prune()
+        if not self.dirty:
+            return
+
+        with self.lock:
+            entries = [(name,) + entry for name, entry in self.entries.items()]
+            self.dirty = False
+
+        with atomic_writer(self.path, "wt", chmod=0o600, sync=False) as fd:
+            json.dump({"entries": entries}, fd)
+
+    def sha1sum(self, path: str) -> str:
+        """
+        Return the SHA1 checksum of the contents of a file
+        """
+        with open(path, "rb") as fd:
+            st = os.fstat(fd.fileno())
+            key = (st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns)
+
+            with self.lock:
+                entry = self.entries.get(path)
+                if entry is not None and entry[:4] == key:
+                    self.hits += 1
+                    return entry[4]
+                self.misses += 1
+
+            h = hashlib.sha1()
+            while True:
+                buf = fd.read(40960)
+                if not buf:
+                    break
+                h.update(buf)
+            checksum = h.hexdigest()
+
+        if time.time_ns() - st.st_mtime_ns >= RACY_INTERVAL_NS:
+            with self.lock:
+                self.entries[path] = key + (checksum,)
+                self.dirty = True
+
+        return checksum
+
+
+# Checksum cache used by actions that need to checksum local files
+cache = ChecksumCache()
@@ -0,0 +1,102 @@
+from __future__ import annotations
+from typing import BinaryIO, Iterable, Iterator, Optional
+import zlib
+import lzma
+import os
+
+# Streaming compression of files being transferred
+
+# Size of the chunks read from files being compressed
+CHUNK_SIZE = 128 * 1024
+
+# Files smaller than this are not worth compressing
+MIN_SIZE = 4096
+
+# lzma compresses better than zlib, but it is too slow for files bigger than
+# this
+LZMA_MAX_SIZE = 8 * 1024 * 1024
+
+# Extensions of files whose contents are already compressed
+COMPRESSED_EXTENSIONS = frozenset((
+    ".gz", ".tgz", ".bz2", ".tbz", ".xz", ".txz", ".lzma", ".zst", ".lz4", ".lz",
+    ".zip", ".jar", ".whl", ".deb", ".rpm", ".apk", ".7z", ".rar",
+    ".png", ".jpg", ".jpeg", ".gif", ".webp", ".avif",
+    ".mp3", ".mp4", ".mkv", ".ogg", ".opus", ".webm", ".flac",
+    ".woff", ".woff2", ".pdf",
+))
+
+
+def choose_method(path: str, size: int) -> Optional[str]:
+    """
+    Choose how to compress a file for transfer.
+
+    Returns "lzma", "zlib", or None if the file should be sent as it is
+    """
+    if size < MIN_SIZE:
+        return None
+    if os.path.splitext(path)[1].lower() in COMPRESSED_EXTENSIONS:
+        return None
+    if size <= LZMA_MAX_SIZE:
+        return "lzma"
+    return "zlib"
+
+
+def _compressor(method: str):
+    if method == "zlib":
+        return zlib.compressobj()
+    elif method == "lzma":
+        return lzma.LZMACompressor()
+    else:
+        raise ValueError(f"unsupported compression method {method!r}")
+
+
+def compress(fd: BinaryIO, method: Optional[str]) -> Iterator[bytes]:
+    """
+    Read fd until the end, and generate its contents compressed with the
+    given method
+    """
+    compressor = _compressor(method) if method is not None else None
+    while True:
+        buf = fd.read(CHUNK_SIZE)
+        if not buf:
+            break
+        if compressor is None:
+            yield buf
+            continue
+        buf = compressor.compress(buf)
+        if buf:
+            yield buf
+    if compressor is not None:
+        buf = compressor.flush()
+        if buf:
+            yield buf
+
+
+def decompress(chunks: Iterable[bytes], method: Optional[str]) -> Iterator[bytes]:
+    """
+    Generate the decompressed contents of a sequence of chunks generated by
+    compress()
+    """
+    if method is None:
+        yield from chunks
+        return
+
+    if method == "zlib":
+        decompressor = zlib.decompressobj()
+    elif method == "lzma":
+        decompressor = lzma.LZMADecompressor()
+    else:
+        raise ValueError(f"unsupported compression method {method!r}")
+
+    for chunk in chunks:
+        buf = decompressor.decompress(chunk)
+        if buf:
+            yield buf
+
+    if method == "zlib":
+        buf = decompressor.flush()
+        if buf:
+            yield buf
+
+    if not decompressor.eof:
+        raise ValueError("compressed data is truncated")
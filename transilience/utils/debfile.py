@@ -0,0 +1,150 @@
+from __future__ import annotations
+from typing import Dict, Optional, Tuple
+import subprocess
+import threading
+import tarfile
+import io
+import os
+from . import checksums
+
+try:
+    import zstandard
+    HAVE_ZSTANDARD = True
+except ImportError:
+    HAVE_ZSTANDARD = False
+
+# Read package information from .deb files.
+#
+# A .deb file is an ar archive containing a control.tar archive, possibly
+# compressed, which in turn contains the control file with the package
+# metadata.
+
+AR_MAGIC = b"!<arch>\n"
+AR_HEADER_SIZE = 60
+
+# Compression extensions of control.tar that can be read in-process.
+# control.tar.zst can also be read in-process if the zstandard module is
+# available: otherwise, it is read using dpkg-deb
+CONTROL_TAR_EXTENSIONS = frozenset((b"", b".gz", b".xz", b".bz2"))
+
+# (package, version, architecture)
+DebInfo = Tuple[str, str, str]
+
+
+def control_field(control: bytes, name: bytes) -> Optional[str]:
+    """
+    Return the value of a single-line field in a control file paragraph.
+
+    ``name`` is the field name followed by ``": "``
+    """
+    if control.startswith(name):
+        start = len(name)
+    else:
+        start = control.find(b"\n" + name)
+        if start == -1:
+            return None
+        start += len(name) + 1
+    end = control.find(b"\n", start)
+    if end == -1:
+        end = len(control)
+    return control[start:end].decode()
+
+
+def read_control(path: str) -> Optional[bytes]:
+    """
+    Return the contents of the control file of a .deb package.
+
+    Returns None if the control archive uses a compression that cannot be
+    read in-process, like zstd when the zstandard module is not available
+    """
+    with open(path, "rb") as fd:
+        if fd.read(len(AR_MAGIC)) != AR_MAGIC:
+            raise RuntimeError(f"{path!r} is not a .deb file")
+
+        while True:
+            header = fd.read(AR_HEADER_SIZE)
+            if len(header) < AR_HEADER_SIZE:
+                raise RuntimeError(f"{path!r} contains no control archive")
+            # GNU ar terminates member names with a slash
+            name = header[:16].rstrip(b" ").rstrip(b"/")
+            size = int(header[48:58])
+
+            if name.startswith(b"control.tar"):
+                ext = name[11:]
+                if ext == b".zst" and HAVE_ZSTANDARD:
+                    data = zstandard.ZstdDecompressor().decompressobj().decompress(fd.read(size))
+                elif ext in CONTROL_TAR_EXTENSIONS:
+                    data = fd.read(size)
+                else:
+                    return None
+                with tarfile.open(fileobj=io.BytesIO(data), mode="r:*") as tf:
+                    for member in tf:
+                        if member.isfile() and member.name in ("./control", "control"):
+                            return tf.extractfile(member).read()
+                raise RuntimeError(f"{path!r} contains no control file")
+
+            # Members are aligned to 2 bytes
+            fd.seek(size + (size & 1), os.SEEK_CUR)
+
+
+def dpkg_info(path: str) -> bytes:
+    """
+    Return the contents of the control file of a .deb package using dpkg-deb
+    """
+    res = subprocess.run(["dpkg-deb", "--info", path, "control"], capture_output=True, check=True)
+    return res.stdout
+
+
+def parse_deb_info(path: str, control: bytes) -> DebInfo:
+    """
+    Extract package, version and architecture from the contents of a control
+    file
+    """
+    package = control_field(control, b"Package: ")
+    if package is None:
+        raise RuntimeError(f"{path!r} contains no Package information")
+    version = control_field(control, b"Version: ")
+    if version is None:
+        raise RuntimeError(f"{path!r} contains no Version information")
+    arch = control_field(control, b"Architecture: ")
+    if arch is None:
+        raise RuntimeError(f"{path!r} contains no Architecture information")
+    return package, version, arch
+
+
+class DebInfoCache:
+    """
+    Cache of information about .deb files.
+
+    Information is reused as long as the SHA1 checksum of a file is unchanged.
+    Checksums are computed using ``checksum_cache``, which avoids rehashing files
+    whose device, inode, size and modification time did not change.
+    """
+    def __init__(self, checksum_cache: Optional[checksums.ChecksumCache] = None):
+        self.checksum_cache = checksum_cache if checksum_cache is not None else checksums.cache
+        # (sha1, info) indexed by file name
+        self.entries: Dict[str, Tuple[str, DebInfo]] = {}
+        self.lock = threading.Lock()
+
+    def info(self, path: str) -> DebInfo:
+        """
+        Return (package, version, architecture) for a .deb file
+        """
+        sha1 = self.checksum_cache.sha1sum(path)
+        with self.lock:
+            entry = self.entries.get(path)
+            if entry is not None and entry[0] == sha1:
+                return entry[1]
+
+        control = read_control(path)
+        if control is None:
+            control = dpkg_info(path)
+        info = parse_deb_info(path, control)
+
+        with self.lock:
+            self.entries[path] = (sha1, info)
+        return info
+
+
+# Cache used by actions that need to inspect .deb files
+cache = DebInfoCache()
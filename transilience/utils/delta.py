@@ -0,0 +1,166 @@
+from __future__ import annotations
+from typing import BinaryIO, Dict, Iterator, List, Tuple, Union
+import hashlib
+import mmap
+import zlib
+import os
+
+# rsync-style delta encoding of a file against a different version of it.
+#
+# The receiver has an old version of the file (the basis), splits it into
+# blocks, and sends a weak rolling checksum and a strong checksum for each
+# block. The sender scans the new version of the file looking for blocks with
+# the same checksums, and sends back a sequence of operations: either the
+# index of a block of the basis to copy, or literal data.
+
+# Adler-32 modulus
+ADLER_MOD = 65521
+
+# Maximum size of a literal data operation
+MAX_LITERAL = 128 * 1024
+
+# Looking for blocks in data that differs from the basis is slow: once at
+# least MISMATCH_MIN_SCAN bytes have been scanned, if more than
+# MAX_MISMATCH_RATIO of them did not match, give up and send the rest of the
+# file as literal data
+MISMATCH_MIN_SCAN = 1024 * 1024
+MAX_MISMATCH_RATIO = 0.5
+
+# A delta operation: int to copy a block of the basis, bytes for literal data
+DeltaOp = Union[int, bytes]
+
+# (weak checksum, strong checksum) for each block of the basis
+Signatures = List[Tuple[int, bytes]]
+
+
+def choose_block_size(size: int) -> int:
+    """
+    Choose a block size for a file of the given size
+    """
+    # Like rsync, use roughly the square root of the file size
+    block_size = 2048
+    while block_size * block_size < size and block_size < 128 * 1024:
+        block_size *= 2
+    return block_size
+
+
+def strong_checksum(data: bytes) -> bytes:
+    return hashlib.sha1(data).digest()
+
+
+def block_signatures(fd: BinaryIO, block_size: int) -> Signatures:
+    """
+    Compute the signatures of all the full blocks in a file
+    """
+    res: Signatures = []
+    while True:
+        block = fd.read(block_size)
+        if len(block) < block_size:
+            break
+        res.append((zlib.adler32(block), strong_checksum(block)))
+    return res
+
+
+def compute_delta(fd: BinaryIO, signatures: Signatures, block_size: int) -> Iterator[DeltaOp]:
+    """
+    Generate the operations that rebuild the contents of fd from a basis
+    with the given block signatures
+    """
+    # Index block numbers by weak and strong checksum
+    index: Dict[int, Dict[bytes, int]] = {}
+    for idx, (weak, strong) in enumerate(signatures):
+        index.setdefault(weak, {}).setdefault(strong, idx)
+
+    size = os.fstat(fd.fileno()).st_size
+    if size == 0:
+        return
+    if not index or size < block_size:
+        yield from _literal(fd, size)
+        return
+
+    with mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        # Last position where a full block starts
+        last = size - block_size
+        pos = 0
+        literal_start = 0
+        # Literal data sent so far
+        literal = 0
+        while pos <= last:
+            block = data[pos:pos + block_size]
+            candidates = index.get(zlib.adler32(block))
+            if candidates is not None:
+                idx = candidates.get(strong_checksum(block))
+                if idx is not None:
+                    if literal_start < pos:
+                        yield data[literal_start:pos]
+                        literal += pos - literal_start
+                    yield idx
+                    pos += block_size
+                    literal_start = pos
+                    continue
+
+            if pos == last:
+                break
+
+            pos = _roll(data, pos, min(last, literal_start + MAX_LITERAL), block_size, index)
+            if pos - literal_start >= MAX_LITERAL:
+                yield data[literal_start:pos]
+                literal += pos - literal_start
+                literal_start = pos
+
+            if pos >= MISMATCH_MIN_SCAN and literal + pos - literal_start > pos * MAX_MISMATCH_RATIO:
+                break
+
+        while literal_start < size:
+            end = min(literal_start + MAX_LITERAL, size)
+            yield data[literal_start:end]
+            literal_start = end
+
+
+def _roll(data: mmap.mmap, pos: int, stop: int, block_size: int, index: Dict[int, Dict[bytes, int]]) -> int:
+    """
+    Roll the weak checksum of the block at ``pos`` forward one byte at a
+    time, and return the first following position with a checksum in
+    ``index``, or ``stop``
+    """
+    weak = zlib.adler32(data[pos:pos + block_size])
+    a = weak & 0xffff
+    b = weak >> 16
+    # Iterating pairs of bytes is much faster than indexing data
+    for out_byte, in_byte in zip(data[pos:stop], data[pos + block_size:stop + block_size]):
+        a = (a - out_byte + in_byte) % ADLER_MOD
+        b = (b - block_size * out_byte + a - 1) % ADLER_MOD
+        pos += 1
+        if ((b << 16) | a) in index:
+            break
+    return pos
+
+
+def _literal(fd: BinaryIO, size: int) -> Iterator[DeltaOp]:
+    fd.seek(0)
+    while True:
+        buf = fd.read(MAX_LITERAL)
+        if not buf:
+            break
+        yield buf
+
+
+def apply_delta(basis: BinaryIO, ops: Iterator[DeltaOp], dst: BinaryIO, block_size: int) -> int:
+    """
+    Write to dst the result of applying delta operations to basis.
+
+    Returns the number of bytes written
+    """
+    written = 0
+    for op in ops:
+        if isinstance(op, int):
+            basis.seek(op * block_size)
+            block = basis.read(block_size)
+            if len(block) != block_size:
+                raise ValueError(f"block {op} is past the end of the basis file")
+            dst.write(block)
+            written += block_size
+        else:
+            dst.write(op)
+            written += len(op)
+    return written
@@ -1,5 +1,6 @@
 from __future__ import annotations
-from typing import NamedTuple, List, Tuple
+from typing import Dict, NamedTuple, List, Sequence, Tuple
+import functools
 import stat
 
 # Python port of coreutils lib/modechange
@@ -245,7 +246,7 @@ class ModeChange(NamedTuple):
         return compiled
 
     @classmethod
-    def adjust(cls, oldmode: int, is_dir: bool, umask_value: int, changes: List["ModeChange"]) -> Tuple[int, int]:
+    def adjust(cls, oldmode: int, is_dir: bool, umask_value: int, changes: Sequence["ModeChange"]) -> Tuple[int, int]:
         """
         Return the file mode bits of OLDMODE (which is the mode of a
         directory if DIR), assuming the umask is UMASK_VALUE, adjusted as
@@ -319,3 +320,42 @@ class ModeChange(NamedTuple):
                 newmode &= ~value
 
         return newmode, mode_bits
+
+
+class ModeProgram:
+    """
+    Compiled mode string, which memoizes the results of ModeChange.adjust.
+
+    A mode string can only produce a limited number of different results,
+    so when changing the mode of many files, most adjustments become a
+    dictionary lookup
+    """
+    def __init__(self, changes: Sequence[ModeChange]):
+        self.changes: Tuple[ModeChange, ...] = tuple(changes)
+        # (newmode, pmode_bits) indexed by (oldmode, is_dir, umask_value)
+        self.results: Dict[Tuple[int, bool, int], Tuple[int, int]] = {}
+
+    def adjust(self, oldmode: int, is_dir: bool, umask_value: int) -> Tuple[int, int]:
+        """
+        Same as ModeChange.adjust with the changes of this program
+        """
+        key = (oldmode & CHMOD_MODE_BITS, is_dir, umask_value)
+        res = self.results.get(key)
+        if res is None:
+            res = self.results[key] = ModeChange.adjust(key[0], is_dir, umask_value, self.changes)
+        return res
+
+    @classmethod
+    def compile(cls, mode_string: str) -> "ModeProgram":
+        """
+        Return the ModeProgram for a mode string.
+
+        Programs are cached, so compiling the same mode string again returns
+        the same object. Raise ValueError if 'mode_string' is invalid
+        """
+        return _compile_program(mode_string)
+
+
+@functools.lru_cache(maxsize=256)
+def _compile_program(mode_string: str) -> ModeProgram:
+    return ModeProgram(ModeChange.compile(mode_string))